@@ -0,0 +1,385 @@
+"""
+API load test.
+
+Seeds the catalog and the user table at the given sizes, then drives every route
+with concurrent clients and reports requests/sec, p50/p95/p99 latency and the peak
+RSS of the server. Each size and concurrency level runs in fresh processes, in one
+or both modes:
+
+    inprocess  requests go straight to the ASGI app, no sockets involved
+    loopback   the app runs under uvicorn and requests go over 127.0.0.1
+
+    python benchmarks/bench_api.py [--sizes 1000,100000,1000000] [--modes inprocess,loopback]
+                                   [--requests 2000] [--concurrency 1,16,64,256] [--users 100]
+                                   [--backend memory] [--scenarios get_book,search,...]
+                                   [--output results.json] [--compare baseline.json]
+
+With several concurrency levels, the level at which each scenario peaks (its
+concurrency ceiling: past it more clients only add latency) is reported at the end.
+Results are saved as JSON together with the git commit, so two runs can be
+compared with `--compare`.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from catalog import WORDS, make_books
+
+# IDs of the synthetic catalog start after the sample books of data.py
+FIRST_ID = 1000
+PASSWORD = "bench@123"
+# IDs of the books written by the search_spike scenario
+SPIKE_FIRST_ID = 10 ** 9
+XML = {"Accept": "application/xml"}
+
+
+# Seeding, in the process that hosts the app
+def seed(size: int, users: int) -> None:
+    from credentials import hash_password
+    from data import books_db, users_db
+
+    hashed_password = hash_password(PASSWORD)
+    for i in range(users):
+        users_db.add({"username": f"bench{i}", "full_name": f"Bench User {i}",
+                      "email": f"bench{i}@example.com", "hashed_password": hashed_password})
+    books = make_books(size, first_id=FIRST_ID)
+    while True:
+        batch = list(itertools.islice(books, 50000))
+        if not batch:
+            break
+        books_db.add_many(batch)
+
+
+# Scenarios: one request each, given the request number
+class Context:
+    def __init__(self, size: int, users: int):
+        self.size = size
+        self.users = users
+        self.rng = random.Random(0)
+        self.headers: Dict[str, str] = {}
+        self.etags: Dict[int, str] = {}
+        # books created by the write scenarios, after the catalog
+        self.new_id = FIRST_ID + size
+
+    def book_id(self) -> int:
+        return self.rng.randrange(FIRST_ID, FIRST_ID + self.size)
+
+    def word(self) -> str:
+        return self.rng.choice(WORDS)
+
+    def new_book(self, book_id: int) -> dict:
+        return {"id": book_id, "title": f"Bench {self.word()} {book_id}", "description": "Written under load",
+                "author": "bench0", "cover_image": None, "price": 9.99, "published": True}
+
+
+async def login_logout(client: httpx.AsyncClient, ctx: Context, i: int) -> httpx.Response:
+    # bench0 is the writer; the others take turns logging in and out
+    username = f"bench{1 + i % (ctx.users - 1)}"
+    response = await client.post("/login", auth=(username, PASSWORD))
+    if response.status_code == 200:
+        await client.post("/logout", headers={"Authorization": f"Bearer {response.json()['access_token']}"})
+    return response
+
+
+async def conditional_get_book(client: httpx.AsyncClient, ctx: Context, i: int) -> httpx.Response:
+    # a client polling books it already has
+    book_id = FIRST_ID + i % min(ctx.size, 100)
+    if book_id not in ctx.etags:
+        ctx.etags[book_id] = (await client.get(f"/books/{book_id}")).headers["etag"]
+    return await client.get(f"/books/{book_id}", headers={"If-None-Match": ctx.etags[book_id]})
+
+
+async def search_spike(client: httpx.AsyncClient, ctx: Context, i: int) -> httpx.Response:
+    # every client searches the same popular word; a write every 100 requests makes the
+    # cached result stale, so the next searches all miss at once
+    if i % 100 == 0:
+        return await client.post("/books", json=ctx.new_book(SPIKE_FIRST_ID + i), headers=ctx.headers)
+    return await client.get(f"/books?query={WORDS[0]}&limit=20")
+
+
+SCENARIOS: Dict[str, Callable[[httpx.AsyncClient, Context, int], Awaitable[httpx.Response]]] = {
+    "home": lambda client, ctx, i: client.get("/"),
+    "get_book": lambda client, ctx, i: client.get(f"/books/{ctx.book_id()}"),
+    "get_book_xml": lambda client, ctx, i: client.get(f"/books/{ctx.book_id()}", headers=XML),
+    "get_book_304": conditional_get_book,
+    "list": lambda client, ctx, i: client.get(f"/books?limit=100&cursor={ctx.book_id()}"),
+    "list_xml": lambda client, ctx, i: client.get(f"/books?limit=100&cursor={ctx.book_id()}", headers=XML),
+    "search": lambda client, ctx, i: client.get(f"/books?query={ctx.word()}&limit=20"),
+    "search_xml": lambda client, ctx, i: client.get(f"/books?query={ctx.word()}&limit=20", headers=XML),
+    "search_spike": search_spike,
+    "login_logout": login_logout,
+    "create": lambda client, ctx, i: client.post("/books", json=ctx.new_book(ctx.new_id + i),
+                                                 headers=ctx.headers),
+    "update": lambda client, ctx, i: client.put(f"/books/{ctx.new_id + i}", json=ctx.new_book(ctx.new_id + i),
+                                                headers=ctx.headers),
+    "delete": lambda client, ctx, i: client.delete(f"/books/{ctx.new_id + i}", headers=ctx.headers),
+    "bulk_create": lambda client, ctx, i: client.post(
+        "/books/bulk", headers=ctx.headers,
+        json=[ctx.new_book(ctx.new_id + ctx.size + i * 100 + j) for j in range(100)]),
+}
+# update and delete work on the books made by create, so the three run in this order
+DEFAULT_SCENARIOS = list(SCENARIOS)
+EXPECTED = {"get_book_304": {304}, "create": {201}, "bulk_create": {201}, "search_spike": {200, 201}}
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_scenario(client: httpx.AsyncClient, ctx: Context, name: str, requests: int,
+                       concurrency: int) -> dict:
+    op = SCENARIOS[name]
+    if name == "bulk_create":
+        requests = max(requests // 100, 1)
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    counter = itertools.count()
+
+    async def worker():
+        for i in counter:
+            if i >= requests:
+                return
+            start = time.perf_counter()
+            response = await op(client, ctx, i)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    expected = EXPECTED.get(name, {200})
+    return {
+        "scenario": name,
+        "requests": requests,
+        "errors": sum(count for code, count in statuses.items() if code not in expected),
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "req/s": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+async def drive(client: httpx.AsyncClient, args: argparse.Namespace) -> List[dict]:
+    ctx = Context(args.size, args.users)
+    response = await client.post("/login", auth=("bench0", PASSWORD))
+    ctx.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    results = []
+    for name in args.scenarios.split(","):
+        results.append(await run_scenario(client, ctx, name, args.requests, args.concurrency))
+    return results
+
+
+def peak_rss_mb(pid: Optional[int] = None) -> Optional[float]:
+    """
+    Peak resident set size of a process (this one by default), from /proc on Linux.
+    """
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if pid is None:
+        try:
+            import resource
+            return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        except ImportError:
+            pass
+    return None
+
+
+# Child processes
+def child_inprocess(args: argparse.Namespace) -> None:
+    seed(args.size, args.users)
+    from build import app
+
+    async def run():
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench",
+                                     limits=limits, timeout=None) as client:
+            return await drive(client, args)
+
+    results = asyncio.run(run())
+    # the client shares the process, so this includes its (small) footprint
+    print(json.dumps({"results": results, "peak_rss_mb": peak_rss_mb()}))
+
+
+def child_serve(args: argparse.Namespace) -> None:
+    import uvicorn
+
+    seed(args.size, args.users)
+    from build import app
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+
+# Orchestration
+def child_command(args: argparse.Namespace, role: str, size: int, port: int = 0) -> List[str]:
+    return [sys.executable, os.path.abspath(__file__), "--child", role, "--size", str(size),
+            "--users", str(args.users), "--requests", str(args.requests),
+            "--concurrency", str(args.concurrency), "--scenarios", args.scenarios, "--port", str(port)]
+
+
+def run_inprocess(args: argparse.Namespace, size: int, env: dict) -> dict:
+    output = subprocess.run(child_command(args, "inprocess", size), env=env, check=True,
+                            stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run_loopback(args: argparse.Namespace, size: int, env: dict) -> dict:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen(child_command(args, "serve", size, port), env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        # seeding a large catalog takes a while
+        deadline = time.monotonic() + 1800
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("the server exited during startup")
+            try:
+                httpx.get(base_url + "/")
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+
+        async def run():
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+                sub_args = argparse.Namespace(**{**vars(args), "size": size})
+                return await drive(client, sub_args)
+
+        results = asyncio.run(run())
+        return {"results": results, "peak_rss_mb": peak_rss_mb(server.pid)}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(runs: List[dict], baseline_path: str) -> None:
+    """
+    Prints the req/s and p99 ratio of every scenario against a saved run.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    # runs saved before concurrency sweeps have one level for the whole report
+    before = {(run["mode"], run["size"], run.get("concurrency", baseline.get("concurrency")), result["scenario"]):
+              result for run in baseline["runs"] for result in run["results"]}
+    print(f"\ncompared with {baseline.get('commit')} ({baseline_path})")
+    for run in runs:
+        for result in run["results"]:
+            old = before.get((run["mode"], run["size"], run["concurrency"], result["scenario"]))
+            if old:
+                print(f"{run['mode']:<10} {run['size']:>8} {run['concurrency']:>5} {result['scenario']:<14} "
+                      f"req/s x{result['req/s'] / old['req/s']:.2f}  p99 x{result['p99_ms'] / old['p99_ms']:.2f}")
+
+
+def ceilings(runs: List[dict]) -> Dict[tuple, dict]:
+    """
+    The concurrency level with the highest req/s of every mode, size and scenario,
+    and that req/s.
+    """
+    best: Dict[tuple, dict] = {}
+    for run in runs:
+        for result in run["results"]:
+            key = (run["mode"], run["size"], result["scenario"])
+            if key not in best or result["req/s"] > best[key]["req/s"]:
+                best[key] = {"concurrency": run["concurrency"], "req/s": result["req/s"]}
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,100000", help="comma separated catalog sizes")
+    parser.add_argument("--modes", default="inprocess,loopback", help="inprocess, loopback or both")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", default="16",
+                        help="concurrent clients, or comma separated levels to sweep, e.g. 1,16,64,256")
+    parser.add_argument("--users", type=int, default=100, help="extra users to seed")
+    parser.add_argument("--backend", default="memory", help="storage and session backend: memory or sqlite")
+    parser.add_argument("--scenarios", default=",".join(DEFAULT_SCENARIOS),
+                        help=f"comma separated scenarios out of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="a previous --output file to compare against")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(",")]
+    # every login goes to a different user, and one more user writes
+    args.users = max(args.users, 2 * max(levels) + 1)
+
+    if args.child:
+        args.concurrency = levels[0]
+    if args.child == "inprocess":
+        return child_inprocess(args)
+    if args.child == "serve":
+        return child_serve(args)
+
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in (int(size) for size in args.sizes.split(",")):
+            for mode in args.modes.split(","):
+                for concurrency in levels:
+                    path = os.path.join(directory, f"bench-{mode}-{size}-{concurrency}.db")
+                    env = {**os.environ, "SECRET_KEY": os.environ.get("SECRET_KEY", "bench"),
+                           "STORAGE_BACKEND": args.backend, "SESSION_BACKEND": args.backend, "SQLITE_PATH": path}
+                    level_args = argparse.Namespace(**{**vars(args), "concurrency": concurrency})
+                    run = (run_inprocess if mode == "inprocess" else run_loopback)(level_args, size, env)
+                    run = {"mode": mode, "size": size, "concurrency": concurrency, **run}
+                    runs.append(run)
+                    print(f"\n{mode}, {size:,} books, {concurrency} clients, peak RSS {run['peak_rss_mb']} MB")
+                    for result in run["results"]:
+                        print(f"  {result['scenario']:<14} {result['req/s']:>9,.0f} req/s  "
+                              f"p50 {result['p50_ms']:>8.2f}  p95 {result['p95_ms']:>8.2f}  "
+                              f"p99 {result['p99_ms']:>8.2f} ms  errors {result['errors']}", flush=True)
+
+    peaks = ceilings(runs)
+    if len(levels) > 1:
+        print("\nconcurrency ceiling (clients at peak req/s)")
+        for (mode, size, scenario), peak in peaks.items():
+            print(f"  {mode:<10} {size:>8} {scenario:<14} {peak['concurrency']:>5} clients "
+                  f"{peak['req/s']:>9,.0f} req/s")
+
+    report = {"commit": git_commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              "python": sys.version.split()[0], "backend": args.backend,
+              "concurrency": levels, "requests": args.requests, "runs": runs,
+              "ceilings": [{"mode": mode, "size": size, "scenario": scenario, **peak}
+                           for (mode, size, scenario), peak in peaks.items()]}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(runs, args.compare)
+
+
+if __name__ == "__main__":
+    main()
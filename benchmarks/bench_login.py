@@ -0,0 +1,64 @@
+"""
+Login throughput benchmark.
+
+Compares logins/sec for the previous scheme (hash the stored password, then verify
+against it), a plain verify against the pre-computed hash, and a verified-credential
+cache hit.
+
+    python benchmarks/bench_login.py [--seconds 2] [--rounds 29000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+
+def measure(fn, seconds: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        fn()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=2.0, help="time spent on each scenario")
+    parser.add_argument("--rounds", type=int, help="PBKDF2 rounds (defaults to PBKDF2_ROUNDS)")
+    args = parser.parse_args()
+    if args.rounds:
+        os.environ["PBKDF2_ROUNDS"] = str(args.rounds)
+
+    from credentials import CredentialCache, get_hasher, hash_password, verify_password
+
+    username, password = "wookie1", "wookie1@123"
+    hashed_password = hash_password(password)
+    cache = CredentialCache(maxsize=1024, ttl=300)
+    cache.add(username, password, hashed_password)
+    hasher = get_hasher()
+
+    def rehash_and_verify():
+        hasher.verify(password, hasher.hash(password))
+
+    def verify_precomputed():
+        verify_password(password, hashed_password)
+
+    def cache_hit():
+        assert cache.check(username, password, hashed_password)
+
+    print(f"pbkdf2_sha256 rounds: {hasher.default_rounds}")
+    baseline = None
+    for name, fn in (("hash + verify (before)", rehash_and_verify),
+                     ("verify pre-computed hash", verify_precomputed),
+                     ("credential cache hit", cache_hit)):
+        rate = measure(fn, args.seconds)
+        baseline = baseline or rate
+        print(f"{name:<28} {rate:>12,.0f} logins/s  {rate / baseline:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
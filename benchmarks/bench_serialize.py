@@ -0,0 +1,87 @@
+"""
+Response serialization benchmark.
+
+Encodes a page of books the way list responses used to be encoded (jsonable_encoder
+then json.dumps, or the XML writer walking every record) and the way they are now
+(orjson when installed, and per-book blobs joined from the blob cache), and reports
+the CPU time per book.
+
+    python benchmarks/bench_serialize.py [--page 1000] [--repeat 50]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from catalog import make_books
+
+
+def per_book_us(fn, books: int, repeat: int) -> float:
+    fn()
+    start = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - start) / repeat / books * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page", type=int, default=1000, help="books per response")
+    parser.add_argument("--repeat", type=int, default=50, help="responses encoded per measurement")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    import json
+    from fastapi.encoders import jsonable_encoder
+    import encoding
+    import xmlstream
+    from encoding import JSON, XML, BookList, blob_cache, render
+
+    books = list(make_books(args.page))
+    content = {"books": books, "next_cursor": None}
+    fast_content = {"books": BookList(books), "next_cursor": None}
+    orjson = encoding.orjson
+
+    def fastapi_json():
+        json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None,
+                   separators=(",", ":")).encode("utf-8")
+
+    def without_orjson(fn):
+        def run():
+            encoding.orjson = None
+            try:
+                fn()
+            finally:
+                encoding.orjson = orjson
+        return run
+
+    def cold_blobs(fmt):
+        def run():
+            blob_cache.clear()
+            render(fast_content, fmt)
+        return run
+
+    # with orjson installed, JSON lists skip the blobs: encoding whole records is faster
+    scenarios = [
+        ("json: jsonable_encoder + json (before)", fastapi_json),
+        ("json: json.dumps", without_orjson(lambda: render(content, JSON))),
+        ("json: json.dumps, blobs, cold cache", without_orjson(cold_blobs(JSON))),
+        ("json: json.dumps, blobs, warm cache", without_orjson(lambda: render(fast_content, JSON))),
+        ("json: orjson" if orjson else "json: orjson (not installed)", lambda: render(fast_content, JSON)),
+        ("xml: walk every record (before)", lambda: xmlstream.to_xml(content)),
+        ("xml: blobs, cold cache", cold_blobs(XML)),
+        ("xml: blobs, warm cache", lambda: render(fast_content, XML)),
+    ]
+    print(f"{args.page} books per response, CPU time per book")
+    baseline = {}
+    for name, fn in scenarios:
+        us = per_book_us(fn, args.page, args.repeat)
+        fmt = name.split(":")[0]
+        baseline.setdefault(fmt, us)
+        print(f"{name:<42} {us:>8.2f} us/book  {baseline[fmt] / us:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
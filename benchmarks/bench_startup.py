@@ -0,0 +1,148 @@
+"""
+Startup benchmark.
+
+Measures, in fresh processes, how long importing the app takes and how many modules
+it loads, then the latency of the first and second request of a few kinds (JSON,
+XML, login), which pay for whatever was deferred to first use. Requests go straight
+to the ASGI app, so no HTTP client is loaded in the measured process. The `serve`
+measurement starts `src/serve.py` and times it until it answers over loopback.
+Medians of `--runs` runs are reported.
+
+    python benchmarks/bench_startup.py [--runs 10] [--workers 1,4] [--output results.json]
+"""
+import argparse
+import asyncio
+import base64
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+def basic(username: str) -> List[Tuple[bytes, bytes]]:
+    return [(b"authorization", b"Basic " + base64.b64encode(f"{username}:{username}@123".encode()))]
+
+
+# name, method, path, headers of the first and second request (a user can't log in twice)
+FIRST_REQUESTS = [
+    ("GET /books", "GET", "/books", [[], []]),
+    ("GET /books xml", "GET", "/books", [[(b"accept", b"application/xml")]] * 2),
+    ("POST /login", "POST", "/login", [basic("wookie1"), basic("wookie2")]),
+]
+
+
+async def asgi_request(app, method: str, path: str, headers: List[Tuple[bytes, bytes]]) -> int:
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+             "headers": [(b"host", b"bench")] + headers, "client": ("127.0.0.1", 1), "server": ("bench", 80)}
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+# Child process
+def child_inprocess() -> None:
+    sys.path.append(SRC)
+    modules = len(sys.modules)
+    start = time.perf_counter()
+    from build import app
+    results = {"import_ms": (time.perf_counter() - start) * 1000, "import_modules": len(sys.modules) - modules}
+
+    async def run():
+        for name, method, path, attempts in FIRST_REQUESTS:
+            modules = len(sys.modules)
+            for attempt, headers in zip(("first", "second"), attempts):
+                start = time.perf_counter()
+                status = await asgi_request(app, method, path, headers)
+                results[f"{name} {attempt}_ms"] = (time.perf_counter() - start) * 1000
+                assert status == 200, (name, status)
+            results[f"{name} modules"] = len(sys.modules) - modules
+
+    asyncio.run(run())
+    print(json.dumps(results))
+
+
+# Orchestration
+def run_inprocess(env: dict) -> dict:
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], env=env, check=True,
+                            stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run_serve(env: dict, workers: int, session_db: str) -> float:
+    if workers > 1:
+        # serve.py refuses several workers with per-process sessions
+        env = {**env, "SESSION_BACKEND": "sqlite", "SESSION_DB_PATH": session_db}
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, os.path.join(SRC, "serve.py")],
+                              env={**env, "PORT": str(port), "WORKERS": str(workers), "RELOAD": "false"},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("the server exited during startup")
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+                connection.request("GET", "/books")
+                if connection.getresponse().status == 200:
+                    return (time.perf_counter() - start) * 1000
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.005)
+            finally:
+                connection.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="fresh processes per measurement")
+    parser.add_argument("--workers", default="1", help="comma separated worker counts for the serve measurement "
+                                                        "(empty skips it)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child_inprocess()
+
+    env = {**os.environ, "SECRET_KEY": os.environ.get("SECRET_KEY", "bench")}
+    runs = [run_inprocess(env) for _ in range(args.runs)]
+    results = {key: round(statistics.median(run[key] for run in runs), 2) for key in runs[0]}
+    with tempfile.TemporaryDirectory() as directory:
+        session_db = os.path.join(directory, "sessions.db")
+        for workers in filter(None, args.workers.split(",")):
+            results[f"serve@{workers} ready_ms"] = round(statistics.median(
+                run_serve(env, int(workers), session_db) for _ in range(args.runs)), 1)
+    width = max(map(len, results))
+    for key, value in results.items():
+        print(f"{key:<{width}}  {value:,}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
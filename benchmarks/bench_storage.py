@@ -0,0 +1,171 @@
+"""
+Storage backend benchmark.
+
+Loads a synthetic catalog into the in-memory store, the compact (columnar) store,
+a memory-mapped catalog file and the SQLite store, then measures the time to open
+it, the Python heap held per book, lookups, pages, searches, filtered listings and
+writes on each. With `--workers N` (Linux only), N processes open the store at once
+and read every book, and the memory private to each and their proportional share of
+shared memory (PSS) are reported, as for N uvicorn workers.
+
+    python benchmarks/bench_storage.py [--sizes 10000,100000,1000000] [--ops 2000]
+                                       [--backends memory,compact,mapped,sqlite] [--workers 2]
+                                       [--output results.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from catalog import make_books
+from store import BookStore
+from compact_store import CompactBookStore
+from mapped_store import MappedBookStore, export_catalog
+from sqlite_store import SQLiteBookStore, SQLiteDatabase
+
+QUERIES = ["star", "wookie", "dark saber", "author12", "zz"]
+
+# Filtered listings: one author, a narrow and a wide price range, unpublished books
+# sorted by title, and the most expensive books
+FILTERS = [
+    {"author": "author12", "sort": "price"},
+    {"price_min": 50.0, "price_max": 50.5},
+    {"price_min": 10.0, "price_max": 90.0, "published": True},
+    {"published": False, "sort": "title"},
+    {"sort": "price", "descending": True},
+]
+
+
+def open_store(backend: str, size: int, directory: str):
+    books = make_books(size)
+    if backend == "memory":
+        return BookStore(books)
+    if backend == "compact":
+        return CompactBookStore(books)
+    if backend == "mapped":
+        path = os.path.join(directory, f"catalog-{size}.bin")
+        if not os.path.exists(path):
+            export_catalog(CompactBookStore(books), path)
+        return MappedBookStore(path)
+    return SQLiteBookStore(SQLiteDatabase(os.path.join(directory, f"books-{size}.db")), seed=books)
+
+
+def heap_size(backend: str, size: int, directory: str) -> int:
+    """
+    Returns the Python heap held by a second, freshly loaded in-memory store. The
+    catalog is generated inside the trace, so the records the store keeps count.
+    """
+    tracemalloc.start()
+    store = open_store(backend, size, directory)
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del store
+    return heap
+
+
+def smaps_rollup() -> dict:
+    with open("/proc/self/smaps_rollup") as f:
+        fields = (line.split() for line in f if line.endswith("kB\n"))
+        return {fields[0].rstrip(":"): int(fields[1]) * 1024 for fields in fields}
+
+
+def worker(backend: str, size: int, directory: str, barrier, results) -> None:
+    store = open_store(backend, size, directory)
+    for _ in store:
+        pass
+    # measured once every worker holds the store, so shared pages are split between them
+    barrier.wait()
+    memory = smaps_rollup()
+    results.put((memory["Private_Clean"] + memory["Private_Dirty"], memory["Pss"]))
+    barrier.wait()
+
+
+def worker_memory(backend: str, size: int, directory: str, workers: int) -> dict:
+    """
+    Starts `workers` fresh processes that each open the store and read every book,
+    and returns the average memory private to one of them and its PSS.
+    """
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(backend, size, directory, barrier, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    measured = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return {"private_mb/worker": round(sum(private for private, _ in measured) / workers / 1e6, 1),
+            "pss_mb/worker": round(sum(pss for _, pss in measured) / workers / 1e6, 1)}
+
+
+def rate(fn, ops: int) -> float:
+    start = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return ops / (time.perf_counter() - start)
+
+
+def run(backend: str, size: int, ops: int, directory: str, workers: int) -> dict:
+    rng = random.Random(0)
+    if backend == "mapped":
+        # export the catalog first, so load_s is the time to open it
+        open_store(backend, size, directory)
+    start = time.perf_counter()
+    store = open_store(backend, size, directory)
+    load = time.perf_counter() - start
+
+    ids = [rng.randint(1, size) for _ in range(ops)]
+    results = {"backend": backend, "size": size, "load_s": round(load, 3)}
+    if backend != "sqlite":
+        results["heap_bytes/book"] = round(heap_size(backend, size, directory) / size)
+    if backend == "mapped":
+        results["file_bytes/book"] = round(os.path.getsize(os.path.join(directory, f"catalog-{size}.bin")) / size)
+    if workers and backend != "sqlite" and os.path.exists("/proc/self/smaps_rollup"):
+        results.update(worker_memory(backend, size, directory, workers))
+    results["get/s"] = rate(lambda i: store.get(ids[i]), ops)
+    results["page/s"] = rate(lambda i: store.page(ids[i], 100), ops)
+    results["search/s"] = rate(lambda i: store.search(QUERIES[i % len(QUERIES)], limit=100), max(ops // 10, 1))
+    results["find/s"] = rate(lambda i: store.find(**FILTERS[i % len(FILTERS)], limit=100), max(ops // 10, 1))
+
+    def write(i):
+        book_id = size + 1 + i
+        book = {**store.get(ids[i]), "id": book_id}
+        store.add(book)
+        store.replace(book_id, {**book, "title": "Updated"})
+        store.delete(book_id)
+    results["add+replace+delete/s"] = rate(write, ops)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000", help="comma separated catalog sizes")
+    parser.add_argument("--ops", type=int, default=2000, help="operations per measurement")
+    parser.add_argument("--backends", default="memory,compact,mapped,sqlite", help="comma separated backends")
+    parser.add_argument("--workers", type=int, default=2, help="worker processes for the memory measurement (0 to skip)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    all_results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in (int(size) for size in args.sizes.split(",")):
+            for backend in args.backends.split(","):
+                results = run(backend, size, args.ops, directory, args.workers)
+                all_results.append(results)
+                print("  ".join(f"{key}={value:,.0f}" if isinstance(value, float) and key.endswith("/s")
+                                else f"{key}={value}" for key, value in results.items()), flush=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
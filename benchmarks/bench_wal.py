@@ -0,0 +1,120 @@
+"""
+Write-ahead log benchmark.
+
+Loads a synthetic catalog into a durable in-memory store (memory or compact), then
+measures committed writes/sec with concurrent writers and the number of fsyncs
+they shared, the time and size of a snapshot, the time to load the snapshot alone and to come
+back after a restart (snapshot load plus replay of `--tail` logged writes),
+compared to building the store from the records as when the app starts without a
+log.
+
+    python benchmarks/bench_wal.py [--sizes 100000,1000000] [--backends memory,compact]
+                                   [--writers 1,16,64] [--writes 2000] [--tail 10000]
+                                   [--output results.json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from catalog import make_books
+from store import BookStore
+from compact_store import CompactBookStore
+from snapshots import read_snapshot
+from wal import DurableBookStore
+
+STORES = {"memory": BookStore, "compact": CompactBookStore}
+
+
+def committed_writes(store: DurableBookStore, writers: int, writes: int, first_id: int) -> dict:
+    """
+    `writers` threads add `writes` books between them, each waiting for its commit.
+    """
+    commits = store.journal.log.commits
+    per_writer = max(writes // writers, 1)
+
+    def writer(n: int) -> None:
+        for i in range(per_writer):
+            book_id = first_id + n * per_writer + i
+            store.add({"id": book_id, "title": f"Book {book_id}", "description": "Written by the benchmark",
+                       "author": "bench", "cover_image": None, "price": 9.99, "published": True})
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    total = per_writer * writers
+    return {"writes/s": total / elapsed, "writes/fsync": round(total / (store.journal.log.commits - commits), 1)}
+
+
+def run(backend: str, size: int, writer_counts: list, writes: int, tail: int, directory: str) -> dict:
+    store_class = STORES[backend]
+    books = list(make_books(size))
+    start = time.perf_counter()
+    store_class(books)
+    results = {"backend": backend, "size": size, "build_s": round(time.perf_counter() - start, 3)}
+
+    path = os.path.join(directory, f"{backend}-{size}")
+    store = DurableBookStore(path, store_class, seed=books, snapshot_every=1 << 62)
+    first_id = size + 1
+    for writers in writer_counts:
+        measured = committed_writes(store, writers, writes, first_id)
+        first_id += writes
+        results[f"writes/s@{writers}"] = measured["writes/s"]
+        results[f"writes/fsync@{writers}"] = measured["writes/fsync"]
+
+    start = time.perf_counter()
+    store.journal.checkpoint()
+    results["snapshot_s"] = round(time.perf_counter() - start, 3)
+    results["snapshot_mb"] = round(os.path.getsize(os.path.join(path, "snapshot")) / 1e6, 1)
+    # a log tail to replay after the snapshot
+    for i in range(tail):
+        store.replace(1 + i % size, {**store.get(1 + i % size), "title": f"Retitled {i}"})
+    store.journal.close()
+
+    start = time.perf_counter()
+    with open(os.path.join(path, "snapshot"), "rb") as f:
+        store_class.restore(read_snapshot(f)[1])
+    results["load_s"] = round(time.perf_counter() - start, 3)
+    start = time.perf_counter()
+    restored = DurableBookStore(path, store_class)
+    results["restart_s"] = round(time.perf_counter() - start, 3)
+    assert len(restored) == len(store)
+    restored.journal.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100000", help="comma separated catalog sizes")
+    parser.add_argument("--backends", default="memory,compact", help="comma separated in-memory backends")
+    parser.add_argument("--writers", default="1,16,64", help="comma separated numbers of concurrent writers")
+    parser.add_argument("--writes", type=int, default=2000, help="committed writes per measurement")
+    parser.add_argument("--tail", type=int, default=10000, help="writes logged after the snapshot")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    all_results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in (int(size) for size in args.sizes.split(",")):
+            for backend in args.backends.split(","):
+                results = run(backend, size, [int(n) for n in args.writers.split(",")], args.writes, args.tail,
+                              directory)
+                all_results.append(results)
+                print("  ".join(f"{key}={value:,.0f}" if isinstance(value, float) and key.startswith("writes/s")
+                                else f"{key}={value}" for key, value in results.items()), flush=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""
+Synthetic catalog generator shared by the benchmarks.
+"""
+from typing import Iterator
+import random
+
+WORDS = (
+    "star galaxy journey secret mission empire wookie rebel force droid planet ship "
+    "light dark saber hunter bounty moon desert forest ocean city shadow storm fleet "
+    "legend chronicle guide handbook python history adventure epic tale war peace"
+).split()
+
+
+def make_books(count: int, authors: int = 1000, seed: int = 42, first_id: int = 1) -> Iterator[dict]:
+    """
+    Yields `count` reproducible books with consecutive IDs from `first_id`, spread
+    over `authors` authors (author0 ... authorN) with random titles and descriptions.
+    """
+    rng = random.Random(seed)
+    for book_id in range(first_id, first_id + count):
+        yield {
+            "id": book_id,
+            "title": " ".join(rng.choices(WORDS, k=3)).title(),
+            "description": " ".join(rng.choices(WORDS, k=10)).capitalize(),
+            "author": f"author{rng.randrange(authors)}",
+            "cover_image": "https://loremflickr.com/320/240",
+            "price": round(rng.uniform(1, 100), 2),
+            "published": rng.random() < 0.9,
+        }
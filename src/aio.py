@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+import asyncio
+import functools
+
+from starlette.concurrency import run_in_threadpool
+
+from app_constants import OFFLOAD_MIN_CATALOG
+
+# Repository methods that may touch many records (scans and batches); they are run
+# off the event loop even on in-memory backends, once these hold enough records
+HEAVY_METHODS = frozenset({"search", "find", "add_many", "replace_many", "delete_many", "existing_ids"})
+
+
+async def offload(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Runs CPU-heavy work on the threadpool, so the event loop keeps serving other
+    requests meanwhile.
+    """
+    return await run_in_threadpool(fn, *args, **kwargs)
+
+
+# Awaitable view of a storage backend
+class AsyncRepository:
+    """
+    Exposes every method of a book, user or session repository as a coroutine, for
+    async routes.
+
+    Backends that don't block (the in-memory ones: a lookup is a dict access under a
+    lock) are called inline on the event loop, which is far cheaper than a hop
+    through the threadpool; only their `HEAVY_METHODS` go to the executor, when the
+    repository holds at least `offload_min_size` records. Those then hold the
+    store's lock for a whole scan, so from that size on every other book method
+    taking the lock runs on the threadpool too, to wait for it there rather than on
+    the event loop; only the backend's `lock_free_methods` stay inline. Backends
+    doing I/O (`blocking = True`, e.g. SQLite) run every call on the executor.
+    Methods a backend lists in `blocking_methods` (writes waiting for a write-ahead
+    log commit) run on the threadpool.
+
+    The executor is dedicated and small, `workers` threads (one per pooled SQLite
+    connection): more threads would only queue for a connection or, for Python
+    code holding the GIL, fight the event loop for it. Storage calls never wait
+    behind other work on the threadpool either.
+    """
+
+    def __init__(self, repository: Any, workers: int = 4, offload_min_size: int = OFFLOAD_MIN_CATALOG):
+        self.repository = repository
+        self.blocking = getattr(repository, "blocking", False)
+        self.workers = workers
+        self.offload_min_size = offload_min_size
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # created on first use, so importing the app doesn't start threads
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="storage")
+        return self._executor
+
+    async def _run(self, method: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), functools.partial(method, *args, **kwargs))
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        method = getattr(self.repository, name)
+        if self.blocking:
+            async def call(*args: Any, **kwargs: Any) -> Any:
+                return await self._run(method, *args, **kwargs)
+        elif name in getattr(self.repository, "blocking_methods", ()):
+            # these wait without holding the GIL (e.g. for a log flush), so the
+            # threadpool's many threads let more of them wait together
+            async def call(*args: Any, **kwargs: Any) -> Any:
+                return await offload(method, *args, **kwargs)
+        elif name in HEAVY_METHODS:
+            async def call(*args: Any, **kwargs: Any) -> Any:
+                if len(self.repository) >= self.offload_min_size:
+                    return await self._run(method, *args, **kwargs)
+                return method(*args, **kwargs)
+        elif name in getattr(self.repository, "lock_free_methods", {name}):
+            # repositories without the attribute (users, sessions) have no scans
+            async def call(*args: Any, **kwargs: Any) -> Any:
+                return method(*args, **kwargs)
+        else:
+            # waits for the lock a scan on the executor may be holding
+            async def call(*args: Any, **kwargs: Any) -> Any:
+                if len(self.repository) >= self.offload_min_size:
+                    return await offload(method, *args, **kwargs)
+                return method(*args, **kwargs)
+        # bound once per name
+        setattr(self, name, call)
+        return call
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -1,12 +1,157 @@
-from dotenv import load_dotenv
 import os
 
-# Load environment variables from .env file
-load_dotenv()
+
+# Function to find the .env file the way python-dotenv does, in this directory or
+# the closest parent holding one
+def _find_env_file(directory: str) -> str:
+    while True:
+        path = os.path.join(directory, ".env")
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return ""
+        directory = parent
+
+
+# Load environment variables from .env file (dotenv is only imported when there is one)
+ENV_FILE = _find_env_file(os.path.dirname(os.path.abspath(__file__)))
+if ENV_FILE:
+    from dotenv import load_dotenv
+
+    load_dotenv(ENV_FILE)
 
 # JWT token secret
 # Get the value of the SECRET_KEY variable
 SECRET_KEY = os.getenv("SECRET_KEY")
 
 # Algorithm
-ALGORITHM = "HS256"
\ No newline at end of file
+ALGORITHM = "HS256"
+
+# Maximum number of ranked results returned by a search
+SEARCH_RESULT_LIMIT = int(os.getenv("SEARCH_RESULT_LIMIT", "100"))
+
+# Default and maximum number of books per page when listing books
+BOOKS_PAGE_SIZE = int(os.getenv("BOOKS_PAGE_SIZE", "100"))
+BOOKS_MAX_PAGE_SIZE = int(os.getenv("BOOKS_MAX_PAGE_SIZE", "1000"))
+
+# PBKDF2 rounds used when hashing passwords. Stored hashes with a different
+# cost are transparently re-hashed on the next successful login.
+PBKDF2_ROUNDS = int(os.getenv("PBKDF2_ROUNDS", "29000"))
+
+# Verified-credential cache: maximum entries and time-to-live in seconds
+CREDENTIAL_CACHE_SIZE = int(os.getenv("CREDENTIAL_CACHE_SIZE", "1024"))
+CREDENTIAL_CACHE_TTL = float(os.getenv("CREDENTIAL_CACHE_TTL", "300"))
+
+# Executor used for password hashing work: "thread" or "process"
+KDF_EXECUTOR = os.getenv("KDF_EXECUTOR", "thread")
+# Number of hashing workers
+KDF_WORKERS = int(os.getenv("KDF_WORKERS", str(os.cpu_count() or 1)))
+# Maximum hashing jobs running or queued before logins are rejected with 503
+KDF_MAX_PENDING = int(os.getenv("KDF_MAX_PENDING", str(4 * KDF_WORKERS)))
+# Retry-After (seconds) sent with those 503 responses
+KDF_RETRY_AFTER = int(os.getenv("KDF_RETRY_AFTER", "1"))
+
+# Times an update or delete without If-Match is retried when another write to the
+# same book lands between reading and writing it, before answering 409
+WRITE_CONFLICT_RETRIES = int(os.getenv("WRITE_CONFLICT_RETRIES", "10"))
+
+# Access token lifetime in minutes
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+
+# Decoded access token cache: maximum entries, and lifetime (seconds) of
+# entries for tokens without an `exp` claim
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+
+# Storage backend for books and users: "memory", "compact" (in memory, columnar
+# book storage), "mapped" (memory-mapped catalog file) or "sqlite"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "memory")
+# SQLite database file and connection pool size (sqlite backend only)
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bookstore.db")
+# Catalog file of the mapped backend, written with the sample books if missing
+CATALOG_PATH = os.getenv("CATALOG_PATH", "catalog.bin")
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "4"))
+
+# Where login sessions are kept: "memory" (single worker only) or "sqlite",
+# which shares them between worker processes through SESSION_DB_PATH
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", SQLITE_PATH)
+# How long (seconds) a worker may answer session checks from its local cache
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "1"))
+
+# Maximum number of items in one bulk request
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "100000"))
+
+# Encoded book responses kept for conditional GETs: entry count and total size (bytes)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Record per-route and per-stage latencies and serve them at /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Profiling: fraction of requests to profile (0 disables sampling), the secret that
+# signs X-Profile debug headers, where profiles are written, how often stacks are sampled
+# and how many profiles of a route each worker keeps as they are before merging the oldest
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SECRET = os.getenv("PROFILE_SECRET") or None
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "100"))
+
+# Users allowed to use the admin endpoints (comma separated usernames)
+ADMIN_USERS = {name.strip() for name in os.getenv("ADMIN_USERS", "").split(",") if name.strip()}
+
+# Number of encoded books (JSON and XML counted separately) kept for list responses
+BLOB_CACHE_SIZE = int(os.getenv("BLOB_CACHE_SIZE", "200000"))
+
+# Rate limits, as `<METHOD> <path>=<requests>/<seconds>` token bucket budgets separated
+# by `;` (the path is a route template, `*` matches any method or path), e.g.
+# "POST /login=10/60; * *=100/1". RATE_LIMITS apply to each client (its username with
+# a valid access token, otherwise its IP), GLOBAL_RATE_LIMITS to all clients together.
+# Both empty (the default) disables rate limiting
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+GLOBAL_RATE_LIMITS = os.getenv("GLOBAL_RATE_LIMITS", "")
+# Where buckets are kept: "memory" (per worker process) or "sqlite", which shares
+# them between worker processes through RATE_LIMIT_DB_PATH
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", SQLITE_PATH)
+# Maximum number of buckets a worker keeps in memory
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+# Response compression: content codings offered, in order of preference (br and zstd
+# are only offered when the brotli and zstandard packages are installed; empty
+# disables compression), the smallest body worth compressing (bytes), and the level
+# of each coding
+COMPRESSION_ENCODINGS = os.getenv("COMPRESSION_ENCODINGS", "br,zstd,gzip")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_LEVEL = int(os.getenv("BROTLI_LEVEL", "4"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+
+# CPU-heavy work done by async routes runs on the threadpool past these sizes, so the
+# event loop keeps serving other requests (below them the hop costs more than the
+# work): searches and other scans of in-memory catalogs of at least OFFLOAD_MIN_CATALOG
+# books, rendering responses holding at least OFFLOAD_MIN_BOOKS books, and
+# compressing bodies of at least OFFLOAD_MIN_BYTES bytes
+OFFLOAD_MIN_CATALOG = int(os.getenv("OFFLOAD_MIN_CATALOG", "5000"))
+OFFLOAD_MIN_BOOKS = int(os.getenv("OFFLOAD_MIN_BOOKS", "200"))
+OFFLOAD_MIN_BYTES = int(os.getenv("OFFLOAD_MIN_BYTES", str(256 * 1024)))
+
+# Write-ahead log of the in-memory backends (memory and compact): the directory
+# holding the log and the snapshots (empty, the default, keeps no log, so data is
+# lost on restart), whether commits are fsynced, how long (seconds) the log waits
+# for more writes to share an fsync, and the number of logged writes after which a
+# snapshot is taken
+WAL_DIR = os.getenv("WAL_DIR", "")
+WAL_FSYNC = os.getenv("WAL_FSYNC", "true").lower() in ("1", "true", "yes")
+WAL_COMMIT_DELAY = float(os.getenv("WAL_COMMIT_DELAY", "0"))
+WAL_SNAPSHOT_EVERY = int(os.getenv("WAL_SNAPSHOT_EVERY", "100000"))
+
+# Production server started by `python src/build.py`: address, port, number of
+# worker processes (each loads the app and its own in-memory stores), and whether
+# the development reloader watches the sources (single worker only)
+HOST = os.getenv("HOST", "127.0.0.1")
+PORT = int(os.getenv("PORT", "8000"))
+WORKERS = int(os.getenv("WORKERS", "1"))
+RELOAD = os.getenv("RELOAD", "false").lower() in ("1", "true", "yes")
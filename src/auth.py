@@ -1,75 +1,113 @@
 from typing import Any, List, Optional, Dict, Union
 from fastapi import FastAPI, HTTPException, Header, status, Depends, Request
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from passlib.hash import pbkdf2_sha256
-import jwt
-from jwt.exceptions import InvalidSignatureError, DecodeError
+from datetime import datetime, timedelta, timezone
 
-from data import users_db, books_db
+from data import async_users_db, users_db, books_db
 from models import User, Book
-from app_constants import SECRET_KEY, ALGORITHM
+from app_constants import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, ADMIN_USERS
+from credentials import credential_cache, hash_password, needs_rehash, verify_password
+from kdf_pool import kdf_pool
+from metrics import timed
+from token_cache import token_cache
+
+# PyJWT is imported by the functions using it, on the first login or token check,
+# so importing the app doesn't load it (nor passlib, see `get_hasher`)
 
 # Security
 security = HTTPBasic()
 
-# Function to verify password hash
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """
-    Verify that the plain text password matches the hashed password.
-    Returns:
-        bool: True if the plain text password matches the hashed password, False otherwise.
-    """
-    return pbkdf2_sha256.verify(plain_password, hashed_password)
-
-
 # Function to authenticate user
-def authenticate_user(username: str, password: str) -> Optional[User]:
+async def authenticate_user(username: str, password: str) -> Optional[User]:
     """
     Authenticates a user by checking if the username exists in the users database,
-    and if the provided password matches the hashed password for the user.
+    and if the provided password matches the stored password hash for the user.
+    Credentials verified recently are answered from the credential cache; otherwise
+    the key derivation runs on the KDF pool, and the user is read through the async
+    repository, so nothing here blocks the event loop.
     Returns:
         Optional[User]: The User object if authentication is successful, None otherwise.
+    Raises:
+        PoolSaturated: If the KDF pool has too much work queued already.
     """
-    if username not in users_db:
+    user = await async_users_db.get(username)
+    if user is None:
         return None
 
-    user = users_db[username]
-    hashed_password = pbkdf2_sha256.hash(user["password"])
-    if verify_password(password, hashed_password):
+    hashed_password = user["hashed_password"]
+    if credential_cache.check(username, password, hashed_password):
         return user
-    else:
+    with timed("kdf"):
+        verified = await kdf_pool.run(verify_password, password, hashed_password)
+    if not verified:
         return None
 
+    # upgrade hashes created with a different cost
+    if needs_rehash(hashed_password):
+        hashed_password = await kdf_pool.run(hash_password, password)
+        user = await async_users_db.update(username, hashed_password=hashed_password)
+    credential_cache.add(username, password, hashed_password)
+    return user
+
 
 # Function to create access token
-def create_access_token(data: dict):
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """
     Create an access token using the provided user data, secret key, and algorithm.
+    The token expires after `expires_delta` (ACCESS_TOKEN_EXPIRE_MINUTES by default).
     """
-    encoded_jwt = jwt.encode(data, SECRET_KEY, algorithm=ALGORITHM)
+    import jwt
+
+    expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    encoded_jwt = jwt.encode({**data, "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
 # returns user if found in DB or else none
 def get_user(username: str) -> Optional[User]:
     
-    if username not in users_db:
-        return None
-    return users_db[username]
+    return users_db.get(username)
+
+
+# Dependency to get the raw bearer token
+async def get_bearer_token(authorization: str = Header(...)) -> str:
+    """
+    Extract the token from an `Authorization: Bearer <token>` header.
+    """
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return token.strip()
+
+
+# Function to decode an access token, through the token cache
+def decode_access_token(token: str) -> dict:
+    """
+    Verify and decode an access token. Tokens seen before are served from the token
+    cache, skipping the signature check and claim parsing.
+    Raises:
+        InvalidTokenError: If the token is malformed, expired or badly signed.
+    """
+    payload = token_cache.get(token)
+    if payload is None:
+        import jwt
+
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        token_cache.put(token, payload)
+    return payload
 
 
 # Dependency to get current user
-async def get_current_user(authorization: str = Header(...)) -> Optional[User]:
-    
+async def get_current_user(token: str = Depends(get_bearer_token)) -> Optional[User]:
+    from jwt.exceptions import InvalidTokenError
+
     try:
-        scheme, token = authorization.split()
-        if scheme.lower() != "bearer":
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid authentication scheme",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with timed("auth"):
+            payload = decode_access_token(token)
         username = payload.get("sub")
         if not username:
             raise HTTPException(
@@ -77,16 +115,26 @@ async def get_current_user(authorization: str = Header(...)) -> Optional[User]:
                 detail="Invalid authentication credentials",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-        user = get_user(username)
+        user = await async_users_db.get(username)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="User not found",
             )
         return user
-    except (HTTPException, InvalidSignatureError, DecodeError):
+    except (HTTPException, InvalidTokenError):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
+
+
+# Dependency to get the current user, who must be an admin
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    if current_user["username"] not in ADMIN_USERS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required",
+        )
+    return current_user
@@ -1,61 +1,82 @@
-from typing import List, Optional, Dict
-from fastapi import FastAPI, HTTPException, status, Depends, Request, Response
+from typing import List, Optional, Dict, Tuple, Union
+from fastapi import FastAPI, HTTPException, status, Depends, Request, Response, Query
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.responses import JSONResponse
-from json2xml import json2xml
-import json
+from fastapi.exceptions import RequestValidationError
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
+from aio import offload
+import bulk
+from compression import CompressionMiddleware
 from auth import security
-from auth import authenticate_user, create_access_token, get_current_user, verify_password
-from models import User, Book
-from data import users_db, books_db
+from auth import (authenticate_user, create_access_token, get_admin_user, get_bearer_token, get_current_user,
+                  verify_password)
+from credentials import credential_cache
+from http_cache import (book_tag, cache_headers, cached_response, flights, invalidate_books, is_not_modified,
+                        make_etag, response_cache, revision_matches)
+from kdf_pool import PoolSaturated
+import metrics
+import profiling
+import ratelimit
+from encoding import BookList
+from indexes import book_matches, decode_position, encode_position, sort_key
+from models import User, Book, BookPage, SearchResults
+from store import RevisionConflict
+from negotiation import (NegotiatedResponse, NegotiationMiddleware, current_format, http_exception_handler,
+                         streaming_response, validation_exception_handler)
+from token_cache import token_cache
+from data import async_books_db, async_sessions_db, books_db
+from app_constants import (SEARCH_RESULT_LIMIT, BOOKS_PAGE_SIZE, BOOKS_MAX_PAGE_SIZE, ACCESS_TOKEN_EXPIRE_MINUTES,
+                           METRICS_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_SECRET, RATE_LIMITS, GLOBAL_RATE_LIMITS,
+                           WRITE_CONFLICT_RETRIES)
 
 # FastAPI App instance
-app = FastAPI()
+app = FastAPI(default_response_class=NegotiatedResponse)
 
 # Middleware
-# Middleware to handle Content-Type (xml | json)
-
-async def content_type_middleware(request: Request, call_next):
-    response = await call_next(request)
-    if "application/xml" in request.headers.get("Content-Type", ""):
-        content_type = response.headers.get('content-type')
-        # if response is json, convert it to xml
-        if 'application/json' in content_type:
-            response_body = b""
-
-            async for chunk in response.body_iterator:
-                response_body += chunk
-
-            # json_content = Response(content=response_body, 
-            #                          status_code=response.status_code, 
-            #                          headers=dict(response.headers), 
-            #                          media_type=response.media_type)
-            
-            xml = json2xml.Json2xml(response_body.decode()).to_xml()
-            return Response(content=xml, media_type="application/xml")
-            
-        elif 'text/xml' in content_type:
-            # If the response is already XML, just return it as-is
-            return response
-    return response
-
-app.middleware("http")(content_type_middleware)
+# Middleware to throttle clients with token buckets (innermost, so 429s are rendered in
+# the negotiated format and still counted by the metrics)
+if RATE_LIMITS or GLOBAL_RATE_LIMITS:
+    budgets = ratelimit.parse_budgets(RATE_LIMITS) + ratelimit.parse_budgets(GLOBAL_RATE_LIMITS, shared=True)
+    app.add_middleware(ratelimit.RateLimitMiddleware, budgets=budgets, store=ratelimit.bucket_store(budgets))
+# Middleware to negotiate the response format (xml | json) from the Accept header
+app.add_middleware(NegotiationMiddleware)
+# Middleware to profile a sample of requests, or requests with a signed X-Profile header
+if PROFILE_SAMPLE_RATE > 0 or PROFILE_SECRET:
+    app.add_middleware(profiling.ProfilingMiddleware, sample_rate=PROFILE_SAMPLE_RATE, secret=PROFILE_SECRET)
+# Middleware to compress responses with the content coding negotiated from Accept-Encoding
+app.add_middleware(CompressionMiddleware)
+# Middleware to time every request and count responses by route and status (outermost)
+if METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
+# Errors are rendered in the negotiated format too
+app.add_exception_handler(StarletteHTTPException, http_exception_handler)
+app.add_exception_handler(RequestValidationError, validation_exception_handler)
 
 
 # API endpoints
 # Login
 @app.post("/login")
-def login(credentials: HTTPBasicCredentials = Depends(security)) -> Dict[str, str]:
+async def login(credentials: HTTPBasicCredentials = Depends(security)) -> Dict[str, str]:
     """
     Authenticate a user with HTTP Basic authentication and create an access token.
+    Password hashing runs on the KDF pool, so the event loop and the threadpool stay free.
     :param credentials: The credentials provided by the client.
     :return: A dictionary containing an access token.
+    :raises HTTPException: 503 with Retry-After if the KDF pool is saturated.
     """
     username = credentials.username
     password = credentials.password
 
-    user = authenticate_user(username, password)
+    try:
+        user = await authenticate_user(username, password)
+    except PoolSaturated as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts in progress, please retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -63,21 +84,20 @@ def login(credentials: HTTPBasicCredentials = Depends(security)) -> Dict[str, st
             headers={"WWW-Authenticate": "Basic"},
         )
         
-    if users_db[username]["active"]:
+    if not await async_sessions_db.start(username, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"{username} already Logged In!",
         )
     
     access_token = create_access_token(data={"sub": user["username"]})
-    users_db[username]["active"] = True
     # print("Access Token---> ",access_token,flush=True)
     return {"access_token": access_token}
 
 
 # Logout
 @app.post("/logout")
-def logout(current_user: User = Depends(get_current_user)):
+async def logout(current_user: User = Depends(get_current_user), token: str = Depends(get_bearer_token)):
     """
     Endpoint to invalidate the current access token and log the user out.
     """
@@ -90,13 +110,13 @@ def logout(current_user: User = Depends(get_current_user)):
         )
 
     user = current_user['username']
-    if users_db[user]["active"] == False:
+    if not await async_sessions_db.end(user):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You are not logged in.",
         )
 
-    users_db[user]["active"] = False
+    token_cache.invalidate(token)
     return {"message": "You have been logged out."}
 
 
@@ -110,54 +130,216 @@ async def home() -> dict:
     return {"message": "Welcome to the Bookstore API!"}
 
 
+# Book reads carry an ETag and Last-Modified. The ETag of a book changes with its revision, the
+# ETag of a listing or search with the catalog version; a matching If-None-Match (or a current
+# If-Modified-Since) gets a 304 without the book being loaded, and encoded bodies are cached.
+
+# Metrics in the Prometheus text format
+# Cache hit/miss counts are read from the caches when scraped
+def cache_counts() -> Dict[tuple, int]:
+    counts = {}
+    for name, cache in (("credentials", credential_cache), ("tokens", token_cache), ("responses", response_cache)):
+        counts[(name, "hit")] = cache.hits
+        counts[(name, "miss")] = cache.misses
+    # misses that waited for a concurrent request's result instead of producing their own
+    counts[("responses", "coalesced")] = flights.coalesced
+    return counts
+
+
+metrics.registry.register(metrics.CallbackMetric(
+    "bookstore_cache_requests_total", "Cache lookups, by cache and result.", "counter", ("cache", "result"),
+    cache_counts))
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics() -> Response:
+    """
+    Request latencies by route, stage latencies, response counts by status code and
+    cache hit rates, for Prometheus to scrape.
+    """
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# Admin: profiles recorded by the profiling middleware
+@app.get("/admin/profiles")
+def list_profiles(admin: User = Depends(get_admin_user)) -> dict:
+    """
+    List the profiled routes with their number of profiled requests and samples.
+    """
+    return {"profiles": profiling.profile_store.summary()}
+
+
+@app.get("/admin/profiles/download")
+def download_profiles(route: Optional[str] = None, admin: User = Depends(get_admin_user)) -> Response:
+    """
+    Download the merged profiles of a route (e.g. `GET /books/{book_id}`), or of every
+    route, as collapsed stacks ready for flamegraph.pl or speedscope.
+    :param route: The method and route template, as listed by /admin/profiles.
+    """
+    collapsed = profiling.profile_store.merged(route)
+    if collapsed is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No profiles for this route")
+    return Response(collapsed, media_type="text/plain",
+                    headers={"Content-Disposition": 'attachment; filename="profiles.collapsed"'})
+
+
+@app.delete("/admin/profiles")
+def delete_profiles(admin: User = Depends(get_admin_user)) -> dict:
+    """
+    Delete every saved profile.
+    """
+    return {"message": f"Profiles of {profiling.profile_store.clear()} routes deleted"}
+
+
 # Get a book by Id
-@app.get("/books/{book_id}")
-def get_book_by_id(book_id: int) -> dict:
+@app.get("/books/{book_id}", response_model=Book)
+async def get_book_by_id(book_id: int, request: Request) -> Response:
     """
     Get a book by ID.
     :param book_id: The ID of the book to retrieve.
-    :return: A dictionary containing the book data.
+    :return: The book data, or 304 if the client's copy is current.
     :raises HTTPException: If the book with the given ID is not found.
     """
-    for book in books_db:
-        if book["id"] == book_id:
-            return book
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                        detail="Book not found!")
-
-
-# Searching books by Title or Author (using query parameter)
-# This endpoint provides a robust search functionality for books based on their title or author,
-# A flexible way can be to add GraphQL or provide rich query params based on requirements
-@app.get("/books")
-def get_books_by_search(request: Request):
-    query = None
-    if "query" in request.query_params:
-        query = request.query_params["query"]
+    revision = await async_books_db.revision(book_id)
+    if revision is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Book not found!")
+
+    async def load_book() -> dict:
+        book = await async_books_db.get(book_id)
+        if book is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail="Book not found!")
+        return book
+
+    return await cached_response(request, ("book", book_id), book_tag(book_id), revision,
+                                 load_book, lambda: async_books_db.revision(book_id))
+
+
+# Searching books by Title, Author or Description (using query parameter)
+# This endpoint provides a robust search functionality for books based on their title, author or description,
+# and filters and sorts listings by author, publication status and price from secondary indexes
+@app.get("/books", response_model=Union[BookPage, SearchResults])
+async def get_books_by_search(request: Request,
+                              query: Optional[str] = None,
+                              author: Optional[str] = None,
+                              published: Optional[bool] = None,
+                              price_min: Optional[float] = None,
+                              price_max: Optional[float] = None,
+                              sort: Optional[str] = Query(None, regex="^(id|price|title)$"),
+                              order: str = Query("asc", regex="^(asc|desc)$"),
+                              limit: Optional[int] = Query(None, ge=1, le=BOOKS_MAX_PAGE_SIZE),
+                              cursor: Optional[str] = None,
+                              stream: Optional[str] = Query(None, regex="^(ndjson|json)$")):
+    """
+    List books page by page, or search them by title, author or description.
+    Unpublished books are listed too, unless `published` says otherwise.
+    :param query: Case-insensitive text to look for. Results are ranked, best match first.
+    :param author: Only books by this author.
+    :param published: Only published (`true`) or unpublished (`false`) books.
+    :param price_min: Only books costing at least this much.
+    :param price_max: Only books costing at most this much.
+    :param sort: Order books by `id` (the default for listings), `price` or `title`
+                 (case-insensitive for ASCII letters), ties broken by ID. Search
+                 results keep their ranking unless a sort is given.
+    :param order: `asc` (default) or `desc`.
+    :param limit: Maximum number of books (or search results) to return.
+    :param cursor: The `next_cursor` of the previous page: a book ID when ordering by
+                   ID, an opaque string otherwise.
+    :param stream: Stream every book after `cursor` instead of a single page, either
+                   as NDJSON (`ndjson`) or as one chunked JSON document (`json`).
+    :return: A dictionary containing the page of books or the search results,
+             or 304 if the client's copy is current.
+    :raises HTTPException: If no book matches the query, or the cursor is invalid.
+    """
+    version = await async_books_db.version()
+    filters = {"author": author, "published": published, "price_min": price_min, "price_max": price_max}
+    filtered = any(value is not None for value in filters.values())
+    descending = order == "desc"
+
     if query:
-        search_results = [book for book in books_db if query.lower() in book["title"].lower() or query.lower() in book["author"].lower()]
-        if not search_results:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"No books found for query '{query}'.",
-            )
-        return {"search_results": search_results}
-    else:
-        return {"books":books_db}
+        limit = min(limit or SEARCH_RESULT_LIMIT, SEARCH_RESULT_LIMIT)
+
+        def filter_and_sort(matches: List[dict]) -> List[dict]:
+            matches = [book for book in matches if book_matches(book, **filters)]
+            if sort:
+                matches.sort(key=lambda book: sort_key(book, sort), reverse=descending)
+            return matches[:limit]
+
+        async def search() -> dict:
+            if filtered or sort:
+                # rank (or sort) every match, then keep the first ones passing the filters
+                search_results = await offload(filter_and_sort, await async_books_db.search(query))
+            else:
+                search_results = await async_books_db.search(query, limit=limit)
+            if not search_results:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"No books found for query '{query}'.",
+                )
+            return {"search_results": BookList(search_results)}
+
+        key = ("search", query, limit, *filters.values(), sort, order)
+        return await cached_response(request, key, "books", version, search, async_books_db.version)
+
+    sort = sort or "id"
+    after = None
+    if cursor is not None:
+        if sort == "id":
+            try:
+                after = (int(cursor), int(cursor))
+            except ValueError:
+                pass
+        else:
+            after = decode_position(cursor, sort)
+        if after is None:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor")
+    # plain listings by ID go through the cheaper page() of every backend
+    plain = not filtered and sort == "id" and not descending
+
+    if stream:
+        etag = make_etag("books", version[0], f"{current_format()}-{stream}")
+        headers = cache_headers(etag, version[1])
+        if is_not_modified(request, etag, version[1]):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        if plain:
+            pages = books_db.iter_pages(after and after[1], BOOKS_MAX_PAGE_SIZE)
+        else:
+            pages = books_db.iter_find(**filters, sort=sort, descending=descending, after=after,
+                                       limit=BOOKS_MAX_PAGE_SIZE)
+        response = streaming_response("books", pages, stream)
+        response.headers.update(headers)
+        return response
+
+    limit = limit or BOOKS_PAGE_SIZE
+
+    async def list_books() -> dict:
+        if plain:
+            books, next_cursor = await async_books_db.page(after and after[1], limit)
+        else:
+            books, position = await async_books_db.find(**filters, sort=sort, descending=descending, after=after,
+                                                        limit=limit)
+            next_cursor = position and (position[1] if sort == "id" else encode_position(position))
+        return {"books": BookList(books), "next_cursor": next_cursor}
+
+    key = ("books", after, limit, *filters.values(), sort, order)
+    return await cached_response(request, key, "books", version, list_books, async_books_db.version)
 
 
 # Create a book
 @app.post("/books")
-def create_book(book: Book, current_user: User = Depends(get_current_user)) -> JSONResponse:
+async def create_book(book: Book, current_user: User = Depends(get_current_user)) -> NegotiatedResponse:
     """
     Create a new book in the database.
     :param book: A `Book` instance containing information about the new book.
     :param current_user: A `User` instance representing the currently authenticated user.
-    :return: A `JSONResponse` indicating whether the book was created successfully.
+    :return: A `NegotiatedResponse` indicating whether the book was created successfully.
     """
 
     # user not logged in
-    if not current_user["active"]:
+    if not await async_sessions_db.is_active(current_user["username"]):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="You are not logged in.")
     
@@ -173,80 +355,171 @@ def create_book(book: Book, current_user: User = Depends(get_current_user)) -> J
             detail="Darth Vader is not allowed to publish his work on Wookie Books",
         )
 
-    # Check if the book ID already exists
-    if any(existing_book["id"] == book.id for existing_book in books_db):
+    # Add the book to the database, unless the book ID already exists
+    try:
+        await async_books_db.add(book.dict())
+    except KeyError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Book ID {book.id} already exists",
         )
+    invalidate_books()
+    return NegotiatedResponse(content={"message": "Book created successfully"}, status_code=status.HTTP_201_CREATED)
+
 
-    # Add the book to the database
-    books_db.append(book.dict())
-    return JSONResponse(content={"message": "Book created successfully"}, status_code=status.HTTP_201_CREATED)
+# Bulk create, update and delete
+# Bodies are a JSON array or NDJSON (Content-Type: application/x-ndjson). With atomic=true (the
+# default) nothing is written unless every item is valid; with atomic=false valid items are
+# applied and the response carries one result per item.
+@app.post("/books/bulk")
+async def create_books_bulk(request: Request, atomic: bool = True,
+                            current_user: User = Depends(get_current_user)) -> NegotiatedResponse:
+    """
+    Create many books in one request.
+    :param atomic: Reject the whole batch if any item is invalid.
+    :return: A `NegotiatedResponse` with the number of books created, or the per-item results.
+    """
+    items = bulk.parse_items(await request.body(), request.headers.get("content-type", ""))
+    return await run_in_threadpool(bulk.create_books, items, current_user, atomic)
+
+
+@app.put("/books/bulk")
+async def update_books_bulk(request: Request, atomic: bool = True,
+                            current_user: User = Depends(get_current_user)) -> NegotiatedResponse:
+    """
+    Update many books in one request. Each item replaces the book with the same ID.
+    :param atomic: Reject the whole batch if any item is invalid.
+    :return: A `NegotiatedResponse` with the number of books updated, or the per-item results.
+    """
+    items = bulk.parse_items(await request.body(), request.headers.get("content-type", ""))
+    return await run_in_threadpool(bulk.update_books, items, current_user, atomic)
+
+
+@app.delete("/books/bulk")
+async def delete_books_bulk(request: Request, atomic: bool = True,
+                            current_user: User = Depends(get_current_user)) -> NegotiatedResponse:
+    """
+    Delete many books in one request. Items are book IDs (or objects with an `id`).
+    :param atomic: Reject the whole batch if any item is invalid.
+    :return: A `NegotiatedResponse` with the number of books deleted, or the per-item results.
+    """
+    items = bulk.parse_items(await request.body(), request.headers.get("content-type", ""))
+    return await run_in_threadpool(bulk.delete_books, items, current_user, atomic)
+
+
+# Function to read a book for a conditional write
+async def read_for_write(book_id: int) -> Tuple[dict, int]:
+    """
+    Reads a book and its revision, for a write that only succeeds if the book is
+    still at that revision. The revision is read first, so the record read can only
+    be newer, in which case the write fails its check and is retried.
+    Returns:
+        Tuple[dict, int]: The book and its revision.
+    Raises:
+        HTTPException: If the book does not exist.
+    """
+    revision = await async_books_db.revision(book_id)
+    book = await async_books_db.get(book_id) if revision is not None else None
+    if book is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return book, revision[0]
+
+
+# Function to evaluate the If-Match precondition of a write
+def check_if_match(request: Request, book_id: int, revision: int) -> None:
+    """
+    Raises:
+        HTTPException: 412 if the request has an If-Match header and the book is not
+            at the revision of any of its ETags.
+    """
+    if_match = request.headers.get("if-match")
+    if if_match is not None and not revision_matches(if_match, book_tag(book_id), revision):
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                            detail="Book was modified since it was read")
 
 
 # Update a book
+# Writes are optimistic: the book is replaced only if nobody wrote it since it was read
+# (and authorized against). With If-Match, a conflict answers 412; without, the update
+# is retried against the new revision.
 @app.put("/books/{book_id}")
-def update_book(book_id: int, book_to_update: Book, current_user: User = Depends(get_current_user)) -> JSONResponse:
+async def update_book(book_id: int, book_to_update: Book, request: Request,
+                      current_user: User = Depends(get_current_user)) -> NegotiatedResponse:
     """
     Update a book with the given book_id in the books database.
     Args:
         book_id (int): The id of the book to be updated.
         book_to_update (Book): The updated book information.
+        request (Request): The request, with an optional If-Match header holding the
+            ETag the client read the book with.
         current_user (User, optional): The current user. Defaults to Depends(get_current_user).
     Returns:
-        JSONResponse: A JSON response indicating if the book was updated successfully or not.
+        NegotiatedResponse: A response indicating if the book was updated successfully or not.
+    Raises:
+        HTTPException: 412 if the book changed since the If-Match ETag, 409 if the new ID
+            is taken or the book kept changing under the update.
     """
-    for i, book in enumerate(books_db):
-        if book["id"] == book_id:
-            if current_user["username"] != book["author"]:
-                raise HTTPException(
-                    status_code=401, detail="User is not authorized to update book")
-            for b in books_db:
-                if b["id"] == book_to_update.id and b is not book:
-                    raise HTTPException(
-                        status_code=409, detail=f"Book ID {update_book.id} already exists in database")
-            books_db[i] = book_to_update.dict()
-            return JSONResponse(content={"message": "Book updated successfully"}, status_code=status.HTTP_200_OK)
-    raise HTTPException(status_code=404, detail="Book not found")
+    for _ in range(WRITE_CONFLICT_RETRIES + 1):
+        book, revision = await read_for_write(book_id)
+        if current_user["username"] != book["author"]:
+            raise HTTPException(
+                status_code=401, detail="User is not authorized to update book")
+        check_if_match(request, book_id, revision)
+        try:
+            await async_books_db.replace(book_id, book_to_update.dict(), expected_revision=revision)
+        except RevisionConflict:
+            continue
+        except KeyError:
+            # either the new ID is taken by another book, or the book vanished meanwhile
+            if await async_books_db.revision(book_id) is None:
+                raise HTTPException(status_code=404, detail="Book not found")
+            raise HTTPException(
+                status_code=409, detail=f"Book ID {book_to_update.id} already exists in database")
+        invalidate_books([book_id, book_to_update.id])
+        return NegotiatedResponse(content={"message": "Book updated successfully"}, status_code=status.HTTP_200_OK)
+    raise HTTPException(status_code=409, detail="Book is being modified concurrently, try again")
 
 
 
 # Delete a book
 @app.delete("/books/{book_id}")
-def delete_book(book_id: int, current_user: User = Depends(get_current_user)):
+async def delete_book(book_id: int, request: Request, current_user: User = Depends(get_current_user)):
     """
     Deletes a book with the given ID and returns the deleted book.
     Args:
         book_id (int): The ID of the book to delete.
+        request (Request): The request, with an optional If-Match header holding the
+            ETag the client read the book with.
         current_user (User): The current authenticated user.
     Returns:
         dict: The deleted book.
     Raises:
-        HTTPException: If the book is not found or the user is not authorized.
+        HTTPException: If the book is not found, the user is not authorized, or the
+            book changed since the If-Match ETag (412).
     """
 
-    book_index = None
-    for i, book in enumerate(books_db):
-        if book["id"] == book_id:
-            book_index = i
-            break
-
-    if book_index is None:
-        raise HTTPException(status_code=404, detail="Book not found")
-
-    if current_user["username"] != books_db[book_index]["author"]:
-        raise HTTPException(status_code=403, detail="User is not authorized to delete book")
+    for _ in range(WRITE_CONFLICT_RETRIES + 1):
+        book, revision = await read_for_write(book_id)
+        if current_user["username"] != book["author"]:
+            raise HTTPException(status_code=403, detail="User is not authorized to delete book")
+        check_if_match(request, book_id, revision)
 
-    deleted_book = books_db.pop(book_index)
-    return JSONResponse(content={"message": "Book deleted successfully"}, status_code=status.HTTP_200_OK)
-    # return deleted_book
+        try:
+            await async_books_db.delete(book_id, expected_revision=revision)
+        except RevisionConflict:
+            continue
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Book not found")
+        invalidate_books([book_id])
+        return NegotiatedResponse(content={"message": "Book deleted successfully"}, status_code=status.HTTP_200_OK)
+        # return deleted_book
+    raise HTTPException(status_code=409, detail="Book is being modified concurrently, try again")
 
 
 def main():
-    import uvicorn
-    # run server
-    uvicorn.run("build:app", host="127.0.0.1", port=8000, reload=True)
+    # run server (`python src/serve.py` avoids loading the app twice)
+    import serve
+    serve.main()
 
 
 if __name__ == "__main__":
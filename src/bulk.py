@@ -0,0 +1,253 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from pydantic import ValidationError
+
+from app_constants import BULK_MAX_ITEMS
+from data import books_db, sessions_db
+from encoding import loads
+from http_cache import invalidate_books
+from models import Book, User
+from metrics import timed
+from negotiation import NegotiatedResponse
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonlines")
+
+
+# Function to parse a bulk request body
+def parse_items(body: bytes, content_type: str) -> List[Any]:
+    """
+    Parses a bulk request body, either a JSON array or NDJSON (one JSON value per line).
+    :raises HTTPException: 400 if the body is malformed, 413 if it has too many items.
+    """
+    try:
+        if content_type.split(";")[0].strip().lower() in NDJSON_TYPES:
+            items = [loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid request body: {e}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Request body must be a JSON array or NDJSON")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {BULK_MAX_ITEMS} items are allowed per request")
+    return items
+
+
+def item_result(index: int, book_id: Any, status_code: int, detail: str) -> Dict[str, Any]:
+    return {"index": index, "id": book_id, "status": status_code, "detail": detail}
+
+
+# (name, type, required, default, allow_none) of every Book field, for the fast path
+_BOOK_FIELDS = [(name, field.type_, field.required, field.default, field.allow_none)
+                for name, field in Book.__fields__.items()]
+_MISSING = object()
+
+
+def fast_book(item: Any) -> Optional[dict]:
+    """
+    Builds a book record from an item whose values already have the exact field types,
+    which is what well-formed JSON bodies contain. Returns None for anything else
+    (coercion, missing fields, wrong types), leaving it to the `Book` model.
+    """
+    if type(item) is not dict:
+        return None
+    book = {}
+    for name, type_, required, default, allow_none in _BOOK_FIELDS:
+        value = item.get(name, _MISSING)
+        if value is _MISSING:
+            if required:
+                return None
+            value = default
+        elif value is None:
+            if not allow_none:
+                return None
+        elif type(value) is not type_:
+            if type_ is float and type(value) is int:
+                value = float(value)
+            else:
+                return None
+        book[name] = value
+    return book
+
+
+def validate_books(items: List[Any], errors: List[dict]) -> List[Tuple[int, dict]]:
+    """
+    Validates every item against the `Book` model in one pass. Invalid items are
+    reported in `errors`.
+    Returns:
+        List[Tuple[int, dict]]: The index and record of every valid item.
+    """
+    books = []
+    with timed("validate"):
+        for index, item in enumerate(items):
+            book = fast_book(item)
+            if book is not None:
+                books.append((index, book))
+                continue
+            try:
+                books.append((index, Book.parse_obj(item).dict()))
+            except ValidationError as e:
+                book_id = item.get("id") if isinstance(item, dict) else None
+                errors.append(item_result(index, book_id, status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                          "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}"
+                                                    for err in e.errors())))
+    return books
+
+
+def check_duplicates(books: List[Tuple[int, dict]], errors: List[dict]) -> List[Tuple[int, dict]]:
+    """
+    Rejects items repeating an ID already seen earlier in the same request.
+    """
+    seen = set()
+    unique = []
+    for index, book in books:
+        if book["id"] in seen:
+            errors.append(item_result(index, book["id"], status.HTTP_400_BAD_REQUEST,
+                                      f"Book ID {book['id']} appears more than once in the request"))
+            continue
+        seen.add(book["id"])
+        unique.append((index, book))
+    return unique
+
+
+def check_logged_in(current_user: User) -> None:
+    if not sessions_db.is_active(current_user["username"]):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You are not logged in.")
+
+
+def batch_id(value: Any) -> Any:
+    # batch values are books, or IDs for deletes
+    return value["id"] if isinstance(value, dict) else value
+
+
+# Function to apply a validated batch and build the response
+def apply_batch(total: int, valid: List[Tuple[int, Any]], errors: List[dict], atomic: bool,
+                apply: Callable[[List[Any]], None], success_status: int, verb: str) -> NegotiatedResponse:
+    """
+    Applies the valid items of a batch.
+
+    In atomic mode nothing is written unless every item is valid, and the store
+    applies the batch all-or-nothing; a rejected batch answers 400 (or 409 when a
+    concurrent write conflicts) with the per-item errors. Otherwise the valid items
+    are applied and the response is 207 with one result per item.
+    """
+    if atomic:
+        if errors:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail={"message": f"No books {verb}: the request has invalid items",
+                                        "errors": sorted(errors, key=lambda e: e["index"])})
+        try:
+            apply([value for _, value in valid])
+        except KeyError as e:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail=f"No books {verb}: book ID {e.args[0]} was changed concurrently")
+        invalidate_books(batch_id(value) for _, value in valid)
+        return NegotiatedResponse(content={"message": f"{total} books {verb} successfully", "count": total},
+                                  status_code=success_status)
+
+    results = list(errors)
+    try:
+        apply([value for _, value in valid])
+        applied = valid
+    except KeyError:
+        # a concurrent write got in the way; fall back to one item at a time
+        applied = []
+        for index, value in valid:
+            try:
+                apply([value])
+                applied.append((index, value))
+            except KeyError:
+                results.append(item_result(index, batch_id(value), status.HTTP_409_CONFLICT,
+                                           f"Book ID {batch_id(value)} was changed concurrently"))
+    invalidate_books(batch_id(value) for _, value in applied)
+    for index, value in applied:
+        results.append(item_result(index, batch_id(value), success_status, f"Book {verb} successfully"))
+    results.sort(key=lambda r: r["index"])
+    return NegotiatedResponse(content={"count": len(applied), "results": results},
+                              status_code=status.HTTP_207_MULTI_STATUS)
+
+
+# Bulk create
+def create_books(items: List[Any], current_user: User, atomic: bool) -> NegotiatedResponse:
+    check_logged_in(current_user)
+    username = current_user["username"]
+    if username == "vader":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Darth Vader is not allowed to publish his work on Wookie Books",
+        )
+
+    errors: List[dict] = []
+    books = []
+    for index, book in validate_books(items, errors):
+        if book["author"] != username:
+            errors.append(item_result(index, book["id"], status.HTTP_401_UNAUTHORIZED,
+                                      "User is not authorized to create book"))
+        else:
+            books.append((index, book))
+    books = check_duplicates(books, errors)
+
+    existing = books_db.existing_ids(book["id"] for _, book in books)
+    valid = []
+    for index, book in books:
+        if book["id"] in existing:
+            errors.append(item_result(index, book["id"], status.HTTP_400_BAD_REQUEST,
+                                      f"Book ID {book['id']} already exists"))
+        else:
+            valid.append((index, book))
+    return apply_batch(len(items), valid, errors, atomic, books_db.add_many,
+                       status.HTTP_201_CREATED, "created")
+
+
+# Bulk update
+def update_books(items: List[Any], current_user: User, atomic: bool) -> NegotiatedResponse:
+    check_logged_in(current_user)
+    errors: List[dict] = []
+    valid = []
+    for index, book in check_duplicates(validate_books(items, errors), errors):
+        existing = books_db.get(book["id"])
+        if existing is None:
+            errors.append(item_result(index, book["id"], status.HTTP_404_NOT_FOUND, "Book not found"))
+        elif existing["author"] != current_user["username"]:
+            errors.append(item_result(index, book["id"], status.HTTP_401_UNAUTHORIZED,
+                                      "User is not authorized to update book"))
+        else:
+            valid.append((index, book))
+    return apply_batch(len(items), valid, errors, atomic, books_db.replace_many,
+                       status.HTTP_200_OK, "updated")
+
+
+# Bulk delete
+def delete_books(items: List[Any], current_user: User, atomic: bool) -> NegotiatedResponse:
+    check_logged_in(current_user)
+    errors: List[dict] = []
+    ids = []
+    for index, item in enumerate(items):
+        book_id = item.get("id") if isinstance(item, dict) else item
+        if isinstance(book_id, bool) or not isinstance(book_id, int):
+            errors.append(item_result(index, book_id, status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                      "Expected a book ID"))
+        else:
+            ids.append((index, book_id))
+
+    seen = set()
+    valid = []
+    for index, book_id in ids:
+        existing = books_db.get(book_id)
+        if book_id in seen:
+            errors.append(item_result(index, book_id, status.HTTP_400_BAD_REQUEST,
+                                      f"Book ID {book_id} appears more than once in the request"))
+        elif existing is None:
+            errors.append(item_result(index, book_id, status.HTTP_404_NOT_FOUND, "Book not found"))
+        elif existing["author"] != current_user["username"]:
+            errors.append(item_result(index, book_id, status.HTTP_403_FORBIDDEN,
+                                      "User is not authorized to delete book"))
+        else:
+            valid.append((index, book_id))
+        seen.add(book_id)
+    return apply_batch(len(items), valid, errors, atomic, books_db.delete_many,
+                       status.HTTP_200_OK, "deleted")
@@ -0,0 +1,570 @@
+from array import array
+from bisect import bisect_right
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import math
+import threading
+import time
+
+from indexes import Position, SortedList, title_key
+from search import fold
+from snapshots import SnapshotWriter
+from store import BookRepository, RevisionConflict, first_duplicate
+
+# Fields searched through the folded text arenas; authors are searched through the
+# (much shorter) list of distinct authors instead
+ARENA_FIELDS = ("title", "description")
+
+# Separates the values in a search arena, so a match never spans two books
+_SEPARATOR = b"\x00"
+
+# Text arenas are compacted once they are more than half garbage, and at least this big
+_COMPACT_MIN_BYTES = 1 << 20
+
+# Columns written to snapshots as they are
+_SNAPSHOT_COLUMNS = ("_id", "_price", "_published", "_author", "_cover", "_text_at", "_title_len",
+                     "_description_len", "_rev", "_modified", "_text")
+
+# Orders written to snapshots as one array of rows each
+_SNAPSHOT_ORDERS = ("_sorted_rows", "_price_order", "_title_order")
+
+
+def _rows(values: List[int]) -> array:
+    return array("l", values)
+
+
+# Columnar in-memory book repository
+class CompactBookStore(BookRepository):
+    """
+    Book repository storing books in columns instead of one dict per book.
+
+    Every book is a row: IDs, prices, revisions and timestamps live in typed arrays,
+    the published flags in a bytearray, authors and cover images as indexes into
+    lists of interned strings, and titles and descriptions as UTF-8 in one shared
+    text arena. Rows of deleted books are reused. Rows are kept in ID order, for
+    lookups by bisection and keyset pagination, and in price and in title order for
+    filtered and sorted listings, each a `SortedList` of row arrays. Records are
+    materialized as dicts only when read.
+
+    Searches scan case-folded copies of the titles and descriptions, each kept in
+    its own arena, with `bytearray.find`, and match authors against the distinct
+    author names; title matches rank above author matches, which rank above
+    description matches, then by ID. That needs far less memory than a token index,
+    at the price of scanning the text for every query.
+
+    Compared to `BookStore`, a book takes several times less memory.
+    """
+
+    lock_free_methods = frozenset({"version"})
+
+    def __init__(self, books: Iterable[dict] = ()):
+        # row-indexed columns
+        self._id = array("q")
+        self._price = array("d")
+        self._published = bytearray()
+        self._author = array("l")
+        self._cover = array("l")
+        # title and description of a row, back to back in the text arena
+        self._text_at = array("Q")
+        self._title_len = array("L")
+        self._description_len = array("L")
+        self._rev = array("q")
+        self._modified = array("d")
+        self._free: List[int] = []
+        self._text = bytearray()
+        self._dead_text = 0
+
+        # interned strings
+        self._authors: List[str] = []
+        self._folded_authors: List[str] = []
+        self._author_index: Dict[str, int] = {}
+        self._covers: List[str] = []
+        self._cover_index: Dict[str, int] = {}
+        # author index -> book ids, in insertion order
+        self._by_author: Dict[int, array] = {}
+
+        self._orders()
+
+        # search arenas: folded text, the start offset and row of every value in it
+        # (-1 once the value is outdated), and the current value of every row
+        self._arena = {field: bytearray() for field in ARENA_FIELDS}
+        self._segment_at = {field: array("Q") for field in ARENA_FIELDS}
+        self._segment_row = {field: array("l") for field in ARENA_FIELDS}
+        self._segment_of = {field: array("l") for field in ARENA_FIELDS}
+        self._dead_arena = {field: 0 for field in ARENA_FIELDS}
+
+        self._version: Tuple[int, float] = (0, time.time())
+        self._lock = threading.RLock()
+        books = list(books)
+        if books:
+            self.add_many(books)
+
+    def __len__(self) -> int:
+        return len(self._sorted_rows)
+
+    def __contains__(self, book_id: object) -> bool:
+        return self._row(book_id) >= 0
+
+    # Row lookups and materialization
+    def _row(self, book_id: object) -> int:
+        if not isinstance(book_id, int):
+            return -1
+        return self._sorted_rows.lookup(book_id, -1)
+
+    def _record(self, row: int) -> dict:
+        at = self._text_at[row]
+        middle = at + self._title_len[row]
+        cover = self._cover[row]
+        return {
+            "id": self._id[row],
+            "title": self._text[at:middle].decode(),
+            "description": self._text[middle:middle + self._description_len[row]].decode(),
+            "author": self._authors[self._author[row]],
+            "cover_image": None if cover < 0 else self._covers[cover],
+            "price": self._price[row],
+            "published": bool(self._published[row]),
+        }
+
+    def get(self, book_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._row(book_id)
+            return self._record(row) if row >= 0 else None
+
+    def version(self) -> Tuple[int, float]:
+        return self._version
+
+    def revision(self, book_id: int) -> Optional[Tuple[int, float]]:
+        with self._lock:
+            row = self._row(book_id)
+            return (self._rev[row], self._modified[row]) if row >= 0 else None
+
+    def by_author(self, author: str) -> List[dict]:
+        with self._lock:
+            index = self._author_index.get(author)
+            ids = self._by_author.get(index, ())
+            return [self._record(self._row(book_id)) for book_id in ids]
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[dict]:
+        needle = fold(query)
+        encoded = needle.encode()
+        if not encoded or _SEPARATOR in encoded:
+            return []
+        with self._lock:
+            seen: Set[int] = set()
+            rows: List[int] = []
+            for field in ("title", "author", "description"):
+                if field == "author":
+                    matches = [self._row(book_id)
+                               for index, name in enumerate(self._folded_authors) if needle in name
+                               for book_id in self._by_author.get(index, ())]
+                else:
+                    matches = self._scan(field, encoded)
+                matches = sorted({row for row in matches if row not in seen}, key=self._id.__getitem__)
+                seen.update(matches)
+                rows.extend(matches)
+                if limit is not None and len(rows) >= limit:
+                    break
+            return [self._record(row) for row in rows[:limit]]
+
+    def _scan(self, field: str, needle: bytes) -> List[int]:
+        arena = self._arena[field]
+        segment_at = self._segment_at[field]
+        segment_row = self._segment_row[field]
+        count = len(segment_at)
+        rows = []
+        position = arena.find(needle)
+        while position != -1:
+            segment = bisect_right(segment_at, position) - 1
+            row = segment_row[segment]
+            if row >= 0:
+                rows.append(row)
+            # the rest of this value can't add anything
+            position = arena.find(needle, segment_at[segment + 1]) if segment + 1 < count else -1
+        return rows
+
+    def page(self, cursor: Optional[int] = None, limit: int = 100) -> Tuple[List[dict], Optional[int]]:
+        with self._lock:
+            start = 0 if cursor is None else self._sorted_rows.bisect_right(cursor)
+            books = [self._record(row) for row in self._sorted_rows.islice(start, start + limit)]
+            more = start + limit < len(self._sorted_rows)
+        return books, (books[-1]["id"] if more and books else None)
+
+    def find(self, author: Optional[str] = None, published: Optional[bool] = None,
+             price_min: Optional[float] = None, price_max: Optional[float] = None,
+             sort: str = "id", descending: bool = False, after: Optional[Position] = None,
+             limit: int = 100) -> Tuple[List[dict], Optional[Position]]:
+        with self._lock:
+            key = self._sort_keys()[sort]
+            priced = price_min is not None or price_max is not None
+            # same plan as BookStore.find: walk an order, or sort a small candidate set
+            candidates = None
+            if author is not None:
+                index = self._author_index.get(author)
+                candidates = [self._row(book_id) for book_id in self._by_author.get(index, ())]
+            elif sort == "price":
+                walk = self._walk(self._price_order, after, descending, price_min, price_max)
+                priced = False
+            elif priced and self._count(self._price_order, price_min, price_max) ** 2 <= limit * len(self):
+                candidates = list(self._walk(self._price_order, lo=price_min, hi=price_max))
+            elif sort == "title":
+                walk = self._walk(self._title_order, after, descending)
+            else:
+                # the ID order is keyed by the ID alone
+                walk = self._walk(self._sorted_rows, None if after is None else after[1], descending)
+
+            if candidates is not None:
+                candidates.sort(key=key, reverse=descending)
+                if after is not None:
+                    candidates = [row for row in candidates if (key(row) < after if descending else key(row) > after)]
+                walk = iter(candidates)
+
+            rows = []
+            for row in walk:
+                if published is not None and self._published[row] != published:
+                    continue
+                if priced and not ((price_min is None or self._price[row] >= price_min)
+                                   and (price_max is None or self._price[row] <= price_max)):
+                    continue
+                rows.append(row)
+                if len(rows) > limit:
+                    break
+            books = [self._record(row) for row in rows[:limit]]
+            return books, (key(rows[limit - 1]) if len(rows) > limit else None)
+
+    # Sort orders
+    def _id_key(self, row: int) -> Position:
+        return self._id[row], self._id[row]
+
+    def _price_key(self, row: int) -> Position:
+        return self._price[row], self._id[row]
+
+    def _title_key(self, row: int) -> Position:
+        at = self._text_at[row]
+        return title_key(self._text[at:at + self._title_len[row]].decode()), self._id[row]
+
+    def _sort_keys(self) -> Dict[str, Callable[[int], Position]]:
+        return {"id": self._id_key, "price": self._price_key, "title": self._title_key}
+
+    def _orders(self, sorted_rows: List[int] = (), price_order: List[int] = (),
+                title_order: List[int] = ()) -> None:
+        """
+        Sets the sort orders from rows already in each order. The ID order is keyed
+        by the ID column in place at the time.
+        """
+        self._sorted_rows = SortedList.from_sorted(sorted_rows, self._id.__getitem__, _rows)
+        # rows ordered by (price, id) and by (title key, id)
+        self._price_order = SortedList.from_sorted(price_order, self._price_key, _rows)
+        self._title_order = SortedList.from_sorted(title_order, self._title_key, _rows)
+
+    @staticmethod
+    def _bounds(order: SortedList, lo, hi) -> Tuple[int, int]:
+        start = 0 if lo is None else order.bisect_left((lo,))
+        stop = len(order) if hi is None else order.bisect_right((hi, math.inf))
+        return start, stop
+
+    def _count(self, order: SortedList, lo, hi) -> int:
+        start, stop = self._bounds(order, lo, hi)
+        return max(stop - start, 0)
+
+    def _walk(self, order: SortedList, after: Any = None, descending: bool = False, lo=None, hi=None) -> Iterator[int]:
+        start, stop = self._bounds(order, lo, hi)
+        if after is not None:
+            if descending:
+                stop = min(stop, order.bisect_left(after))
+            else:
+                start = max(start, order.bisect_right(after))
+        return order.islice(start, stop, descending)
+
+    def existing_ids(self, ids: Iterable[int]) -> Set[int]:
+        with self._lock:
+            return {book_id for book_id in ids if self._row(book_id) >= 0}
+
+    # Writes
+    def add(self, book: dict) -> None:
+        with self._lock:
+            if self._row(book["id"]) >= 0:
+                raise KeyError(book["id"])
+            self._insert_rows([self._write(self._new_row(), book, self._bump())])
+
+    def replace(self, book_id: int, book: dict, expected_revision: Optional[int] = None) -> dict:
+        with self._lock:
+            row = self._row(book_id)
+            if row < 0:
+                raise KeyError(book_id)
+            self._check_revision(row, expected_revision)
+            new_id = book["id"]
+            if new_id != book_id and self._row(new_id) >= 0:
+                raise KeyError(new_id)
+            old = self._record(row)
+            self._remove_rows([row])
+            self._release(row)
+            self._insert_rows([self._write(row, book, self._bump())])
+            self._maybe_compact()
+            return old
+
+    def delete(self, book_id: int, expected_revision: Optional[int] = None) -> dict:
+        with self._lock:
+            row = self._row(book_id)
+            if row < 0:
+                raise KeyError(book_id)
+            self._check_revision(row, expected_revision)
+            book = self._record(row)
+            self._remove_rows([row])
+            self._release(row)
+            self._free.append(row)
+            self._bump()
+            self._maybe_compact()
+            return book
+
+    def add_many(self, books: List[dict]) -> None:
+        with self._lock:
+            ids = [book["id"] for book in books]
+            duplicate = first_duplicate(ids)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            for book_id in ids:
+                if self._row(book_id) >= 0:
+                    raise KeyError(book_id)
+            revision = self._bump()
+            self._insert_rows([self._write(self._new_row(), book, revision) for book in books])
+
+    def replace_many(self, books: List[dict]) -> None:
+        with self._lock:
+            duplicate = first_duplicate(book["id"] for book in books)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            rows = [self._row(book["id"]) for book in books]
+            for book, row in zip(books, rows):
+                if row < 0:
+                    raise KeyError(book["id"])
+            revision = self._bump()
+            self._remove_rows(rows)
+            for book, row in zip(books, rows):
+                self._release(row)
+                self._write(row, book, revision)
+            self._insert_rows(rows)
+            self._maybe_compact()
+
+    def delete_many(self, book_ids: List[int]) -> None:
+        with self._lock:
+            duplicate = first_duplicate(book_ids)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            rows = [self._row(book_id) for book_id in book_ids]
+            for book_id, row in zip(book_ids, rows):
+                if row < 0:
+                    raise KeyError(book_id)
+            self._remove_rows(rows)
+            for row in rows:
+                self._release(row)
+            self._free.extend(rows)
+            self._bump()
+            self._maybe_compact()
+
+    def _bump(self) -> Tuple[int, float]:
+        # called with the lock held; rows are stamped with the new version as they
+        # are written
+        self._version = (self._version[0] + 1, time.time())
+        return self._version
+
+    def _check_revision(self, row: int, expected_revision: Optional[int]) -> None:
+        # called with the lock held, before anything changes
+        if expected_revision is not None and self._rev[row] != expected_revision:
+            raise RevisionConflict(self._id[row], self._rev[row])
+
+    # Row maintenance
+    def _new_row(self) -> int:
+        return self._free.pop() if self._free else len(self._id)
+
+    def _intern_author(self, author: str) -> int:
+        index = self._author_index.get(author)
+        if index is None:
+            index = self._author_index[author] = len(self._authors)
+            self._authors.append(author)
+            self._folded_authors.append(fold(author))
+        return index
+
+    def _intern_cover(self, cover_image: Optional[str]) -> int:
+        if cover_image is None:
+            return -1
+        index = self._cover_index.get(cover_image)
+        if index is None:
+            index = self._cover_index[cover_image] = len(self._covers)
+            self._covers.append(cover_image)
+        return index
+
+    def _write(self, row: int, book: dict, revision: Tuple[int, float]) -> int:
+        title = book["title"].encode()
+        description = book["description"].encode()
+        author = self._intern_author(book["author"])
+        values = (
+            (self._id, book["id"]),
+            (self._price, float(book["price"])),
+            (self._published, 1 if book["published"] else 0),
+            (self._author, author),
+            (self._cover, self._intern_cover(book.get("cover_image"))),
+            (self._text_at, len(self._text)),
+            (self._title_len, len(title)),
+            (self._description_len, len(description)),
+            (self._rev, revision[0]),
+            (self._modified, revision[1]),
+        )
+        if row == len(self._id):
+            for column, value in values:
+                column.append(value)
+        else:
+            for column, value in values:
+                column[row] = value
+        self._text += title
+        self._text += description
+        self._by_author.setdefault(author, array("q")).append(book["id"])
+
+        for field in ARENA_FIELDS:
+            arena = self._arena[field]
+            segment_of = self._segment_of[field]
+            segment = len(self._segment_at[field])
+            self._segment_at[field].append(len(arena))
+            self._segment_row[field].append(row)
+            arena += fold(book[field]).encode().replace(_SEPARATOR, b"")
+            arena += _SEPARATOR
+            if row == len(segment_of):
+                segment_of.append(segment)
+            else:
+                segment_of[row] = segment
+        return row
+
+    def _release(self, row: int) -> None:
+        """
+        Marks the text of a row as garbage and unindexes it, before the row is
+        rewritten or freed.
+        """
+        self._dead_text += self._title_len[row] + self._description_len[row]
+        for field in ARENA_FIELDS:
+            segment = self._segment_of[field][row]
+            segment_at = self._segment_at[field]
+            end = segment_at[segment + 1] if segment + 1 < len(segment_at) else len(self._arena[field])
+            self._segment_row[field][segment] = -1
+            self._dead_arena[field] += end - segment_at[segment]
+        author = self._author[row]
+        ids = self._by_author[author]
+        ids.remove(self._id[row])
+        if not ids:
+            del self._by_author[author]
+
+    def _insert_rows(self, rows: List[int]) -> None:
+        """
+        Adds written rows to the sort orders.
+        """
+        for order in (self._sorted_rows, self._price_order, self._title_order):
+            order.update(rows)
+
+    def _remove_rows(self, rows: List[int]) -> None:
+        """
+        Removes rows from the sort orders, before they are rewritten or freed.
+        """
+        for order in (self._sorted_rows, self._price_order, self._title_order):
+            order.remove_many(rows)
+
+    # Snapshots
+    def snapshot(self) -> Callable[[SnapshotWriter], None]:
+        """
+        Captures the store and returns a function writing it to a snapshot. The
+        capture copies every column (one memcpy each, or one per block of an order)
+        under the lock; the snapshot is written afterwards, while writes go on.
+        Restoring it needs no sorting.
+        """
+        with self._lock:
+            columns = [(name, getattr(self, name)[:]) for name in _SNAPSHOT_COLUMNS]
+            for name in _SNAPSHOT_ORDERS:
+                rows = array("l")
+                for block in getattr(self, name).blocks():
+                    rows += block
+                columns.append((name, rows))
+            for field in ARENA_FIELDS:
+                columns += [(f"arena.{field}", self._arena[field][:]),
+                            (f"segment_at.{field}", self._segment_at[field][:]),
+                            (f"segment_row.{field}", self._segment_row[field][:]),
+                            (f"segment_of.{field}", self._segment_of[field][:])]
+            authors = array("l", self._by_author)
+            author_sizes = array("q", [len(ids) for ids in self._by_author.values()])
+            author_ids = array("q")
+            for ids in self._by_author.values():
+                author_ids += ids
+            columns += [("by_author", authors), ("by_author_sizes", author_sizes), ("by_author_ids", author_ids),
+                        ("free", array("l", self._free))]
+            state = {"version": list(self._version), "authors": list(self._authors), "covers": list(self._covers),
+                     "dead_text": self._dead_text, "dead_arena": dict(self._dead_arena)}
+
+        def write(writer: SnapshotWriter) -> None:
+            writer.section("state", state)
+            for name, column in columns:
+                writer.section(name, column)
+        return write
+
+    @classmethod
+    def restore(cls, sections: List[Tuple[str, Any]]) -> "CompactBookStore":
+        """
+        Rebuilds a store from the sections of a snapshot written by `snapshot`.
+        """
+        store = cls()
+        values = dict(sections)
+        for name in _SNAPSHOT_COLUMNS:
+            setattr(store, name, values[name])
+        store._orders(*(values[name] for name in _SNAPSHOT_ORDERS))
+        for field in ARENA_FIELDS:
+            store._arena[field] = values[f"arena.{field}"]
+            store._segment_at[field] = values[f"segment_at.{field}"]
+            store._segment_row[field] = values[f"segment_row.{field}"]
+            store._segment_of[field] = values[f"segment_of.{field}"]
+        start = 0
+        author_ids = values["by_author_ids"]
+        for author, size in zip(values["by_author"], values["by_author_sizes"]):
+            store._by_author[author] = author_ids[start:start + size]
+            start += size
+        store._free = list(values["free"])
+
+        state = values["state"]
+        for author in state["authors"]:
+            store._intern_author(author)
+        for cover in state["covers"]:
+            store._intern_cover(cover)
+        store._dead_text = state["dead_text"]
+        store._dead_arena = state["dead_arena"]
+        store._version = tuple(state["version"])
+        return store
+
+    def _maybe_compact(self) -> None:
+        garbage = [self._dead_text > max(len(self._text) // 2, _COMPACT_MIN_BYTES)]
+        garbage += [self._dead_arena[field] > max(len(self._arena[field]) // 2, _COMPACT_MIN_BYTES)
+                    for field in ARENA_FIELDS]
+        if any(garbage):
+            self._compact()
+
+    def _compact(self) -> None:
+        """
+        Rewrites the text arena and the search arenas without the garbage, live
+        rows in ID order.
+        """
+        text = bytearray()
+        for row in self._sorted_rows:
+            at = self._text_at[row]
+            length = self._title_len[row] + self._description_len[row]
+            self._text_at[row] = len(text)
+            text += self._text[at:at + length]
+        self._text = text
+        self._dead_text = 0
+
+        for field in ARENA_FIELDS:
+            old_arena, old_at = self._arena[field], self._segment_at[field]
+            arena, segment_at, segment_row = bytearray(), array("Q"), array("l")
+            segment_of = self._segment_of[field]
+            for row in self._sorted_rows:
+                segment = segment_of[row]
+                end = old_at[segment + 1] if segment + 1 < len(old_at) else len(old_arena)
+                segment_of[row] = len(segment_at)
+                segment_at.append(len(arena))
+                segment_row.append(row)
+                arena += old_arena[old_at[segment]:end]
+            self._arena[field] = arena
+            self._segment_at[field] = segment_at
+            self._segment_row[field] = segment_row
+            self._dead_arena[field] = 0
@@ -0,0 +1,218 @@
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+import gzip
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from aio import offload
+from app_constants import (BROTLI_LEVEL, COMPRESSION_ENCODINGS, COMPRESSION_MIN_SIZE, GZIP_LEVEL, OFFLOAD_MIN_BYTES,
+                           ZSTD_LEVEL)
+from metrics import timed
+
+try:
+    import brotli
+except ImportError:  # optional, br is not offered without it
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional, zstd is not offered without it
+    zstandard = None
+
+GZIP, BROTLI, ZSTD = "gzip", "br", "zstd"
+
+# Media types worth compressing; everything else (e.g. images) goes out as is
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/xml", "application/x-ndjson")
+
+# Content-Encoding negotiated for the current request, None for identity
+response_encoding: ContextVar[Optional[str]] = ContextVar("response_encoding", default=None)
+
+
+def available_encodings(names: str = COMPRESSION_ENCODINGS) -> List[str]:
+    """
+    The configured encodings this installation can produce, in order of preference.
+    """
+    installed = {GZIP: True, BROTLI: brotli is not None, ZSTD: zstandard is not None}
+    return [name for name in (name.strip().lower() for name in names.split(",")) if installed.get(name)]
+
+
+def negotiate_encoding(accept_encoding: Optional[str], offered: List[str]) -> Optional[str]:
+    """
+    Picks the content coding for an Accept-Encoding header: the one with the highest
+    q-value, ties going to the server's preference. `*` stands for every coding not
+    listed. Returns None (identity) when nothing offered is acceptable.
+    """
+    if not accept_encoding or not offered:
+        return None
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+    default = weights.get("*", 0.0)
+    best, best_q = None, 0.0
+    for name in offered:
+        q = weights.get(name, default)
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Compresses a whole body. Output is deterministic (gzip carries no timestamp),
+    so equal bodies compress to equal bytes.
+    """
+    with timed("compress"):
+        if encoding == GZIP:
+            return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+        if encoding == BROTLI:
+            return brotli.compress(body, quality=BROTLI_LEVEL)
+        if encoding == ZSTD:
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    raise ValueError(f"Unknown content coding: {encoding!r}")
+
+
+# Incremental compressor for streamed bodies
+class StreamCompressor:
+    """
+    Compresses a body chunk by chunk, flushing after every chunk so the client can
+    decode what was sent so far instead of waiting for the end of the stream.
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == GZIP:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == BROTLI:
+            self._compressor = brotli.Compressor(quality=BROTLI_LEVEL)
+        elif encoding == ZSTD:
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            raise ValueError(f"Unknown content coding: {encoding!r}")
+
+    def compress(self, chunk: bytes) -> bytes:
+        with timed("compress"):
+            if self.encoding == GZIP:
+                return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            if self.encoding == BROTLI:
+                return self._compressor.process(chunk) + self._compressor.flush()
+            return self._compressor.compress(chunk) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        with timed("compress"):
+            if self.encoding == BROTLI:
+                return self._compressor.finish()
+            return self._compressor.flush()
+
+
+def weak_etag(etag: str) -> str:
+    """
+    Marks an ETag weak. A compressed body is a different byte sequence than the one
+    the strong ETag names, but it stays a valid If-None-Match validator since that
+    header uses weak comparison.
+    """
+    return etag if etag.startswith("W/") else f"W/{etag}"
+
+
+# Middleware compressing responses
+class CompressionMiddleware:
+    """
+    Negotiates a content coding from Accept-Encoding and compresses text, JSON and
+    XML responses of at least `minimum_size` bytes with it. Streamed responses are
+    compressed chunk by chunk, whatever their size. Bodies and chunks of at least
+    OFFLOAD_MIN_BYTES are compressed on the threadpool.
+
+    The negotiated coding is also exposed through the `response_encoding` context
+    variable, so routes can send bodies they compressed (and cached) themselves;
+    responses that already carry a Content-Encoding are passed through untouched.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE,
+                 encodings: Optional[List[str]] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encodings = available_encodings() if encodings is None else encodings
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.encodings:
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"), self.encodings)
+        token = response_encoding.set(encoding)
+        start: Optional[Message] = None
+        compressor: Optional[StreamCompressor] = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                media_type = headers.get("content-type", "")
+                if media_type.startswith(COMPRESSIBLE_TYPES):
+                    MutableHeaders(scope=message).add_vary_header("Accept-Encoding")
+                    if encoding is not None and "content-encoding" not in headers \
+                            and message["status"] not in (204, 304):
+                        # wait for the body to decide
+                        start = message
+                        return
+                await send(message)
+                return
+
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(scope=start)
+                if not more_body:
+                    # the whole body at once
+                    if len(body) >= self.minimum_size:
+                        if len(body) >= OFFLOAD_MIN_BYTES:
+                            body = await offload(compress, body, encoding)
+                        else:
+                            body = compress(body, encoding)
+                        self._mark(headers, encoding)
+                        headers["Content-Length"] = str(len(body))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                compressor = StreamCompressor(encoding)
+                self._mark(headers, encoding)
+                if "content-length" in headers:
+                    del headers["Content-Length"]
+                await send(start)
+
+            if len(body) >= OFFLOAD_MIN_BYTES:
+                body = await offload(compressor.compress, body)
+            else:
+                body = compressor.compress(body) if body else b""
+            if not more_body:
+                body += compressor.finish()
+            if body or not more_body:
+                await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        try:
+            await self.app(scope, receive, send_compressed)
+        finally:
+            response_encoding.reset(token)
+
+    @staticmethod
+    def _mark(headers: MutableHeaders, encoding: str) -> None:
+        headers["Content-Encoding"] = encoding
+        if "etag" in headers:
+            headers["ETag"] = weak_etag(headers["etag"])
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from typing import Tuple
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from app_constants import PBKDF2_ROUNDS, CREDENTIAL_CACHE_SIZE, CREDENTIAL_CACHE_TTL
+
+_hasher = None
+
+
+# Function to get the password hasher with the configured cost
+def get_hasher():
+    """
+    The pbkdf2_sha256 hasher with the configured cost. passlib is imported on first
+    use, so only processes that hash or verify passwords pay for loading it.
+    """
+    global _hasher
+    if _hasher is None:
+        from passlib.hash import pbkdf2_sha256
+
+        _hasher = pbkdf2_sha256.using(rounds=PBKDF2_ROUNDS)
+    return _hasher
+
+
+# Function to hash a password
+def hash_password(password: str) -> str:
+    """
+    Hash a plain text password with the configured PBKDF2 cost.
+    """
+    return get_hasher().hash(password)
+
+
+# Function to verify password hash
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """
+    Verify that the plain text password matches the hashed password.
+    Returns:
+        bool: True if the plain text password matches the hashed password, False otherwise.
+    """
+    return get_hasher().verify(plain_password, hashed_password)
+
+
+# Function to check whether a stored hash uses an outdated cost
+def needs_rehash(hashed_password: str) -> bool:
+    return get_hasher().needs_update(hashed_password)
+
+
+# Cache of recently verified credentials
+class CredentialCache:
+    """
+    Bounded LRU cache of credentials that were verified recently, so repeated logins
+    skip the key derivation.
+
+    Entries are keyed by username and an HMAC of the submitted password under a
+    per-process random key, so plain text passwords are never kept in memory and the
+    digests are useless outside this process. An entry also remembers the hash it was
+    verified against, so changing a user's password invalidates it.
+    """
+
+    def __init__(self, maxsize: int = CREDENTIAL_CACHE_SIZE, ttl: float = CREDENTIAL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._key = os.urandom(32)
+        self._entries: "OrderedDict[Tuple[str, bytes], Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _cache_key(self, username: str, password: str) -> Tuple[str, bytes]:
+        return username, hmac.new(self._key, password.encode(), hashlib.sha256).digest()
+
+    def check(self, username: str, password: str, hashed_password: str) -> bool:
+        """
+        Returns True if these credentials were verified against `hashed_password`
+        within the last `ttl` seconds.
+        """
+        if self.maxsize <= 0:
+            return False
+        key = self._cache_key(username, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False
+            cached_hash, expires = entry
+            if expires <= time.monotonic() or not hmac.compare_digest(cached_hash, hashed_password):
+                del self._entries[key]
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, username: str, password: str, hashed_password: str) -> None:
+        """
+        Remembers credentials that were just verified against `hashed_password`.
+        """
+        if self.maxsize <= 0:
+            return
+        key = self._cache_key(username, password)
+        with self._lock:
+            self._entries[key] = (hashed_password, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+credential_cache = CredentialCache()
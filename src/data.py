@@ -1,30 +1,35 @@
-# Users database
-users_db = {
-    "wookie1": {
+import os
+
+from aio import AsyncRepository
+from store import BookStore, UserStore
+from app_constants import (STORAGE_BACKEND, SQLITE_PATH, SQLITE_POOL_SIZE, CATALOG_PATH,
+                           SESSION_BACKEND, SESSION_DB_PATH, SESSION_CACHE_TTL, WAL_DIR)
+
+# Seed users
+# Passwords are stored pre-hashed (pbkdf2_sha256), so nothing is derived at load or login time
+_seed_users = [
+    {
         "username": "wookie1",
         "full_name": "Chewbacca",
         "email": "chewie@kashyyyk.com",
-        "password": "wookie1@123",
-        "active": False,
+        "hashed_password": "$pbkdf2-sha256$29000$F4KQktKac875X8vZ.59zrg$hvznzRJsfJFTII/bItJn2LSQjTGSdnEm2tr0dIVm1u0",
     },
-    "wookie2": {
+    {
         "username": "wookie2",
         "full_name": "Lohgarra",
         "email": "lohg@kashyyyk.com",
-        "password": "wookie2@123",
-        "active": False,
+        "hashed_password": "$pbkdf2-sha256$29000$jTFGCIGwdu4dI8R4zxljDA$Dp7IVZwsa6.HNLesyXbOaiNLeeKZjHbaHIOKTvidL7g",
     },
-    "vader": {
+    {
         "username": "vader",
         "full_name": "Darth Vader",
         "email": "vader@empire.com",
-        "password": "vader@123",
-        "active": False,
+        "hashed_password": "$pbkdf2-sha256$29000$srY25pxzjhGidK7Vem.t1Q$pKgfCld06qsvO5i8PDXezuYvFb2OwvmkKqTjsHMkPIE",
     },
-}
+]
 
-# Books database
-books_db = [
+# Seed books
+_seed_books = [
     {
         "id": 1,
         "title": "The Big Adventure",
@@ -52,4 +57,56 @@ books_db = [
         "price": 12.99,
         "published": False,
     },
-]
\ No newline at end of file
+]
+
+
+# Users and books databases
+if STORAGE_BACKEND == "sqlite":
+    from sqlite_store import SQLiteBookStore, SQLiteDatabase, SQLiteUserStore
+
+    database = SQLiteDatabase(SQLITE_PATH, pool_size=SQLITE_POOL_SIZE)
+    users_db = SQLiteUserStore(database, seed=_seed_users)
+    books_db = SQLiteBookStore(database, seed=_seed_books)
+elif STORAGE_BACKEND in ("memory", "compact"):
+    if STORAGE_BACKEND == "compact":
+        from compact_store import CompactBookStore as book_store_class
+    else:
+        book_store_class = BookStore
+
+    if WAL_DIR:
+        # restored from the last snapshot and the log after it
+        from wal import DurableBookStore, DurableUserStore
+
+        users_db = DurableUserStore(os.path.join(WAL_DIR, "users"), UserStore, seed=_seed_users)
+        books_db = DurableBookStore(os.path.join(WAL_DIR, "books"), book_store_class, seed=_seed_books)
+    else:
+        users_db = UserStore(_seed_users)
+        books_db = book_store_class(_seed_books)
+elif STORAGE_BACKEND == "mapped":
+    from mapped_store import MappedBookStore, export_catalog
+
+    if not os.path.exists(CATALOG_PATH):
+        export_catalog(BookStore(_seed_books), CATALOG_PATH)
+    users_db = UserStore(_seed_users)
+    books_db = MappedBookStore(CATALOG_PATH)
+else:
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND!r}")
+
+# Login sessions
+if SESSION_BACKEND == "sqlite":
+    from sessions import SQLiteSessionStore
+    from sqlite_store import SQLiteDatabase
+
+    sessions_db = SQLiteSessionStore(SQLiteDatabase(SESSION_DB_PATH, pool_size=SQLITE_POOL_SIZE),
+                                     cache_ttl=SESSION_CACHE_TTL)
+elif SESSION_BACKEND == "memory":
+    from sessions import MemorySessionStore
+
+    sessions_db = MemorySessionStore()
+else:
+    raise ValueError(f"Unknown SESSION_BACKEND: {SESSION_BACKEND!r}")
+
+# Awaitable views of the databases, for async routes
+async_users_db = AsyncRepository(users_db, workers=SQLITE_POOL_SIZE)
+async_books_db = AsyncRepository(books_db, workers=SQLITE_POOL_SIZE)
+async_sessions_db = AsyncRepository(sessions_db, workers=SQLITE_POOL_SIZE)
@@ -0,0 +1,132 @@
+from typing import Any, Dict, Iterable, List, Tuple
+import json
+
+from app_constants import BLOB_CACHE_SIZE
+from metrics import timed
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is used instead
+    orjson = None
+
+JSON, XML = "json", "xml"
+
+# xmlstream is imported where XML is produced: the standard library's XML escaping
+# pulls in urllib and much of the http stack, which JSON-only workers never need
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Encodes content as compact UTF-8 JSON, with orjson when it is installed.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(content)
+        except TypeError:
+            # e.g. non-string dict keys, which orjson refuses
+            pass
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# A list of book records, whose items may be encoded from cached blobs
+class BookList(list):
+    """
+    Marks a list of book records in response content. Encoding it joins the
+    pre-encoded blob of every book instead of walking each record again. Anywhere
+    else it is an ordinary list.
+    """
+
+
+# Cache of encoded books
+class BlobCache:
+    """
+    The JSON and XML encoding of recently served books, keyed by book ID and
+    format. Each blob is stored with the record it was encoded from and only used
+    while the record being served is equal to it, so an updated book is never
+    served stale, whatever the storage backend. The cache is emptied when full.
+    """
+
+    def __init__(self, maxsize: int = BLOB_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._blobs: Dict[Tuple[Any, str], Tuple[dict, bytes]] = {}
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+    def encode(self, book: dict, fmt: str) -> bytes:
+        key = (book["id"], fmt)
+        entry = self._blobs.get(key)
+        if entry is not None and (entry[0] is book or entry[0] == book):
+            return entry[1]
+        if fmt == XML:
+            import xmlstream
+
+            blob = xmlstream.item_xml(book).encode()
+        else:
+            blob = dumps(book)
+        if self.maxsize > 0:
+            if len(self._blobs) >= self.maxsize:
+                self._blobs.clear()
+            self._blobs[key] = (book, blob)
+        return blob
+
+    def clear(self) -> None:
+        self._blobs.clear()
+
+
+blob_cache = BlobCache()
+
+
+def encode_books(books: Iterable[dict], fmt: str) -> List[bytes]:
+    if fmt == JSON and orjson is not None:
+        return [orjson.dumps(book) for book in books]
+    return [blob_cache.encode(book, fmt) for book in books]
+
+
+def _render_with_blobs(content: dict, fmt: str) -> bytes:
+    if fmt == XML:
+        import xmlstream
+
+        parts = [f"{xmlstream.XML_DECLARATION}<{xmlstream.ROOT}>".encode()]
+        for key, value in content.items():
+            if type(value) is BookList:
+                parts.append(xmlstream.open_tag(key, "list").encode())
+                parts.extend(encode_books(value, XML))
+                parts.append(xmlstream.close_tag(key).encode())
+            else:
+                parts.append(xmlstream.element(key, value).encode())
+        parts.append(f"</{xmlstream.ROOT}>".encode())
+        return b"".join(parts)
+
+    parts = []
+    for key, value in content.items():
+        if type(value) is BookList:
+            parts.append(dumps(key) + b":[" + b",".join(encode_books(value, JSON)) + b"]")
+        else:
+            parts.append(dumps(key) + b":" + dumps(value))
+    return b"{" + b",".join(parts) + b"}"
+
+
+def render(content: Any, fmt: str) -> bytes:
+    """
+    Encodes response content in the given format. Dicts holding a `BookList` are
+    assembled from per-book blobs (except for JSON when orjson is installed); the
+    result is the same as encoding the records.
+    """
+    with timed("serialize"):
+        # orjson encodes whole records faster than blobs can be looked up and joined
+        if (fmt == XML or orjson is None) and type(content) is dict \
+                and any(type(value) is BookList for value in content.values()):
+            return _render_with_blobs(content, fmt)
+        if fmt == XML:
+            import xmlstream
+
+            return xmlstream.to_xml(content)
+        return dumps(content)
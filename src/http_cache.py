@@ -0,0 +1,308 @@
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Set, Tuple
+import asyncio
+import threading
+
+from fastapi import Request, Response
+
+from aio import offload
+from app_constants import (COMPRESSION_MIN_SIZE, OFFLOAD_MIN_BOOKS, OFFLOAD_MIN_BYTES, RESPONSE_CACHE_SIZE,
+                           RESPONSE_CACHE_MAX_BYTES)
+from compression import compress, response_encoding, weak_etag
+from metrics import timed
+from encoding import BookList, render
+from negotiation import current_format, media_type
+
+
+def make_etag(tag: str, revision: int, fmt: str) -> str:
+    """
+    Builds a strong ETag for one representation of a resource: JSON and XML bodies
+    of the same revision are different representations, so they get different tags.
+    """
+    return f'"{tag}.{revision}.{fmt}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks an If-None-Match header against an ETag, using the weak comparison
+    RFC 9110 requires for this header.
+    """
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def revision_matches(if_match: str, tag: str, revision: int) -> bool:
+    """
+    Checks an If-Match header against the current revision of a resource, using the
+    strong comparison RFC 9110 requires for this header (weak tags never match). The
+    ETag of any representation of that revision matches, since JSON and XML bodies
+    of a revision hold the same state.
+    """
+    if if_match.strip() == "*":
+        return True
+    for candidate in if_match.split(","):
+        candidate = candidate.strip()
+        if len(candidate) < 2 or candidate[0] != '"' or candidate[-1] != '"':
+            continue
+        name, _, rest = candidate[1:-1].partition(".")
+        if name == tag and rest.partition(".")[0] == str(revision):
+            return True
+    return False
+
+
+def is_not_modified(request: Request, etag: str, modified: float) -> bool:
+    """
+    Evaluates the request's preconditions. If-None-Match takes precedence; the
+    If-Modified-Since date is only looked at when it is absent.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def book_tag(book_id: int) -> str:
+    # names a book in its ETag and tags its cached bodies; listings and searches use "books"
+    return f"book{book_id}"
+
+
+def cache_headers(etag: str, modified: float) -> Dict[str, str]:
+    # no-cache: clients may store the response but must revalidate it every time
+    return {"ETag": etag, "Last-Modified": formatdate(modified, usegmt=True), "Cache-Control": "no-cache"}
+
+
+# Cache of encoded response bodies
+class ResponseCache:
+    """
+    LRU cache of encoded response bodies, bounded by entry count and total size.
+
+    Each body is stored with the ETag it was rendered for and is only served while
+    the caller's current ETag is the same. ETags carry the catalog version or the
+    book revision, so a write makes the affected entries unusable even in workers
+    that didn't see it. Entries are also tagged with the resource they belong to,
+    so the worker doing a write drops them right away (`invalidate`) instead of
+    leaving them to age out of the LRU.
+    """
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[str, bytes, str]]" = OrderedDict()
+        self._tagged: Dict[str, Set[Hashable]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, etag: str, count: bool = True) -> Optional[bytes]:
+        """
+        Returns the body cached under `key` if it was rendered for `etag`. With
+        `count` false the lookup isn't counted as a hit or miss, for callers looking
+        up several bodies for one request and recording its outcome once.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            hit = entry is not None and entry[0] == etag
+            if hit:
+                self._entries.move_to_end(key)
+            if count:
+                self._record(hit)
+            return entry[1] if hit else None
+
+    def record(self, hit: bool) -> None:
+        with self._lock:
+            self._record(hit)
+
+    def _record(self, hit: bool) -> None:
+        # called with the lock held
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def put(self, key: Hashable, etag: str, body: bytes, tag: str = "") -> None:
+        if self.maxsize <= 0 or len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (etag, body, tag)
+            self._tagged.setdefault(tag, set()).add(key)
+            self._size += len(body)
+            while len(self._entries) > self.maxsize or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *tags: str) -> None:
+        """
+        Drops every entry tagged with one of `tags`.
+        """
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tagged.get(tag, ())):
+                    self._remove(key)
+
+    def _remove(self, key: Hashable) -> None:
+        # called with the lock held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+            keys = self._tagged[entry[2]]
+            keys.discard(key)
+            if not keys:
+                del self._tagged[entry[2]]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tagged.clear()
+            self._size = 0
+
+
+response_cache = ResponseCache()
+
+
+def invalidate_books(book_ids: Iterable[int] = ()) -> None:
+    """
+    Drops the cached bodies a write made stale: every listing and search, and the
+    given books.
+    """
+    response_cache.invalidate("books", *(book_tag(book_id) for book_id in book_ids))
+
+
+# Concurrent computations of the same result, run once
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first one starts the
+    computation, the others wait for its outcome (result or exception) instead of
+    starting their own. Once it is done the next call computes again.
+
+    The computation runs as its own task, so a caller that is cancelled (e.g. its
+    client disconnected) doesn't cancel it for the others. Flights are tied to the
+    event loop they were started on.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        loop = asyncio.get_running_loop()
+        key = (loop, key)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = loop.create_task(compute())
+            flight.add_done_callback(lambda task: self._land(key, task))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(flight)
+
+    def _land(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # marks the exception as retrieved, in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+
+flights = SingleFlight()
+
+
+def book_count(content: Any) -> int:
+    # number of books in response content, to tell a page from a single book
+    if type(content) is dict:
+        return sum(len(value) for value in content.values() if type(value) is BookList)
+    return 0
+
+
+# Function to answer a GET from the validators, the response cache or a fresh render
+async def cached_response(request: Request, key: Hashable, tag: str, revision: Tuple[int, float],
+                          produce: Callable[[], Awaitable[Any]],
+                          current: Callable[[], Awaitable[Optional[Tuple[int, float]]]]) -> Response:
+    """
+    Answers a conditional GET. Large bodies are rendered and compressed on the
+    threadpool, small ones on the event loop, which is cheaper than the hop.
+    Concurrent misses for the same body and ETag are coalesced: one caller produces
+    (or compresses) it and the others await its result.
+    Args:
+        key (Hashable): Identifies the response body, e.g. the path and query parameters.
+        tag (str): Names the resource in its ETag, and tags its cached bodies.
+        revision (Tuple[int, float]): The resource's revision and last-modified time,
+            read before `produce` runs.
+        produce (Callable): Coroutine function returning the response content; only
+            called on a cache miss.
+        current (Callable): Coroutine function re-reading the revision. A body is only cached if the revision
+            didn't change while it was produced, so a cached body is never newer or
+            older than its ETag.
+    Returns:
+        Response: 304 if the client's copy is current, otherwise the encoded body,
+            compressed with the negotiated content coding if it is large enough.
+            Compressed bodies are cached too, so identical payloads are compressed once.
+    """
+    fmt = current_format()
+    etag = make_etag(tag, revision[0], fmt)
+    headers = cache_headers(etag, revision[1])
+    if is_not_modified(request, etag, revision[1]):
+        return Response(status_code=304, headers=headers)
+
+    # a request counts as one hit if either the compressed or the plain body is
+    # cached, otherwise as one miss
+    encoding = response_encoding.get()
+    if encoding is not None:
+        body = response_cache.get((key, fmt, encoding), etag, count=False)
+        if body is not None:
+            response_cache.record(True)
+            return _compressed_response(body, fmt, encoding, headers)
+
+    async def render_body() -> bytes:
+        with timed("lookup"):
+            content = await produce()
+        if book_count(content) >= OFFLOAD_MIN_BOOKS:
+            body = await offload(render, content, fmt)
+        else:
+            body = render(content, fmt)
+        if await current() == revision:
+            response_cache.put((key, fmt), etag, body, tag)
+        return body
+
+    async def compress_body() -> bytes:
+        if len(body) >= OFFLOAD_MIN_BYTES:
+            compressed = await offload(compress, body, encoding)
+        else:
+            compressed = compress(body, encoding)
+        if await current() == revision:
+            response_cache.put((key, fmt, encoding), etag, compressed, tag)
+        return compressed
+
+    body = response_cache.get((key, fmt), etag, count=False)
+    response_cache.record(body is not None)
+    if body is None:
+        body = await flights.run((key, fmt, etag), render_body)
+
+    if encoding is not None and len(body) >= COMPRESSION_MIN_SIZE:
+        compressed = await flights.run((key, fmt, encoding, etag), compress_body)
+        return _compressed_response(compressed, fmt, encoding, headers)
+    return Response(content=body, media_type=media_type(fmt), headers=headers)
+
+
+def _compressed_response(body: bytes, fmt: str, encoding: str, headers: Dict[str, str]) -> Response:
+    headers = {**headers, "ETag": weak_etag(headers["ETag"]), "Content-Encoding": encoding}
+    return Response(content=body, media_type=media_type(fmt), headers=headers)
@@ -0,0 +1,396 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import base64
+import binascii
+import json
+import math
+import string
+
+# Orders `BookRepository.find` can return books in; ties are broken by ID
+SORT_FIELDS = ("id", "price", "title")
+
+# Titles sort case-insensitively for ASCII letters only, like SQLite's NOCASE collation,
+# so every backend returns the same order
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# A position in a sort order: (sort key, book ID)
+Position = Tuple[Any, int]
+
+# Batches larger than this are indexed in one pass instead of book by book
+BULK_THRESHOLD = 64
+
+# Values per block of a `SortedList`; blocks split at twice this and are merged into
+# a neighbour below half of it
+BLOCK_SIZE = 1000
+
+
+def title_key(title: str) -> str:
+    return title.translate(_ASCII_LOWER)
+
+
+def sort_key(book: dict, sort: str) -> Position:
+    """
+    Returns the position of a book in the given order.
+    """
+    if sort == "title":
+        return title_key(book["title"]), book["id"]
+    return book[sort], book["id"]
+
+
+def book_matches(book: dict, author: Optional[str] = None, published: Optional[bool] = None,
+                 price_min: Optional[float] = None, price_max: Optional[float] = None) -> bool:
+    """
+    Checks a book against the filters of `BookRepository.find`; None means any.
+    """
+    return ((author is None or book["author"] == author)
+            and (published is None or book["published"] == published)
+            and (price_min is None or book["price"] >= price_min)
+            and (price_max is None or book["price"] <= price_max))
+
+
+# Cursors of sorted listings
+def encode_position(position: Position) -> str:
+    """
+    Encodes a position as an opaque, URL-safe cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(position)).encode()).decode().rstrip("=")
+
+
+def decode_position(cursor: str, sort: str) -> Optional[Position]:
+    """
+    Decodes a cursor made by `encode_position` for the given order.
+    Returns:
+        Optional[Position]: The position, or None if the cursor is malformed.
+    """
+    try:
+        key, book_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError, TypeError):
+        return None
+    if type(book_id) is not int:
+        return None
+    if sort == "title":
+        return (key, book_id) if isinstance(key, str) else None
+    if sort == "price" and type(key) in (int, float) and math.isfinite(key):
+        return float(key), book_id
+    return None
+
+
+# Set of book IDs stored as bits
+class Bitmap:
+    """
+    Set of integers stored one bit each, in chunks of 2^16 bits so sparse (or
+    negative) IDs only cost the chunks they fall in.
+    """
+
+    CHUNK_BITS = 16
+
+    def __init__(self):
+        self._chunks: Dict[int, int] = {}
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, value: int) -> bool:
+        return self._chunks.get(value >> self.CHUNK_BITS, 0) >> (value & 0xFFFF) & 1 == 1
+
+    def add(self, value: int) -> None:
+        chunk = value >> self.CHUNK_BITS
+        bits = self._chunks.get(chunk, 0)
+        bit = 1 << (value & 0xFFFF)
+        if not bits & bit:
+            self._chunks[chunk] = bits | bit
+            self._count += 1
+
+    def discard(self, value: int) -> None:
+        chunk = value >> self.CHUNK_BITS
+        bits = self._chunks.get(chunk, 0)
+        bit = 1 << (value & 0xFFFF)
+        if bits & bit:
+            bits ^= bit
+            if bits:
+                self._chunks[chunk] = bits
+            else:
+                del self._chunks[chunk]
+            self._count -= 1
+
+
+# Sorted sequence with O(log n) updates
+class SortedList:
+    """
+    Sorted sequence kept in blocks of about BLOCK_SIZE values, with the largest key
+    of every block alongside and a Fenwick tree of the block lengths.
+
+    Adding or removing a value bisects the block maxima and shifts one block, instead
+    of half of one flat list; positions (for counts, and walks from a bisection) are
+    a walk down the tree. `key` orders the values by a key of each, as with `bisect`,
+    and bisections take keys; keys must be unique. `block` makes a block out of a
+    list, e.g. to keep the values in typed arrays.
+    """
+
+    def __init__(self, values: Iterable[Any] = (), key: Optional[Callable[[Any], Any]] = None,
+                 block: Callable[[List[Any]], Any] = list):
+        self._key = key
+        self._block = block
+        self._blocks: List[Any] = []
+        self._maxes: List[Any] = []
+        self._tree: List[int] = [0]
+        self._len = 0
+        self._build(sorted(values, key=key))
+
+    @classmethod
+    def from_sorted(cls, values: List[Any], key: Optional[Callable[[Any], Any]] = None,
+                    block: Callable[[List[Any]], Any] = list) -> "SortedList":
+        """
+        Makes a list out of values already in order, without sorting them again.
+        """
+        result = cls(key=key, block=block)
+        result._build(values)
+        return result
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[Any]:
+        for block in self._blocks:
+            yield from block
+
+    def _key_of(self, value: Any) -> Any:
+        return value if self._key is None else self._key(value)
+
+    def _build(self, values: List[Any]) -> None:
+        """
+        Replaces the contents with already sorted values.
+        """
+        self._blocks = [self._block(values[i:i + BLOCK_SIZE]) for i in range(0, len(values), BLOCK_SIZE)]
+        self._maxes = [self._key_of(block[-1]) for block in self._blocks]
+        self._len = len(values)
+        self._reindex()
+
+    # Fenwick tree of block lengths
+    def _reindex(self) -> None:
+        # rebuilt in linear time whenever blocks are split or merged, which is rare
+        tree = [0] * (len(self._blocks) + 1)
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _resize(self, b: int, delta: int) -> None:
+        tree = self._tree
+        b += 1
+        while b < len(tree):
+            tree[b] += delta
+            b += b & -b
+        self._len += delta
+
+    def _offset(self, b: int) -> int:
+        # number of values in the blocks before block b
+        tree = self._tree
+        total = 0
+        while b:
+            total += tree[b]
+            b -= b & -b
+        return total
+
+    def _locate(self, index: int) -> Tuple[int, int]:
+        # block and offset in it of the value at a position
+        tree = self._tree
+        b = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            if b + step < len(tree) and tree[b + step] <= index:
+                b += step
+                index -= tree[b]
+            step >>= 1
+        return b, index
+
+    # Updates
+    def add(self, value: Any) -> None:
+        key = self._key_of(value)
+        blocks, maxes = self._blocks, self._maxes
+        if not blocks:
+            self._build([value])
+            return
+        b = bisect_right(maxes, key)
+        if b == len(blocks):
+            b -= 1
+            blocks[b].append(value)
+            maxes[b] = key
+        else:
+            insort(blocks[b], value, key=self._key)
+        self._resize(b, 1)
+        if len(blocks[b]) > 2 * BLOCK_SIZE:
+            block = blocks[b]
+            blocks[b:b + 1] = [block[:BLOCK_SIZE], block[BLOCK_SIZE:]]
+            maxes.insert(b, self._key_of(block[BLOCK_SIZE - 1]))
+            self._reindex()
+
+    def remove(self, value: Any) -> None:
+        """
+        Raises:
+            ValueError: If no value has the key of `value`.
+        """
+        key = self._key_of(value)
+        blocks, maxes = self._blocks, self._maxes
+        b = bisect_left(maxes, key)
+        if b == len(blocks):
+            raise ValueError(value)
+        block = blocks[b]
+        i = bisect_left(block, key, key=self._key)
+        if i == len(block) or self._key_of(block[i]) != key:
+            raise ValueError(value)
+        del block[i]
+        self._resize(b, -1)
+        if len(block) >= BLOCK_SIZE // 2 or len(blocks) == 1:
+            if block and i == len(block):
+                maxes[b] = self._key_of(block[-1])
+            elif not block:
+                del blocks[b], maxes[b]
+                self._reindex()
+            return
+        # merge the block into a neighbour, and split the result again if too big
+        if b == len(blocks) - 1:
+            b -= 1
+        merged = blocks[b] + blocks[b + 1]
+        parts = [merged] if len(merged) <= 2 * BLOCK_SIZE else [merged[:BLOCK_SIZE], merged[BLOCK_SIZE:]]
+        blocks[b:b + 2] = parts
+        maxes[b:b + 2] = [self._key_of(part[-1]) for part in parts]
+        self._reindex()
+
+    def update(self, values: List[Any]) -> None:
+        # small batches go in one by one, big ones (relative to the list) in one
+        # sort, which timsort does in linear time for the part already in order
+        if len(values) * 16 < self._len:
+            for value in values:
+                self.add(value)
+        else:
+            self._build(sorted([*self, *values], key=self._key))
+
+    def remove_many(self, values: List[Any]) -> None:
+        """
+        Removes values, compared by equality for big batches.
+        """
+        if len(values) * 16 < self._len:
+            for value in values:
+                self.remove(value)
+        else:
+            removed = set(values)
+            self._build([value for value in self if value not in removed])
+
+    # Lookups
+    def bisect_left(self, key: Any) -> int:
+        b = bisect_left(self._maxes, key)
+        if b == len(self._blocks):
+            return self._len
+        return self._offset(b) + bisect_left(self._blocks[b], key, key=self._key)
+
+    def bisect_right(self, key: Any) -> int:
+        b = bisect_right(self._maxes, key)
+        if b == len(self._blocks):
+            return self._len
+        return self._offset(b) + bisect_right(self._blocks[b], key, key=self._key)
+
+    def lookup(self, key: Any, default: Any = None) -> Any:
+        """
+        Returns the value with the given key, or `default` if there is none.
+        """
+        b = bisect_left(self._maxes, key)
+        if b == len(self._blocks):
+            return default
+        block = self._blocks[b]
+        i = bisect_left(block, key, key=self._key)
+        return block[i] if i < len(block) and self._key_of(block[i]) == key else default
+
+    def islice(self, start: int, stop: int, descending: bool = False) -> Iterator[Any]:
+        """
+        Yields the values at positions `start` to `stop` (exclusive), last first
+        when descending.
+        """
+        start, stop = max(start, 0), min(stop, self._len)
+        if start >= stop:
+            return
+        blocks = self._blocks
+        if descending:
+            b, i = self._locate(stop - 1)
+            remaining = stop - start
+            while remaining:
+                block = blocks[b]
+                taken = min(i + 1, remaining)
+                yield from reversed(block[i + 1 - taken:i + 1])
+                remaining -= taken
+                b -= 1
+                i = len(blocks[b]) - 1
+        else:
+            b, i = self._locate(start)
+            remaining = stop - start
+            while remaining:
+                block = blocks[b]
+                taken = min(len(block) - i, remaining)
+                yield from block[i:i + taken]
+                remaining -= taken
+                b += 1
+                i = 0
+
+    def blocks(self) -> List[Any]:
+        """
+        Returns the blocks, in order; they must not be modified.
+        """
+        return self._blocks
+
+
+# Secondary index of books sorted by one field
+class SortedIndex:
+    """
+    Sorted list of (key, book ID) positions. Walking it yields books in key order
+    from any position, optionally bounded to a key range, without looking at the
+    books outside it.
+    """
+
+    def __init__(self):
+        self._positions = SortedList()
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def add(self, key: Any, book_id: int) -> None:
+        self._positions.add((key, book_id))
+
+    def remove(self, key: Any, book_id: int) -> None:
+        self._positions.remove((key, book_id))
+
+    def add_many(self, positions: List[Position]) -> None:
+        self._positions.update(positions)
+
+    def remove_many(self, positions: List[Position]) -> None:
+        self._positions.remove_many(positions)
+
+    def _bounds(self, lo: Optional[Any], hi: Optional[Any]) -> Tuple[int, int]:
+        positions = self._positions
+        start = 0 if lo is None else positions.bisect_left((lo,))
+        stop = len(positions) if hi is None else positions.bisect_right((hi, math.inf))
+        return start, stop
+
+    def count(self, lo: Optional[Any] = None, hi: Optional[Any] = None) -> int:
+        """
+        Returns the number of books whose key is between `lo` and `hi`, inclusive.
+        """
+        start, stop = self._bounds(lo, hi)
+        return max(stop - start, 0)
+
+    def walk(self, after: Optional[Position] = None, descending: bool = False,
+             lo: Optional[Any] = None, hi: Optional[Any] = None) -> Iterator[Position]:
+        """
+        Yields the positions after `after` (before it when descending) whose key
+        is between `lo` and `hi`.
+        """
+        positions = self._positions
+        start, stop = self._bounds(lo, hi)
+        if after is not None:
+            if descending:
+                stop = min(stop, positions.bisect_left(after))
+            else:
+                start = max(start, positions.bisect_right(after))
+        return positions.islice(start, stop, descending)
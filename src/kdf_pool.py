@@ -0,0 +1,75 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+import asyncio
+
+from app_constants import KDF_EXECUTOR, KDF_WORKERS, KDF_MAX_PENDING, KDF_RETRY_AFTER
+
+
+class PoolSaturated(Exception):
+    """
+    Raised when the pool already has `max_pending` jobs running or queued.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Password hashing pool is saturated, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+# Bounded executor for key derivation work
+class KdfPool:
+    """
+    Runs CPU-heavy password hashing off the event loop, on a dedicated executor so it
+    never competes with the threadpool serving sync routes.
+
+    Admission is bounded: once `max_pending` jobs are running or queued, new jobs are
+    rejected with `PoolSaturated` instead of piling up behind the workers. The pending
+    counter is only touched from the event loop, so it needs no lock.
+    """
+
+    def __init__(self, kind: str = KDF_EXECUTOR, workers: int = KDF_WORKERS,
+                 max_pending: int = KDF_MAX_PENDING, retry_after: int = KDF_RETRY_AFTER):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown KDF executor kind: {kind!r}")
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pending = 0
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        # created on first use, so importing the app doesn't spawn workers (nor load
+        # the multiprocessing machinery)
+        if self._executor is None:
+            if self.kind == "process":
+                from concurrent.futures import ProcessPoolExecutor
+                import multiprocessing
+
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="kdf")
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        Runs `fn(*args)` on the pool and waits for the result.
+        Raises:
+            PoolSaturated: If too many jobs are already pending.
+        """
+        if self.pending >= self.max_pending:
+            raise PoolSaturated(self.retry_after)
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+kdf_pool = KdfPool()
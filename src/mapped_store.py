@@ -0,0 +1,515 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from itertools import islice
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import argparse
+import heapq
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from indexes import Position, sort_key, title_key
+from search import fold
+from store import BookRepository, BookStore, RevisionConflict, first_duplicate
+from wal import fsync_directory
+
+# Catalog files start with this
+MAGIC = b"BKCAT001"
+
+# Sections of a catalog file, in file order; each starts at a multiple of 8 bytes
+SECTIONS = ("records", "ids", "price_order", "title_order", "author_order", "authors", "heap",
+            "title_arena", "title_segments", "author_arena", "author_segments",
+            "description_arena", "description_segments")
+
+# Fields searched through the folded arenas, best match first
+SEARCH_FIELDS = ("title", "author", "description")
+
+# Header: magic, number of books and of authors, catalog version, then the offset
+# and length of every section
+_HEADER = struct.Struct("<8sQQqd" + "QQ" * len(SECTIONS))
+
+# A book: id, price, revision, last modified, offset of its text in the heap (title,
+# description and cover image back to back), their lengths (-1 for no cover image),
+# author number and published flag. Records are stored in ID order.
+_RECORD = struct.Struct("<qdqdQIIiIB7x")
+_PRICE = struct.Struct("<d")
+_PRICE_AT = 8
+_PUBLISHED_AT = 56
+
+# An author, in name order: offset and length of the name in the heap, and where
+# their books start in the author order (books of one author are in ID order).
+# A last entry marks the end of the author order.
+_AUTHOR = struct.Struct("<QII")
+
+# Separates the values in a search arena, so a match never spans two values
+_SEPARATOR = b"\x00"
+
+
+def _arena(values: Iterable[str]) -> Tuple[bytearray, array]:
+    # folded values back to back, and where each starts (plus where the last ends)
+    arena, segments = bytearray(), array("Q")
+    for value in values:
+        segments.append(len(arena))
+        arena += fold(value).encode().replace(_SEPARATOR, b"")
+        arena += _SEPARATOR
+    segments.append(len(arena))
+    return arena, segments
+
+
+def export_catalog(repository: BookRepository, path: str) -> None:
+    """
+    Writes the books of a repository, with their revisions, to a catalog file for
+    `MappedBookStore`. The file is written aside and renamed over `path`, so
+    processes that have the old catalog mapped keep reading it unchanged.
+    """
+    version = repository.version()
+    books = list(repository)
+    revisions = [repository.revision(book["id"]) or version for book in books]
+    count = len(books)
+
+    names = sorted({book["author"] for book in books})
+    author_of = {name: number for number, name in enumerate(names)}
+    heap = bytearray()
+    records = bytearray(count * _RECORD.size)
+    for slot, (book, (revision, modified)) in enumerate(zip(books, revisions)):
+        title = book["title"].encode()
+        description = book["description"].encode()
+        cover = book.get("cover_image")
+        cover = None if cover is None else cover.encode()
+        _RECORD.pack_into(records, slot * _RECORD.size, book["id"], float(book["price"]), revision, modified,
+                          len(heap), len(title), len(description), -1 if cover is None else len(cover),
+                          author_of[book["author"]], 1 if book["published"] else 0)
+        heap += title
+        heap += description
+        heap += cover or b""
+
+    books_by_author = Counter(book["author"] for book in books)
+    authors = bytearray()
+    first = 0
+    for name in names:
+        encoded = name.encode()
+        authors += _AUTHOR.pack(len(heap), len(encoded), first)
+        heap += encoded
+        first += books_by_author[name]
+    authors += _AUTHOR.pack(0, 0, first)
+
+    ids = array("q", [book["id"] for book in books])
+    sections = {
+        "records": records,
+        "ids": ids,
+        "price_order": array("i", sorted(range(count), key=lambda slot: (float(books[slot]["price"]), ids[slot]))),
+        "title_order": array("i", sorted(range(count), key=lambda slot: (title_key(books[slot]["title"]), ids[slot]))),
+        # a stable sort keeps each author's books in ID order
+        "author_order": array("i", sorted(range(count), key=lambda slot: author_of[books[slot]["author"]])),
+        "authors": authors,
+        "heap": heap,
+    }
+    for field in SEARCH_FIELDS:
+        arena, segments = _arena(names if field == "author" else (book[field] for book in books))
+        sections[f"{field}_arena"] = arena
+        sections[f"{field}_segments"] = segments
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(prefix=os.path.basename(path) + ".", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            extents = []
+            f.write(bytes(_HEADER.size))
+            for name in SECTIONS:
+                data = memoryview(sections[name]).cast("B")
+                f.write(bytes(-f.tell() % 8))
+                extents += [f.tell(), len(data)]
+                f.write(data)
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, count, len(names), version[0], version[1], *extents))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    fsync_directory(directory)
+
+
+# Book repository over a memory-mapped catalog file
+class MappedBookStore(BookRepository):
+    """
+    Book repository reading an immutable catalog file written by `export_catalog`,
+    memory-mapped read-only. Nothing is loaded at startup: records are read from the
+    mapping when asked for, so opening takes the same time at any catalog size, and
+    every process mapping the file shares one copy of it in the page cache.
+
+    Lookups bisect the ID array and unpack the fixed-width record in place; strings
+    are decoded straight from the mapped heap. Sort orders and the author order
+    are precomputed arrays of record numbers, and searches scan case-folded arenas
+    (title matches first, then author, then description matches, then by ID), like
+    `CompactBookStore`.
+
+    Writes go to an in-memory `BookStore` layered on top, holding books added or
+    changed since the export, while the IDs of the file's books that were deleted or
+    changed hide them. Like the memory backend, those writes belong to one process
+    and are lost on restart unless the catalog is exported again.
+    """
+
+    lock_free_methods = frozenset({"version"})
+
+    def __init__(self, path: str):
+        if sys.byteorder != "little":
+            raise ValueError("Catalog files can only be mapped on little-endian machines")
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _HEADER.size or self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a catalog file")
+        _, self._count, self._author_count, number, modified, *extents = _HEADER.unpack_from(self._map)
+        view = memoryview(self._map)
+        bounds = {name: (offset, offset + length)
+                  for name, offset, length in zip(SECTIONS, extents[::2], extents[1::2])}
+        if any(end > len(self._map) for _, end in bounds.values()):
+            raise ValueError(f"{path} is truncated")
+        sections = {name: view[start:end] for name, (start, end) in bounds.items()}
+        self._records = sections["records"]
+        self._ids = sections["ids"].cast("q")
+        self._slots = range(self._count)
+        self._price_order = sections["price_order"].cast("i")
+        self._title_order = sections["title_order"].cast("i")
+        self._author_order = sections["author_order"].cast("i")
+        self._authors = sections["authors"]
+        self._heap = sections["heap"]
+        self._arenas = {field: bounds[f"{field}_arena"] for field in SEARCH_FIELDS}
+        self._segments = {field: sections[f"{field}_segments"].cast("Q") for field in SEARCH_FIELDS}
+        self._author_names: Dict[int, str] = {}
+
+        # writes since the export: changed and added books, their revisions, and the
+        # IDs of the file's books they replace or delete
+        self._delta = BookStore()
+        self._revisions: Dict[int, Tuple[int, float]] = {}
+        self._hidden: Set[int] = set()
+        self._version: Tuple[int, float] = (number, modified)
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return self._count - len(self._hidden) + len(self._delta)
+
+    def __contains__(self, book_id: object) -> bool:
+        return book_id in self._revisions or self._slot(book_id) >= 0
+
+    # Records of the file
+    def _slot(self, book_id: object) -> int:
+        # the record number of a book of the file that is still current, or -1
+        if not isinstance(book_id, int) or book_id in self._hidden:
+            return -1
+        i = bisect_left(self._ids, book_id)
+        return i if i < self._count and self._ids[i] == book_id else -1
+
+    def _author_name(self, number: int) -> str:
+        name = self._author_names.get(number)
+        if name is None:
+            at, length, _ = _AUTHOR.unpack_from(self._authors, number * _AUTHOR.size)
+            name = self._author_names[number] = str(self._heap[at:at + length], "utf-8")
+        return name
+
+    def _author_slots(self, number: int) -> List[int]:
+        start = _AUTHOR.unpack_from(self._authors, number * _AUTHOR.size)[2]
+        stop = _AUTHOR.unpack_from(self._authors, (number + 1) * _AUTHOR.size)[2]
+        return [slot for slot in self._author_order[start:stop] if self._ids[slot] not in self._hidden]
+
+    def _author_number(self, author: str) -> int:
+        encoded = author.encode()
+        number = bisect_left(range(self._author_count), encoded, key=self._author_bytes)
+        return number if number < self._author_count and self._author_bytes(number) == encoded else -1
+
+    def _author_bytes(self, number: int) -> bytes:
+        at, length, _ = _AUTHOR.unpack_from(self._authors, number * _AUTHOR.size)
+        return self._heap[at:at + length].tobytes()
+
+    def _record(self, slot: int) -> dict:
+        book_id, price, _, _, at, title_length, description_length, cover_length, author, published = \
+            _RECORD.unpack_from(self._records, slot * _RECORD.size)
+        heap = self._heap
+        middle = at + title_length
+        end = middle + description_length
+        return {
+            "id": book_id,
+            "title": str(heap[at:middle], "utf-8"),
+            "description": str(heap[middle:end], "utf-8"),
+            "author": self._author_name(author),
+            "cover_image": None if cover_length < 0 else str(heap[end:end + cover_length], "utf-8"),
+            "price": price,
+            "published": bool(published),
+        }
+
+    # Reads
+    def get(self, book_id: int) -> Optional[dict]:
+        with self._lock:
+            book = self._delta.get(book_id)
+            if book is not None:
+                return book
+            slot = self._slot(book_id)
+            return self._record(slot) if slot >= 0 else None
+
+    def version(self) -> Tuple[int, float]:
+        return self._version
+
+    def revision(self, book_id: int) -> Optional[Tuple[int, float]]:
+        with self._lock:
+            revision = self._revisions.get(book_id)
+            if revision is not None:
+                return revision
+            slot = self._slot(book_id)
+            if slot < 0:
+                return None
+            return _RECORD.unpack_from(self._records, slot * _RECORD.size)[2:4]
+
+    def by_author(self, author: str) -> List[dict]:
+        with self._lock:
+            number = self._author_number(author)
+            books = [self._record(slot) for slot in self._author_slots(number)] if number >= 0 else []
+            return books + self._delta.by_author(author)
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[dict]:
+        needle = fold(query)
+        encoded = needle.encode()
+        if not encoded or _SEPARATOR in encoded:
+            return []
+        with self._lock:
+            # the delta is small: its books are checked one by one, like the arenas
+            changed = [(book["id"], {field: fold(book[field]) for field in SEARCH_FIELDS}) for book in self._delta]
+            seen: Set[int] = set()
+            ids: List[int] = []
+            for field in SEARCH_FIELDS:
+                if field == "author":
+                    slots = [slot for number in self._scan(field, encoded) for slot in self._author_slots(number)]
+                else:
+                    slots = [slot for slot in self._scan(field, encoded) if self._ids[slot] not in self._hidden]
+                matches = {self._ids[slot] for slot in slots}
+                matches.update(book_id for book_id, folded in changed if needle in folded[field])
+                matches = sorted(matches - seen)
+                seen.update(matches)
+                ids.extend(matches)
+                if limit is not None and len(ids) >= limit:
+                    break
+            return [self.get(book_id) for book_id in ids[:limit]]
+
+    def _scan(self, field: str, needle: bytes) -> List[int]:
+        # numbers of the values of an arena containing `needle`: records, or authors
+        start, end = self._arenas[field]
+        segments = self._segments[field]
+        found = []
+        position = self._map.find(needle, start, end)
+        while position != -1:
+            segment = bisect_right(segments, position - start) - 1
+            found.append(segment)
+            # the rest of this value can't add anything
+            position = self._map.find(needle, start + segments[segment + 1], end)
+        return found
+
+    def page(self, cursor: Optional[int] = None, limit: int = 100) -> Tuple[List[dict], Optional[int]]:
+        books, after = self.find(after=None if cursor is None else (cursor, cursor), limit=limit)
+        return books, (after[1] if after is not None else None)
+
+    def find(self, author: Optional[str] = None, published: Optional[bool] = None,
+             price_min: Optional[float] = None, price_max: Optional[float] = None,
+             sort: str = "id", descending: bool = False, after: Optional[Position] = None,
+             limit: int = 100) -> Tuple[List[dict], Optional[Position]]:
+        with self._lock:
+            key = self._sort_keys()[sort]
+            priced = price_min is not None or price_max is not None
+            # same plan as BookStore.find over the file's books: walk an order, or
+            # sort a small candidate set
+            candidates = None
+            if author is not None:
+                number = self._author_number(author)
+                candidates = self._author_slots(number) if number >= 0 else []
+            elif sort == "price":
+                walk = self._walk(self._price_order, key, after, descending, price_min, price_max)
+                priced = False
+            elif priced and self._count_between(self._price_order, self._price_key, price_min, price_max) ** 2 \
+                    <= limit * len(self):
+                candidates = list(self._walk(self._price_order, self._price_key, lo=price_min, hi=price_max))
+            elif sort == "title":
+                walk = self._walk(self._title_order, key, after, descending)
+            else:
+                walk = self._walk(self._slots, key, after, descending)
+
+            if candidates is not None:
+                candidates.sort(key=key, reverse=descending)
+                if after is not None:
+                    candidates = [slot for slot in candidates if (key(slot) < after if descending else key(slot) > after)]
+                walk = iter(candidates)
+
+            found = []
+            for slot in walk:
+                if self._ids[slot] in self._hidden:
+                    continue
+                if published is not None and self._published(slot) != published:
+                    continue
+                if priced and not ((price_min is None or self._price(slot) >= price_min)
+                                   and (price_max is None or self._price(slot) <= price_max)):
+                    continue
+                found.append((key(slot), slot))
+                if len(found) > limit:
+                    break
+
+            # then merge in the books written since (dicts, where the file's are record numbers)
+            changed, _ = self._delta.find(author, published, price_min, price_max, sort, descending, after, limit + 1)
+            merged = list(islice(heapq.merge(found, [(sort_key(book, sort), book) for book in changed],
+                                             key=itemgetter(0), reverse=descending), limit + 1))
+            books = [self._record(book) if isinstance(book, int) else book for _, book in merged[:limit]]
+            return books, (merged[limit - 1][0] if len(merged) > limit else None)
+
+    # Sort orders
+    def _price(self, slot: int) -> float:
+        return _PRICE.unpack_from(self._records, slot * _RECORD.size + _PRICE_AT)[0]
+
+    def _published(self, slot: int) -> bool:
+        return bool(self._records[slot * _RECORD.size + _PUBLISHED_AT])
+
+    def _id_key(self, slot: int) -> Position:
+        return self._ids[slot], self._ids[slot]
+
+    def _price_key(self, slot: int) -> Position:
+        return self._price(slot), self._ids[slot]
+
+    def _title_key(self, slot: int) -> Position:
+        at, length = _RECORD.unpack_from(self._records, slot * _RECORD.size)[4:6]
+        return title_key(str(self._heap[at:at + length], "utf-8")), self._ids[slot]
+
+    def _sort_keys(self) -> Dict[str, Callable[[int], Position]]:
+        return {"id": self._id_key, "price": self._price_key, "title": self._title_key}
+
+    @staticmethod
+    def _bounds(order, key: Callable[[int], Position], lo, hi) -> Tuple[int, int]:
+        start = 0 if lo is None else bisect_left(order, (lo,), key=key)
+        stop = len(order) if hi is None else bisect_right(order, (hi, math.inf), key=key)
+        return start, stop
+
+    def _count_between(self, order, key: Callable[[int], Position], lo, hi) -> int:
+        start, stop = self._bounds(order, key, lo, hi)
+        return max(stop - start, 0)
+
+    def _walk(self, order, key: Callable[[int], Position], after: Optional[Position] = None,
+              descending: bool = False, lo=None, hi=None) -> Iterator[int]:
+        start, stop = self._bounds(order, key, lo, hi)
+        if after is not None:
+            if descending:
+                stop = min(stop, bisect_left(order, after, key=key))
+            else:
+                start = max(start, bisect_right(order, after, key=key))
+        for i in (range(stop - 1, start - 1, -1) if descending else range(start, stop)):
+            yield order[i]
+
+    # Writes
+    def add(self, book: dict) -> None:
+        with self._lock:
+            if book["id"] in self:
+                raise KeyError(book["id"])
+            self._delta.add(book)
+            self._revisions[book["id"]] = self._bump()
+
+    def replace(self, book_id: int, book: dict, expected_revision: Optional[int] = None) -> dict:
+        with self._lock:
+            old = self.get(book_id)
+            if old is None:
+                raise KeyError(book_id)
+            self._check_revision(book_id, expected_revision)
+            new_id = book["id"]
+            if new_id != book_id and new_id in self:
+                raise KeyError(new_id)
+            self._remove([book_id])
+            self._delta.add(book)
+            self._revisions[new_id] = self._bump()
+            return old
+
+    def delete(self, book_id: int, expected_revision: Optional[int] = None) -> dict:
+        with self._lock:
+            book = self.get(book_id)
+            if book is None:
+                raise KeyError(book_id)
+            self._check_revision(book_id, expected_revision)
+            self._remove([book_id])
+            self._bump()
+            return book
+
+    def add_many(self, books: List[dict]) -> None:
+        with self._lock:
+            ids = [book["id"] for book in books]
+            duplicate = first_duplicate(ids)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            for book_id in ids:
+                if book_id in self:
+                    raise KeyError(book_id)
+            self._delta.add_many(books)
+            revision = self._bump()
+            for book_id in ids:
+                self._revisions[book_id] = revision
+
+    def replace_many(self, books: List[dict]) -> None:
+        with self._lock:
+            duplicate = first_duplicate(book["id"] for book in books)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            for book in books:
+                if book["id"] not in self:
+                    raise KeyError(book["id"])
+            self._remove([book["id"] for book in books])
+            self._delta.add_many(books)
+            revision = self._bump()
+            for book in books:
+                self._revisions[book["id"]] = revision
+
+    def delete_many(self, book_ids: List[int]) -> None:
+        with self._lock:
+            duplicate = first_duplicate(book_ids)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            for book_id in book_ids:
+                if book_id not in self:
+                    raise KeyError(book_id)
+            self._remove(book_ids)
+            self._bump()
+
+    def _remove(self, book_ids: List[int]) -> None:
+        # takes existing books out of the delta, or hides them in the file
+        changed = [book_id for book_id in book_ids if book_id in self._revisions]
+        if changed:
+            self._delta.delete_many(changed)
+        for book_id in changed:
+            del self._revisions[book_id]
+        self._hidden.update(book_id for book_id in book_ids if self._slot(book_id) >= 0)
+
+    def _bump(self) -> Tuple[int, float]:
+        # called with the lock held, after the data changed
+        self._version = (self._version[0] + 1, time.time())
+        return self._version
+
+    def _check_revision(self, book_id: int, expected_revision: Optional[int]) -> None:
+        # called with the lock held, before anything changes
+        revision = self.revision(book_id)[0]
+        if expected_revision is not None and revision != expected_revision:
+            raise RevisionConflict(book_id, revision)
+
+
+if __name__ == "__main__":
+    # exports the books of the configured storage backend (or of a JSON file) to a
+    # catalog file for STORAGE_BACKEND=mapped
+    parser = argparse.ArgumentParser(description="Export a book catalog file")
+    parser.add_argument("path", help="catalog file to write")
+    parser.add_argument("--json", help="export the list of books in this JSON file instead")
+    args = parser.parse_args()
+    if args.json:
+        from encoding import loads
+
+        with open(args.json, "rb") as f:
+            source = BookStore(loads(f.read()))
+    else:
+        from data import books_db as source
+    export_catalog(source, args.path)
+    print(f"Exported {len(source)} books to {args.path}")
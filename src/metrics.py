@@ -0,0 +1,226 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+import threading
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Upper bounds (seconds) of the latency buckets, from half a millisecond to 10s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# starlette appends the charset to text/* media types
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Metric types
+class Counter:
+    """
+    A monotonically increasing count per combination of label values.
+    """
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram:
+    """
+    Observations counted into fixed buckets per combination of label values. An
+    observation is a bisect and three increments under a lock, cheap enough to
+    record on every request.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count) in self._series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}"
+
+
+class CallbackMetric:
+    """
+    A metric whose values are read when scraped, for counts other objects already
+    keep (e.g. cache hits). Costs nothing on the hot path.
+    """
+
+    def __init__(self, name: str, documentation: str, type: str, labelnames: Sequence[str],
+                 collect: Callable[[], Dict[Tuple[str, ...], float]]):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in sorted(self.collect().items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+# Registry rendering every metric in the Prometheus text format
+class Registry:
+    def __init__(self):
+        self._metrics: List = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return ("\n".join(lines) + "\n").encode()
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    "bookstore_request_duration_seconds", "Time spent handling requests, by route.", ("method", "route")))
+responses = registry.register(Counter(
+    "bookstore_responses_total", "Responses sent, by route and status code.", ("method", "route", "code")))
+stage_duration = registry.register(Histogram(
+    "bookstore_stage_duration_seconds",
+    "Time spent in each stage of request handling: auth (token checks), kdf (password hashing), "
+    "lookup (storage reads), validate (bulk validation), serialize (JSON/XML encoding), "
+    "compress (response compression) and negotiate (Accept parsing).", ("stage",)))
+
+
+# Timer recording a stage of request handling
+class timed:
+    """
+    Context manager adding the time spent in its block to the `stage` histogram.
+
+        with timed("serialize"):
+            body = render(content, fmt)
+    """
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self) -> "timed":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        stage_duration.observe(time.perf_counter() - self.start, self.stage)
+
+
+# endpoint -> path template of its route
+_route_paths: Dict[Callable, str] = {}
+
+
+def route_name(scope: Scope) -> str:
+    """
+    The route template of a request (e.g. `/books/{book_id}`), so one series covers
+    every book ID. Requests no route matched share one label.
+    """
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    path = _route_paths.get(endpoint)
+    if path is None:
+        for route in getattr(scope.get("app"), "routes", ()):
+            if hasattr(route, "endpoint") and hasattr(route, "path"):
+                _route_paths[route.endpoint] = route.path
+        path = _route_paths.setdefault(endpoint, getattr(endpoint, "__name__", "unknown"))
+    return path
+
+
+# Middleware recording the latency and status of every request
+class MetricsMiddleware:
+    """
+    Times every HTTP request from the moment it arrives until the response body
+    has been sent, and counts responses by route and status code.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            method = scope["method"]
+            route = route_name(scope)
+            request_duration.observe(time.perf_counter() - start, method, route)
+            responses.inc(method, route, str(status_code))
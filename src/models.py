@@ -1,6 +1,6 @@
 
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Union
 
 # Custom user model
 class User(BaseModel):
@@ -18,4 +18,14 @@ class Book(BaseModel):
     author: str
     cover_image: Optional[str] = None
     price: float
-    published: bool
\ No newline at end of file
+    published: bool
+
+# Response models, for the API docs: book reads return store records as they are,
+# without validating them again
+class BookPage(BaseModel):
+    books: List[Book]
+    # a book ID when listing by ID, an opaque string for other orders
+    next_cursor: Optional[Union[int, str]] = None
+
+class SearchResults(BaseModel):
+    search_results: List[Book]
\ No newline at end of file
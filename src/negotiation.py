@@ -0,0 +1,144 @@
+from contextvars import ContextVar
+from typing import Any, Iterator, List, Optional
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from encoding import JSON, XML, encode_books, render
+from metrics import timed
+
+_MEDIA_TYPES = {
+    "application/json": JSON,
+    "application/xml": XML,
+    "text/xml": XML,
+}
+
+# Response format negotiated for the current request
+response_format: ContextVar[str] = ContextVar("response_format", default=JSON)
+
+
+def negotiate(accept: Optional[str], content_type: Optional[str] = None) -> str:
+    """
+    Picks the response format from the Accept header, honoring q-values. JSON wins
+    ties and wildcards. Without a usable Accept header, falls back to the request's
+    Content-Type for clients that relied on it before Accept was honored.
+    """
+    best, best_q = None, 0.0
+    for media_range in (accept or "").split(","):
+        media_type, _, params = media_range.partition(";")
+        media_type = media_type.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        fmt = _MEDIA_TYPES.get(media_type)
+        if fmt is None or q <= 0:
+            continue
+        if q > best_q or (q == best_q and fmt == JSON):
+            best, best_q = fmt, q
+    if best is not None:
+        return best
+    if content_type and "application/xml" in content_type.lower():
+        return XML
+    return JSON
+
+
+def current_format() -> str:
+    return response_format.get()
+
+
+def media_type(fmt: str) -> str:
+    return "application/xml" if fmt == XML else "application/json"
+
+
+# Middleware to negotiate the response format (json | xml)
+class NegotiationMiddleware:
+    """
+    Negotiates the response format once per request and exposes it through the
+    `response_format` context variable, so responses are rendered straight into the
+    right format instead of being converted after the fact. Adds `Vary: Accept`.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with timed("negotiate"):
+            headers = Headers(scope=scope)
+            fmt = negotiate(headers.get("accept"), headers.get("content-type"))
+        token = response_format.set(fmt)
+
+        async def send_with_vary(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).add_vary_header("Accept")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_vary)
+        finally:
+            response_format.reset(token)
+
+
+# Response class rendering JSON or XML depending on the negotiated format
+class NegotiatedResponse(JSONResponse):
+    def __init__(self, content: Any, *args: Any, **kwargs: Any):
+        self.format = current_format()
+        if self.format == XML:
+            self.media_type = "application/xml"
+        super().__init__(content, *args, **kwargs)
+
+    def render(self, content: Any) -> bytes:
+        return render(content, self.format)
+
+
+# Streaming renderers for lists of books, one chunk per page
+def ndjson_chunks(pages: Iterator[List[dict]]) -> Iterator[bytes]:
+    for books in pages:
+        yield b"\n".join(encode_books(books, JSON)) + b"\n"
+
+
+def json_array_chunks(key: str, pages: Iterator[List[dict]]) -> Iterator[bytes]:
+    yield f'{{"{key}":['.encode()
+    separator = b""
+    for books in pages:
+        yield separator + b",".join(encode_books(books, JSON))
+        separator = b","
+    yield b"]}"
+
+
+def streaming_response(key: str, pages: Iterator[List[dict]], stream: str) -> StreamingResponse:
+    """
+    Streams a list in the negotiated format: an XML document for XML clients,
+    otherwise NDJSON (`stream="ndjson"`) or a chunked JSON document.
+    """
+    if current_format() == XML:
+        import xmlstream
+
+        return StreamingResponse(xmlstream.iter_xml_list(key, pages, lambda books: encode_books(books, XML)),
+                                 media_type="application/xml")
+    if stream == "ndjson":
+        return StreamingResponse(ndjson_chunks(pages), media_type="application/x-ndjson")
+    return StreamingResponse(json_array_chunks(key, pages), media_type="application/json")
+
+
+# Exception handlers rendering errors in the negotiated format
+async def http_exception_handler(request: Request, exc: HTTPException) -> NegotiatedResponse:
+    return NegotiatedResponse({"detail": exc.detail}, status_code=exc.status_code,
+                              headers=getattr(exc, "headers", None))
+
+
+async def validation_exception_handler(request: Request, exc: RequestValidationError) -> NegotiatedResponse:
+    return NegotiatedResponse({"detail": jsonable_encoder(exc.errors())}, status_code=422)
@@ -0,0 +1,315 @@
+from collections import Counter
+from types import CodeType, FrameType
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import hmac
+import os
+import random
+import re
+import shutil
+import sys
+import threading
+import time
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app_constants import PROFILE_DIR, PROFILE_INTERVAL, PROFILE_MAX_FILES, PROFILE_SECRET
+from metrics import route_name
+
+PROFILE_HEADER = "x-profile"
+
+# Innermost frames of threads that are waiting rather than working
+_IDLE_FILES = {"threading.py", "selectors.py", "queue.py"}
+
+
+# Debug header signing
+def sign(secret: str, ttl: float = 3600) -> str:
+    """
+    Returns a value for the `X-Profile` header that makes the app profile the
+    request, valid for `ttl` seconds: `<expiry>:<HMAC-SHA256 of the expiry>`.
+    """
+    expires = str(int(time.time() + ttl))
+    return f"{expires}:{hmac.new(secret.encode(), expires.encode(), hashlib.sha256).hexdigest()}"
+
+
+def verify(secret: Optional[str], value: Optional[str]) -> bool:
+    if not secret or not value:
+        return False
+    expires, _, signature = value.partition(":")
+    expected = hmac.new(secret.encode(), expires.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature, expected):
+        return False
+    try:
+        return int(expires) > time.time()
+    except ValueError:
+        return False
+
+
+# Stack sampler
+class Recording:
+    def __init__(self):
+        self.samples: Counter = Counter()
+
+
+class StackSampler:
+    """
+    Samples the Python stack of every thread every `interval` seconds, but only
+    while at least one recording is open; the sampling thread exits when the last
+    recording stops.
+
+    Sync routes run on threadpool threads, so all threads are sampled, not only
+    the one serving the request; threads that are only waiting are skipped. Under
+    concurrent load a recording therefore also shows the work of requests running
+    at the same time.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self._recordings: List[Recording] = []
+        self._labels: Dict[CodeType, str] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> Recording:
+        recording = Recording()
+        with self._lock:
+            self._recordings.append(recording)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+        return recording
+
+    def stop(self, recording: Recording) -> Counter:
+        with self._lock:
+            self._recordings.remove(recording)
+        return recording.samples
+
+    def _label(self, code: CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def collapse(self, frame: FrameType) -> Optional[str]:
+        """
+        Folds a stack into `outer;...;inner`, or returns None for an idle thread.
+        """
+        if os.path.basename(frame.f_code.co_filename) in _IDLE_FILES:
+            return None
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while True:
+            stacks = [self.collapse(frame) for ident, frame in sys._current_frames().items() if ident != me]
+            with self._lock:
+                if not self._recordings:
+                    self._thread = None
+                    return
+                # counted under the lock, so a stopped recording no longer changes
+                for stack in stacks:
+                    if stack is not None:
+                        for recording in self._recordings:
+                            recording.samples[stack] += 1
+            time.sleep(self.interval)
+
+
+# Profile files on disk
+class ProfileStore:
+    """
+    Profiles saved as collapsed stacks (one `frame;frame;frame count` line per
+    stack, the input of flamegraph.pl and speedscope), one file per profiled
+    request in a directory per route. Past `max_files` profiles of a route, a worker
+    merges its oldest ones into one file, so disk use is bounded by the number of
+    distinct stacks. The number of profiles and samples of a route are kept as
+    running totals, so listing routes doesn't read the profiles.
+
+    Every worker process only writes and merges its own files (named after its
+    PID), so the directory can be shared.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR, max_files: int = PROFILE_MAX_FILES):
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def _route_dir(self, route: str) -> str:
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", route).strip("_")
+        digest = hashlib.sha1(route.encode()).hexdigest()[:8]
+        return os.path.join(self.directory, f"{slug}-{digest}")
+
+    def save(self, route: str, profile_id: str, samples: Counter) -> None:
+        """
+        Saves the profile of a request; `profile_id` is `<time_ns>-<pid>`, the PID
+        being this process's.
+        """
+        directory = self._route_dir(route)
+        pid = os.getpid()
+        with self._lock:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, "ROUTE"), "w") as f:
+                f.write(route)
+            self._write(os.path.join(directory, f"{profile_id}.collapsed"), samples)
+
+            # running totals: profiles, samples
+            totals_path = os.path.join(directory, f"totals-{pid}")
+            profiles, total = self._read_totals(totals_path)
+            with open(totals_path + ".tmp", "w") as f:
+                f.write(f"{profiles + 1} {total + sum(samples.values())}")
+            os.replace(totals_path + ".tmp", totals_path)
+
+            own = sorted((name for name in os.listdir(directory)
+                          if name.endswith(f"-{pid}.collapsed") and not name.startswith("merged-")),
+                         key=lambda name: int(name.partition("-")[0]))
+            if len(own) > self.max_files:
+                self._merge_oldest(directory, own[:len(own) - self.max_files], pid)
+
+    def _merge_oldest(self, directory: str, names: List[str], pid: int) -> None:
+        # called with the lock held
+        merged_path = os.path.join(directory, f"merged-{pid}.collapsed")
+        merged = self._load_file(merged_path) if os.path.exists(merged_path) else Counter()
+        for name in names:
+            merged.update(self._load_file(os.path.join(directory, name)))
+        self._write(merged_path + ".tmp", merged)
+        os.replace(merged_path + ".tmp", merged_path)
+        for name in names:
+            os.remove(os.path.join(directory, name))
+
+    @staticmethod
+    def _write(path: str, samples: Counter) -> None:
+        with open(path, "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in samples.items())
+
+    @staticmethod
+    def _read_totals(path: str) -> Tuple[int, int]:
+        try:
+            with open(path) as f:
+                profiles, total = f.read().split()
+            return int(profiles), int(total)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def _routes(self) -> Dict[str, str]:
+        routes = {}
+        if os.path.isdir(self.directory):
+            for name in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, name, "ROUTE")
+                if os.path.isfile(path):
+                    with open(path) as f:
+                        routes[f.read()] = os.path.dirname(path)
+        return routes
+
+    @staticmethod
+    def _load_file(path: str) -> Counter:
+        samples: Counter = Counter()
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack and count.isdigit():
+                    samples[stack] += int(count)
+        return samples
+
+    def _load(self, directory: str) -> Counter:
+        samples: Counter = Counter()
+        for name in os.listdir(directory):
+            if name.endswith(".collapsed"):
+                samples.update(self._load_file(os.path.join(directory, name)))
+        return samples
+
+    def summary(self) -> List[dict]:
+        """
+        Returns the number of profiled requests and samples of every route, from
+        the running totals of every worker.
+        """
+        result = []
+        for route, directory in self._routes().items():
+            totals = [self._read_totals(os.path.join(directory, name))
+                      for name in os.listdir(directory) if name.startswith("totals-") and not name.endswith(".tmp")]
+            result.append({"route": route, "profiles": sum(profiles for profiles, _ in totals),
+                           "samples": sum(total for _, total in totals)})
+        return result
+
+    def merged(self, route: Optional[str] = None) -> Optional[str]:
+        """
+        Merges the profiles of one route, or of every route with the route as the
+        root frame, into one collapsed stack file. Returns None for an unknown route.
+        """
+        routes = self._routes()
+        if route is not None:
+            if route not in routes:
+                return None
+            samples = self._load(routes[route])
+        else:
+            samples = Counter()
+            for name, directory in routes.items():
+                for stack, count in self._load(directory).items():
+                    samples[f"{name};{stack}"] += count
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(samples.items()))
+
+    def clear(self) -> int:
+        """
+        Deletes every profile.
+        Returns:
+            int: The number of routes cleared.
+        """
+        routes = self._routes()
+        for directory in routes.values():
+            shutil.rmtree(directory, ignore_errors=True)
+        return len(routes)
+
+
+sampler = StackSampler()
+profile_store = ProfileStore()
+
+
+# Middleware profiling a sample of requests
+class ProfilingMiddleware:
+    """
+    Profiles a random `sample_rate` fraction of requests, and any request carrying
+    an `X-Profile` header signed with `secret` (see `sign`). The profile is saved
+    per route and its ID returned in the `X-Profile-Id` response header.
+
+    Only installed when profiling is configured, so it costs nothing otherwise.
+    """
+
+    def __init__(self, app: ASGIApp, sample_rate: float = 0.0, secret: Optional[str] = PROFILE_SECRET,
+                 store: Optional[ProfileStore] = None):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.store = store
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not (
+                random.random() < self.sample_rate
+                or verify(self.secret, Headers(scope=scope).get(PROFILE_HEADER))):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f"{time.time_ns()}-{os.getpid()}"
+
+        async def send_with_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Profile-Id", profile_id)
+            await send(message)
+
+        recording = sampler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            samples = sampler.stop(recording)
+            route = f"{scope['method']} {route_name(scope)}"
+            await run_in_threadpool((self.store or profile_store).save, route, profile_id, samples)
+
+
+if __name__ == "__main__":
+    # prints an X-Profile header value for PROFILE_SECRET, valid for an hour
+    if not PROFILE_SECRET:
+        sys.exit("PROFILE_SECRET is not set")
+    print(sign(PROFILE_SECRET))
@@ -0,0 +1,370 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+import math
+import re
+import threading
+import time
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match, compile_path
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app_constants import (RATE_LIMIT_BACKEND, RATE_LIMIT_DB_PATH, RATE_LIMIT_MAX_BUCKETS, SQLITE_POOL_SIZE)
+from auth import decode_access_token
+from metrics import Counter, registry
+from negotiation import NegotiatedResponse
+
+if TYPE_CHECKING:  # sqlite3 is only loaded with the sqlite bucket store
+    import sqlite3
+
+    from sqlite_store import SQLiteDatabase
+
+rate_limited = registry.register(Counter(
+    "bookstore_rate_limited_total", "Requests rejected with 429, by rate limit budget.", ("budget",)))
+
+
+_PARAM_RE = re.compile(r"{[^}]*}")
+
+
+def route_template(path: str) -> str:
+    """
+    A route path with its parameter names and convertors dropped, so
+    `/books/{book_id}` and `/books/{id:int}` compare equal.
+    """
+    return _PARAM_RE.sub("{}", path)
+
+
+def resolve_route(scope: Scope) -> Optional[str]:
+    """
+    The template (see `route_template`) of the route of the application in `scope`
+    that the request resolves to, trying routes in order like the router does.
+    """
+    partial = None
+    for route in getattr(scope.get("app"), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route_template(route.path)
+        if match == Match.PARTIAL and partial is None:
+            partial = route_template(route.path)
+    return partial
+
+
+# Rate limit budget of a route
+class Budget:
+    """
+    A token bucket budget: `requests` requests in a burst, refilled at `requests`
+    per `period` seconds, for the requests matching `method` and the route template
+    `path` (`*` matches any). A shared budget has one bucket for all clients
+    together, otherwise every client has its own.
+
+    A request matches `path` if the route it resolves to has that template, so
+    `/books/{book_id}` doesn't match `/books/bulk`; only requests no route resolves
+    are matched against the template as a pattern.
+    """
+
+    def __init__(self, method: str, path: str, requests: int, period: float, shared: bool = False):
+        self.method = method
+        self.path = path
+        self.capacity = float(requests)
+        self.rate = requests / period
+        self.period = period
+        self.shared = shared
+        self.name = f"{method} {path}"
+        self._pattern = None if path == "*" else compile_path(path)[0]
+        self._template = None if path == "*" else route_template(path)
+
+    def matches(self, method: str, path: str, route: Optional[str] = None) -> bool:
+        """
+        Args:
+            route: The template of the route the request resolves to, as returned
+                by `route_template`, or None if no route does.
+        """
+        if self.method != "*" and self.method != method:
+            return False
+        if self._pattern is None:
+            return True
+        if route is not None:
+            return self._template == route
+        return self._pattern.match(path) is not None
+
+    @property
+    def policy(self) -> str:
+        return f"{int(self.capacity)};w={self.period:g}"
+
+
+_BUDGET_RE = re.compile(r"^\s*(\S+)\s+(\S+)\s*=\s*(\d+)\s*/\s*(\d+(?:\.\d+)?)\s*$")
+
+
+def parse_budgets(spec: str, shared: bool = False) -> List[Budget]:
+    """
+    Parses budgets written as `<METHOD> <path>=<requests>/<seconds>`, separated by `;`,
+    e.g. `POST /login=10/60; GET /books/{book_id}=50/1; * *=100/1`.
+    Raises:
+        ValueError: If a budget is malformed.
+    """
+    budgets = []
+    for item in filter(str.strip, spec.split(";")):
+        match = _BUDGET_RE.match(item)
+        if match is None or int(match.group(3)) < 1 or float(match.group(4)) <= 0:
+            raise ValueError(f"Invalid rate limit budget: {item.strip()!r}")
+        method, path, requests, period = match.groups()
+        budgets.append(Budget(method.upper(), path, int(requests), float(period), shared))
+    return budgets
+
+
+# A token bucket: key, capacity, refill rate in tokens per second
+Bucket = Tuple[str, float, float]
+
+
+# Token bucket storage interface
+class BucketStore(ABC):
+    # True if `take_all` does I/O, so it has to run off the event loop
+    blocking = False
+
+    def take(self, key: str, capacity: float, rate: float) -> Tuple[bool, float]:
+        """
+        Refills the bucket `key` for the time elapsed since it was last used, then
+        takes a token from it if it holds one. A bucket seen for the first time is full.
+        Returns:
+            Tuple[bool, float]: Whether a token was taken, and the tokens left.
+        """
+        return self.take_all([(key, capacity, rate)])[0]
+
+    @abstractmethod
+    def take_all(self, buckets: List[Bucket]) -> List[Tuple[bool, float]]:
+        """
+        Refills the buckets like `take`, then takes a token from every one of them
+        if each holds one, and from none otherwise, atomically.
+        Returns:
+            List[Tuple[bool, float]]: Whether each bucket held a token, and the
+                tokens left in it.
+        """
+
+
+# In-memory token buckets
+class MemoryBucketStore(BucketStore):
+    """
+    Buckets kept in process memory, in least recently used order. Buckets that have
+    refilled since their last use are dropped, since forgetting a full bucket changes
+    nothing; past `max_buckets` the least recently used one is dropped even if it is
+    not full. Every request does O(1) work (amortized), and memory stays bounded.
+
+    Each worker process has its own buckets, so with N workers a client can get up
+    to N times its budget.
+    """
+
+    def __init__(self, max_buckets: int = RATE_LIMIT_MAX_BUCKETS, clock: Callable[[], float] = time.monotonic):
+        self.max_buckets = max_buckets
+        self.clock = clock
+        # key -> (tokens, last use, time the bucket is full again)
+        self._buckets: "OrderedDict[str, Tuple[float, float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take_all(self, buckets: List[Bucket]) -> List[Tuple[bool, float]]:
+        now = self.clock()
+        with self._lock:
+            levels = []
+            for key, capacity, rate in buckets:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    self._evict(now)
+                    levels.append(capacity)
+                else:
+                    levels.append(min(capacity, bucket[0] + (now - bucket[1]) * rate))
+                    self._buckets.move_to_end(key)
+            allowed = all(level >= 1 for level in levels)
+            results = []
+            for (key, capacity, rate), level in zip(buckets, levels):
+                tokens = level - 1 if allowed else level
+                self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+                results.append((level >= 1, tokens))
+        return results
+
+    def _evict(self, now: float) -> None:
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if bucket[2] > now and len(buckets) < self.max_buckets:
+                return
+            del buckets[key]
+
+
+RATE_LIMITS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    granted INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rate_limits_updated ON rate_limits (updated);
+"""
+
+
+# SQLite token buckets, shared by every worker using the same database file
+class SQLiteBucketStore(BucketStore):
+    """
+    Buckets kept in a SQLite table, so every worker process draws from the same
+    budget. Taking a token from one bucket is one atomic upsert (SQLite >= 3.35 for
+    RETURNING); from several, one write transaction reading them all first. Every
+    `purge_every` takes, buckets unused for longer than `idle` seconds are deleted;
+    `idle` should be at least the longest time a bucket takes to refill.
+    """
+
+    blocking = True
+
+    def __init__(self, db: "SQLiteDatabase", idle: float = 3600, purge_every: int = 1000,
+                 clock: Callable[[], float] = time.time):
+        self.db = db
+        self.idle = idle
+        self.purge_every = purge_every
+        self.clock = clock
+        self._takes = 0
+        db.create_schema(RATE_LIMITS_SCHEMA)
+
+    def take_all(self, buckets: List[Bucket]) -> List[Tuple[bool, float]]:
+        if len(buckets) == 1:
+            return [self._take_one(*buckets[0])]
+        now = self.clock()
+        with self.db.transaction() as conn:
+            levels = []
+            for key, capacity, rate in buckets:
+                row = conn.execute("SELECT tokens, updated FROM rate_limits WHERE key = ?", (key,)).fetchone()
+                levels.append(capacity if row is None else min(capacity, row[0] + max(now - row[1], 0) * rate))
+            allowed = all(level >= 1 for level in levels)
+            results = []
+            for (key, capacity, rate), level in zip(buckets, levels):
+                tokens = level - 1 if allowed else level
+                conn.execute(
+                    "INSERT INTO rate_limits (key, tokens, updated, granted) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, granted = excluded.granted, "
+                    "updated = max(excluded.updated, updated)",
+                    (key, tokens, now, allowed))
+                results.append((level >= 1, tokens))
+            self._count_take(conn, now)
+        return results
+
+    def _take_one(self, key: str, capacity: float, rate: float) -> Tuple[bool, float]:
+        now = self.clock()
+        with self.db.connection() as conn:
+            # SET expressions see the values from before the update
+            tokens, granted = conn.execute(
+                "INSERT INTO rate_limits (key, tokens, updated, granted) VALUES (:key, :capacity - 1, :now, 1) "
+                "ON CONFLICT (key) DO UPDATE SET "
+                "tokens = min(:capacity, tokens + max(:now - updated, 0) * :rate) "
+                "- (min(:capacity, tokens + max(:now - updated, 0) * :rate) >= 1), "
+                "granted = min(:capacity, tokens + max(:now - updated, 0) * :rate) >= 1, "
+                "updated = max(:now, updated) "
+                "RETURNING tokens, granted",
+                {"key": key, "capacity": capacity, "rate": rate, "now": now}).fetchone()
+            self._count_take(conn, now)
+        return bool(granted), tokens
+
+    def _count_take(self, conn: "sqlite3.Connection", now: float) -> None:
+        self._takes += 1
+        if self._takes % self.purge_every == 0:
+            conn.execute("DELETE FROM rate_limits WHERE updated < ?", (now - self.idle,))
+
+
+def bucket_store(budgets: List[Budget]) -> BucketStore:
+    """
+    Creates the bucket store configured by RATE_LIMIT_BACKEND.
+    """
+    if RATE_LIMIT_BACKEND == "sqlite":
+        from sqlite_store import SQLiteDatabase
+
+        idle = max((budget.capacity / budget.rate for budget in budgets), default=0)
+        return SQLiteBucketStore(SQLiteDatabase(RATE_LIMIT_DB_PATH, pool_size=SQLITE_POOL_SIZE), idle=idle)
+    if RATE_LIMIT_BACKEND == "memory":
+        return MemoryBucketStore()
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {RATE_LIMIT_BACKEND!r}")
+
+
+# Function to find who is making a request
+def client_identity(scope: Scope) -> str:
+    """
+    The username of a request carrying a valid access token (the `get_current_user`
+    user), otherwise the client's IP address. Usernames sent with HTTP Basic are not
+    trusted, as anyone can send any of them.
+    """
+    scheme, _, token = Headers(scope=scope).get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token.strip():
+        from jwt.exceptions import InvalidTokenError
+
+        try:
+            username = decode_access_token(token.strip()).get("sub")
+        except InvalidTokenError:
+            username = None
+        if username:
+            return f"user:{username}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+# Middleware throttling clients with token buckets
+class RateLimitMiddleware:
+    """
+    Takes a token from the bucket of every budget the request matches: the client's
+    own bucket for per-client budgets, the one bucket of shared budgets. If any is
+    empty the request is answered with 429 and a Retry-After header, without
+    reaching the route, and no token is taken from the others.
+
+    Responses carry RateLimit-Limit, RateLimit-Remaining and RateLimit-Reset
+    (seconds until the bucket is full) for the most depleted of the buckets, and a
+    RateLimit-Policy listing the matched budgets.
+    """
+
+    def __init__(self, app: ASGIApp, budgets: List[Budget], store: Optional[BucketStore] = None,
+                 identify: Callable[[Scope], str] = client_identity):
+        self.app = app
+        self.budgets = budgets
+        self.store = store if store is not None else MemoryBucketStore()
+        self.identify = identify
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = resolve_route(scope)
+        budgets = [budget for budget in self.budgets if budget.matches(scope["method"], scope["path"], route)]
+        if not budgets:
+            await self.app(scope, receive, send)
+            return
+
+        client = None
+        buckets = []
+        for budget in budgets:
+            if not budget.shared and client is None:
+                client = self.identify(scope)
+            buckets.append((f"{budget.name}|{'*' if budget.shared else client}", budget.capacity, budget.rate))
+        if self.store.blocking:
+            taken = await run_in_threadpool(self.store.take_all, buckets)
+        else:
+            taken = self.store.take_all(buckets)
+        results = [(budget, *result) for budget, result in zip(budgets, taken)]
+
+        budget, allowed, tokens = min(results, key=lambda result: (result[1], result[2]))
+        headers = {
+            "RateLimit-Limit": str(int(budget.capacity)),
+            "RateLimit-Remaining": str(int(tokens)),
+            "RateLimit-Reset": str(math.ceil((budget.capacity - tokens) / budget.rate)),
+            "RateLimit-Policy": ", ".join(budget.policy for budget in budgets),
+        }
+        if not allowed:
+            rate_limited.inc(budget.name)
+            headers["Retry-After"] = str(max(math.ceil((1 - tokens) / budget.rate), 1))
+            response = NegotiatedResponse({"detail": "Too many requests, please retry later"},
+                                          status_code=429, headers=headers)
+            await response(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).update(headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,221 @@
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+import heapq
+import re
+
+from indexes import SortedList
+
+# Indexed fields and their ranking weights. Each field also gets a bit in the
+# per-document mask stored in the postings.
+FIELDS: Tuple[Tuple[str, int], ...] = (
+    ("title", 3),
+    ("author", 2),
+    ("description", 1),
+)
+
+# Summed field weight for every possible field mask
+FIELD_SCORES: List[int] = [
+    sum(weight for bit, (_, weight) in enumerate(FIELDS) if mask & (1 << bit))
+    for mask in range(1 << len(FIELDS))
+]
+
+TOKEN_RE = re.compile(r"\w+")
+
+# Match quality bonuses, added on top of the field weights
+EXACT, PREFIX, INFIX = 3, 2, 1
+
+
+def fold(text: str) -> str:
+    """
+    Case-folds text the same way for documents and queries.
+    """
+    return text.casefold()
+
+
+def ngrams(token: str, n: int) -> Set[str]:
+    return {token[i:i + n] for i in range(len(token) - n + 1)}
+
+
+# Inverted index for full-text search over books
+class SearchIndex:
+    """
+    Token-level inverted index with an n-gram index over the vocabulary.
+
+    Each case-folded token maps to the books containing it (with a bitmask of the
+    fields it appears in). Substring matching is answered by looking up the
+    vocabulary tokens that contain the query terms through a trigram index, so a
+    query only touches matching tokens and their postings, never the whole catalog.
+    Two-character terms go through a bigram index instead, and prefixes through the
+    sorted vocabulary. A single character is only matched as a prefix: as a
+    substring it would match nearly every token, and scoring their postings means
+    touching most of the catalog.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._vocab = SortedList()
+        # trigram -> tokens containing it, and the same for bigrams
+        self._grams: Dict[str, Set[str]] = {}
+        self._bigrams: Dict[str, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._vocab)
+
+    def add(self, book: dict) -> None:
+        """
+        Indexes the searchable fields of a book.
+        """
+        book_id = book["id"]
+        for token, mask in self._tokens(book).items():
+            docs = self._postings.get(token)
+            if docs is None:
+                docs = self._postings[token] = {}
+                self._vocab.add(token)
+                for grams, n in ((self._grams, 3), (self._bigrams, 2)):
+                    for gram in ngrams(token, n):
+                        grams.setdefault(gram, set()).add(token)
+            docs[book_id] = docs.get(book_id, 0) | mask
+
+    def remove(self, book: dict) -> None:
+        """
+        Removes a previously indexed book. `book` must be the record as it was
+        indexed, since its tokens are recomputed from it.
+        """
+        book_id = book["id"]
+        for token in self._tokens(book):
+            docs = self._postings.get(token)
+            if docs is None:
+                continue
+            docs.pop(book_id, None)
+            if not docs:
+                del self._postings[token]
+                self._vocab.remove(token)
+                for grams, n in ((self._grams, 3), (self._bigrams, 2)):
+                    for gram in ngrams(token, n):
+                        tokens = grams[gram]
+                        tokens.discard(token)
+                        if not tokens:
+                            del grams[gram]
+
+    def search(self, query: str, lookup: Callable[[int], Optional[dict]],
+               limit: Optional[int] = None) -> List[int]:
+        """
+        Finds books whose title, author or description contains `query`
+        (case-insensitive), best matches first.
+        Args:
+            query (str): The search text.
+            lookup (Callable): Returns the record for a book id, used to verify
+                multi-word phrases.
+            limit (int, optional): Maximum number of ids to return.
+        Returns:
+            List[int]: Matching book ids, ranked by field weight and match quality.
+        """
+        folded = fold(query)
+        terms = [(m.group(), m.start() == 0, m.end() == len(folded))
+                 for m in TOKEN_RE.finditer(folded)]
+        if not terms:
+            return []
+
+        if len(terms) == 1:
+            token, open_left, open_right = terms[0]
+            scores = self._score_term(token, open_left, open_right)
+        else:
+            scores = self._score_phrase(folded, terms, lookup)
+
+        ranked = ((-score, book_id) for book_id, score in scores.items())
+        if limit is not None:
+            return [book_id for _, book_id in heapq.nsmallest(limit, ranked)]
+        return [book_id for _, book_id in sorted(ranked)]
+
+    # Single term: scores come straight from the postings
+    def _score_term(self, token: str, open_left: bool, open_right: bool) -> Dict[int, int]:
+        scores: Dict[int, int] = {}
+        for candidate in self._matching_tokens(token, open_left, open_right, narrow_short=True):
+            if candidate == token:
+                quality = EXACT
+            elif candidate.startswith(token):
+                quality = PREFIX
+            else:
+                quality = INFIX
+            for book_id, mask in self._postings[candidate].items():
+                score = FIELD_SCORES[mask] + quality
+                if score > scores.get(book_id, 0):
+                    scores[book_id] = score
+        return scores
+
+    # Several terms: intersect per-term candidates, then verify the phrase
+    def _score_phrase(self, folded: str, terms: List[Tuple[str, bool, bool]],
+                      lookup: Callable[[int], Optional[dict]]) -> Dict[int, int]:
+        candidate_sets: List[Set[int]] = []
+        for token, open_left, open_right in terms:
+            tokens = self._matching_tokens(token, open_left, open_right, narrow_short=False)
+            if tokens is None:
+                # too short to narrow down; the phrase check covers it
+                continue
+            docs: Set[int] = set()
+            for candidate in tokens:
+                docs.update(self._postings[candidate])
+            if not docs:
+                return {}
+            candidate_sets.append(docs)
+        if not candidate_sets:
+            return {}
+
+        candidate_sets.sort(key=len)
+        candidates = candidate_sets[0].intersection(*candidate_sets[1:])
+
+        scores: Dict[int, int] = {}
+        for book_id in candidates:
+            book = lookup(book_id)
+            if book is None:
+                continue
+            mask = 0
+            for bit, (field, _) in enumerate(FIELDS):
+                value = book.get(field)
+                if value and folded in fold(value):
+                    mask |= 1 << bit
+            if mask:
+                scores[book_id] = FIELD_SCORES[mask] + EXACT
+        return scores
+
+    def _matching_tokens(self, token: str, open_left: bool, open_right: bool,
+                         narrow_short: bool) -> Optional[Iterable[str]]:
+        """
+        Returns the vocabulary tokens a query term can match. A term bounded on
+        both sides must match a whole token, a term open on the right is a prefix,
+        one open on the left a suffix and one open on both sides a substring.
+        Returns None for a suffix/substring term shorter than three characters
+        unless `narrow_short` is set, as such a term matches much of the vocabulary.
+        """
+        if not open_left and not open_right:
+            return [token] if token in self._postings else []
+        if not open_left:
+            return self._prefixed(token)
+        if len(token) < 3 and not narrow_short:
+            return None
+        if len(token) == 1:
+            # as a substring or suffix it would match nearly every token
+            return self._prefixed(token) if open_right else self._matching_tokens(token, False, False, True)
+        if len(token) == 2:
+            matches = self._bigrams.get(token, set())
+        else:
+            grams = sorted((self._grams.get(gram, set()) for gram in ngrams(token, 3)), key=len)
+            matches = grams[0].intersection(*grams[1:])
+        if open_right:
+            return [t for t in matches if token in t]
+        return [t for t in matches if t.endswith(token)]
+
+    def _prefixed(self, prefix: str) -> List[str]:
+        start = self._vocab.bisect_left(prefix)
+        end = self._vocab.bisect_left(prefix + "\U0010ffff")
+        return list(self._vocab.islice(start, end))
+
+    @staticmethod
+    def _tokens(book: dict) -> Dict[str, int]:
+        tokens: Dict[str, int] = {}
+        for bit, (field, _) in enumerate(FIELDS):
+            value = book.get(field)
+            if not value:
+                continue
+            for token in TOKEN_RE.findall(fold(value)):
+                tokens[token] = tokens.get(token, 0) | (1 << bit)
+        return tokens
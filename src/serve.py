@@ -0,0 +1,32 @@
+import os
+import sys
+
+from app_constants import HOST, PORT, RELOAD, SESSION_BACKEND, WORKERS
+
+
+# Production entry point
+def main():
+    """
+    Serves the app with uvicorn on HOST:PORT with WORKERS processes, without the
+    reloader unless RELOAD is set.
+
+    The app is given to uvicorn by name, so it is only imported where requests are
+    served: in this process with one worker, otherwise in each worker while this
+    process just supervises them. Workers are spawned, and a spawned process first
+    re-imports the script it was started from, which is why this one is kept apart
+    from `build.py` and imports next to nothing.
+
+    Refuses to start several workers with in-memory sessions, since each worker
+    would only see the logins and logouts it handled itself.
+    """
+    if WORKERS > 1 and SESSION_BACKEND == "memory":
+        sys.exit(f"WORKERS={WORKERS} needs sessions shared between the workers: set SESSION_BACKEND=sqlite "
+                 "(SESSION_BACKEND=memory keeps them in each worker)")
+    import uvicorn
+
+    uvicorn.run("build:app", host=HOST, port=PORT, workers=WORKERS, reload=RELOAD,
+                app_dir=os.path.dirname(os.path.abspath(__file__)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Dict, List, Tuple
+import heapq
+import threading
+import time
+
+if TYPE_CHECKING:  # sqlite3 is only loaded with the sqlite session backend
+    from sqlite_store import SQLiteDatabase
+
+
+# Session store interface
+class SessionStore(ABC):
+    """
+    Tracks which users are logged in. A session starts on login, ends on logout and
+    expires on its own after `ttl` seconds (the access token lifetime), so a crashed
+    client doesn't keep a user logged in forever.
+    """
+
+    # True if methods do I/O, so async callers must run them off the event loop
+    blocking = False
+
+    @abstractmethod
+    def start(self, username: str, ttl: float) -> bool:
+        """
+        Starts a session for `username`, unless one is already active.
+        Returns:
+            bool: True if the session was started, False if the user is already logged in.
+        """
+
+    @abstractmethod
+    def end(self, username: str) -> bool:
+        """
+        Ends the session of `username`.
+        Returns:
+            bool: True if a session was active, False otherwise.
+        """
+
+    @abstractmethod
+    def is_active(self, username: str) -> bool:
+        """
+        Returns True if `username` has an active session.
+        """
+
+
+# In-memory session store
+class MemorySessionStore(SessionStore):
+    """
+    Sessions kept in process memory: a dict of username -> expiry for O(1) checks,
+    plus a heap ordered by expiry so expired sessions are purged without scanning.
+    Only correct with a single worker process.
+    """
+
+    def __init__(self):
+        self._expires: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+    def _purge(self, now: float) -> None:
+        while self._heap and self._heap[0][0] <= now:
+            expires, username = heapq.heappop(self._heap)
+            # a later session for the same user has its own heap entry
+            if self._expires.get(username) == expires:
+                del self._expires[username]
+
+    def start(self, username: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            if username in self._expires:
+                return False
+            expires = now + ttl
+            self._expires[username] = expires
+            heapq.heappush(self._heap, (expires, username))
+            return True
+
+    def end(self, username: str) -> bool:
+        with self._lock:
+            self._purge(time.time())
+            return self._expires.pop(username, None) is not None
+
+    def is_active(self, username: str) -> bool:
+        return self._expires.get(username, 0.0) > time.time()
+
+
+SESSIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    username TEXT PRIMARY KEY,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+"""
+
+
+# SQLite session store, shared by every worker using the same database file
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions kept in a SQLite table, so every worker process sees the same login
+    state. Starting and ending a session are single atomic statements.
+
+    `is_active` answers from a small in-process cache for up to `cache_ttl` seconds,
+    so protected routes usually skip the database; changes made by this process are
+    visible immediately, changes made by other workers after at most `cache_ttl`.
+    """
+
+    blocking = True
+
+    def __init__(self, db: "SQLiteDatabase", cache_ttl: float = 1.0, cache_size: int = 10000):
+        self.db = db
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._cache: Dict[str, Tuple[float, float]] = {}
+        db.create_schema(SESSIONS_SCHEMA)
+
+    def _remember(self, username: str, expires: float) -> None:
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[username] = (expires, time.time() + self.cache_ttl)
+
+    def start(self, username: str, ttl: float) -> bool:
+        now = time.time()
+        with self.db.connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO sessions (username, expires) VALUES (?, ?) "
+                "ON CONFLICT (username) DO UPDATE SET expires = excluded.expires WHERE sessions.expires <= ?",
+                (username, now + ttl, now))
+        started = cursor.rowcount == 1
+        if started:
+            self._remember(username, now + ttl)
+        else:
+            # someone else holds the session; don't trust the cached state
+            self._cache.pop(username, None)
+        return started
+
+    def end(self, username: str) -> bool:
+        with self.db.connection() as conn:
+            cursor = conn.execute("DELETE FROM sessions WHERE username = ? AND expires > ?",
+                                  (username, time.time()))
+        self._remember(username, 0.0)
+        return cursor.rowcount == 1
+
+    def is_active(self, username: str) -> bool:
+        now = time.time()
+        cached = self._cache.get(username)
+        if cached is not None and cached[1] > now:
+            return cached[0] > now
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT expires FROM sessions WHERE username = ?", (username,)).fetchone()
+        expires = row[0] if row else 0.0
+        self._remember(username, expires)
+        return expires > now
+
+    def purge(self) -> int:
+        """
+        Deletes expired sessions.
+        Returns:
+            int: The number of sessions deleted.
+        """
+        with self.db.connection() as conn:
+            return conn.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
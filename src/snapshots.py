@@ -0,0 +1,104 @@
+from array import array
+from typing import Any, BinaryIO, List, Tuple
+import struct
+import zlib
+
+from encoding import dumps, loads
+
+# Snapshot files start with this, followed by a `meta` section
+MAGIC = b"BKSNAP01"
+
+# Section header: name length, then the name, kind, typecode and item size (arrays
+# only) and data length
+_NAME = struct.Struct("<H")
+_HEAD = struct.Struct("<ccBQ")
+_CRC = struct.Struct("<I")
+
+ARRAY, BYTES, JSON = b"A", b"B", b"J"
+
+
+# Writer of a snapshot file
+class SnapshotWriter:
+    """
+    Writes a snapshot: a sequence of named sections, each an `array` (written as its
+    raw machine values, so it is read back with one copy), bytes or a JSON value,
+    followed by a CRC-32 of everything before it.
+    """
+
+    def __init__(self, f: BinaryIO, meta: dict):
+        self._f = f
+        self._crc = 0
+        self._write(MAGIC)
+        self.section("meta", meta)
+
+    def _write(self, data) -> None:
+        self._f.write(data)
+        self._crc = zlib.crc32(data, self._crc)
+
+    def section(self, name: str, value: Any) -> None:
+        if isinstance(value, array):
+            head = _HEAD.pack(ARRAY, value.typecode.encode(), value.itemsize, len(value) * value.itemsize)
+            data = memoryview(value).cast("B")
+        elif isinstance(value, (bytes, bytearray)):
+            head = _HEAD.pack(BYTES, b" ", 0, len(value))
+            data = value
+        else:
+            data = dumps(value)
+            head = _HEAD.pack(JSON, b" ", 0, len(data))
+        encoded = name.encode()
+        self._write(_NAME.pack(len(encoded)) + encoded + head)
+        self._write(data)
+
+    def close(self) -> None:
+        # an empty name ends the sections
+        self._write(_NAME.pack(0))
+        self._f.write(_CRC.pack(self._crc))
+
+
+def read_snapshot(f: BinaryIO) -> Tuple[dict, List[Tuple[str, Any]]]:
+    """
+    Reads a snapshot written by `SnapshotWriter`.
+    Returns:
+        Tuple[dict, List[Tuple[str, Any]]]: The meta section, and the other sections in order.
+    Raises:
+        ValueError: If the file is not a snapshot, is truncated or corrupt, or holds
+            arrays of another platform's item sizes.
+    """
+    crc = 0
+
+    def read(size: int) -> bytes:
+        nonlocal crc
+        data = f.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated snapshot")
+        crc = zlib.crc32(data, crc)
+        return data
+
+    if read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a snapshot file")
+    sections = []
+    while True:
+        name_length, = _NAME.unpack(read(_NAME.size))
+        if not name_length:
+            break
+        name = read(name_length).decode()
+        kind, typecode, itemsize, length = _HEAD.unpack(read(_HEAD.size))
+        data = read(length)
+        if kind == ARRAY:
+            value = array(typecode.decode())
+            if value.itemsize != itemsize:
+                raise ValueError(f"Snapshot section {name!r} was written with {itemsize}-byte items")
+            value.frombytes(data)
+        elif kind == BYTES:
+            value = bytearray(data)
+        else:
+            value = loads(data)
+        sections.append((name, value))
+    checksum = f.read(_CRC.size)
+    if len(checksum) != _CRC.size:
+        raise ValueError("Truncated snapshot")
+    if _CRC.unpack(checksum)[0] != crc:
+        raise ValueError("Corrupt snapshot")
+    if not sections or sections[0][0] != "meta":
+        raise ValueError("Snapshot has no meta section")
+    return sections[0][1], sections[1:]
@@ -0,0 +1,416 @@
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+import queue
+import sqlite3
+import time
+
+from indexes import Position, sort_key
+from store import BookRepository, RevisionConflict, UserRepository, first_duplicate
+
+BOOK_FIELDS = ("id", "title", "description", "author", "cover_image", "price", "published")
+USER_FIELDS = ("username", "full_name", "email", "hashed_password")
+
+_BOOK_COLUMNS = ", ".join(BOOK_FIELDS)
+_USER_COLUMNS = ", ".join(USER_FIELDS)
+
+BOOKS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL,
+    author TEXT NOT NULL,
+    cover_image TEXT,
+    price REAL NOT NULL,
+    published INTEGER NOT NULL,
+    rev INTEGER NOT NULL DEFAULT 0,
+    modified REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS catalog (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    version INTEGER NOT NULL,
+    modified REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_author ON books (author, id);
+CREATE INDEX IF NOT EXISTS books_title ON books (title COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS books_price ON books (price, id);
+CREATE INDEX IF NOT EXISTS books_published ON books (published, id);
+"""
+
+USERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    full_name TEXT,
+    email TEXT,
+    hashed_password TEXT NOT NULL
+);
+"""
+
+# Trigram full-text index over books, kept in sync by triggers (SQLite >= 3.34)
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+    title, author, description, content='books', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+    INSERT INTO books_fts (rowid, title, author, description)
+    VALUES (new.id, new.title, new.author, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+    INSERT INTO books_fts (books_fts, rowid, title, author, description)
+    VALUES ('delete', old.id, old.title, old.author, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE ON books BEGIN
+    INSERT INTO books_fts (books_fts, rowid, title, author, description)
+    VALUES ('delete', old.id, old.title, old.author, old.description);
+    INSERT INTO books_fts (rowid, title, author, description)
+    VALUES (new.id, new.title, new.author, new.description);
+END;
+"""
+
+
+# Pool of SQLite connections to one database file
+class SQLiteDatabase:
+    """
+    A fixed-size pool of connections to one SQLite database in WAL mode, so readers
+    never block each other or the writer.
+
+    Connections run in autocommit mode; writes go through `transaction()`, which
+    takes the write lock up front (BEGIN IMMEDIATE) so concurrent writers queue on
+    the busy timeout instead of failing to upgrade a read lock. Statements are
+    reused from each connection's prepared statement cache.
+    """
+
+    def __init__(self, path: str, pool_size: int = 4, busy_timeout: float = 5.0):
+        self.path = path
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(max(pool_size, 1)):
+            self._pool.put(self._connect(busy_timeout))
+
+    def _connect(self, busy_timeout: float) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=busy_timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def create_schema(self, schema: str) -> bool:
+        """
+        Runs a script of idempotent DDL statements.
+        Returns:
+            bool: False if this SQLite build doesn't support the statements
+                (e.g. a missing FTS5 tokenizer), True otherwise.
+        """
+        try:
+            with self.connection() as conn:
+                conn.executescript(schema)
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self) -> None:
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+def _book(row: sqlite3.Row) -> dict:
+    book = dict(row)
+    book["published"] = bool(book["published"])
+    return book
+
+
+# ORDER BY expression of each sort order, matching `indexes.sort_key`
+_SORT_COLUMNS = {"id": "id", "price": "price", "title": "title COLLATE NOCASE"}
+
+
+def _like_pattern(query: str) -> str:
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+# SQLite book repository
+class SQLiteBookStore(BookRepository):
+    """
+    Book repository stored in the `books` table. Searches use the trigram FTS5 index
+    (ranked with bm25, weighting title over author over description) for queries of
+    three characters or more, and a LIKE scan otherwise.
+
+    The catalog version lives in the one-row `catalog` table and is bumped inside
+    every write transaction, which also stamps the written rows with it, so all
+    workers sharing the file agree on versions and revisions.
+    """
+
+    blocking = True
+
+    def __init__(self, db: SQLiteDatabase, seed: Iterable[dict] = ()):
+        self.db = db
+        db.create_schema(BOOKS_SCHEMA)
+        self.fts = db.create_schema(FTS_SCHEMA)
+        with db.transaction() as conn:
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(books)")}
+            # databases created before books carried revisions
+            if "rev" not in columns:
+                conn.execute("ALTER TABLE books ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE books ADD COLUMN modified REAL NOT NULL DEFAULT 0")
+                conn.execute("UPDATE books SET modified = ?", (time.time(),))
+            conn.execute("INSERT OR IGNORE INTO catalog (id, version, modified) VALUES (0, 0, ?)",
+                         (time.time(),))
+            if conn.execute("SELECT 1 FROM books LIMIT 1").fetchone() is None:
+                revision = self._bump(conn)
+                conn.executemany(
+                    f"INSERT INTO books ({_BOOK_COLUMNS}, rev, modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self._values(book) + revision for book in seed))
+
+    @staticmethod
+    def _values(book: dict) -> tuple:
+        return tuple(book.get(field) for field in BOOK_FIELDS)
+
+    @staticmethod
+    def _bump(conn: sqlite3.Connection) -> Tuple[int, float]:
+        now = time.time()
+        conn.execute("UPDATE catalog SET version = version + 1, modified = ? WHERE id = 0", (now,))
+        return conn.execute("SELECT version FROM catalog WHERE id = 0").fetchone()[0], now
+
+    @staticmethod
+    def _check_revision(conn: sqlite3.Connection, book_id: int, expected_revision: Optional[int]) -> None:
+        # read in the write transaction, so the revision can't change before the write
+        if expected_revision is not None:
+            revision = conn.execute("SELECT rev FROM books WHERE id = ?", (book_id,)).fetchone()[0]
+            if revision != expected_revision:
+                raise RevisionConflict(book_id, revision)
+
+    def __len__(self) -> int:
+        with self.db.connection() as conn:
+            return conn.execute("SELECT count(*) FROM books").fetchone()[0]
+
+    def version(self) -> Tuple[int, float]:
+        with self.db.connection() as conn:
+            return tuple(conn.execute("SELECT version, modified FROM catalog WHERE id = 0").fetchone())
+
+    def revision(self, book_id: int) -> Optional[Tuple[int, float]]:
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT rev, modified FROM books WHERE id = ?", (book_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def __contains__(self, book_id: object) -> bool:
+        with self.db.connection() as conn:
+            return conn.execute("SELECT 1 FROM books WHERE id = ?", (book_id,)).fetchone() is not None
+
+    def get(self, book_id: int) -> Optional[dict]:
+        with self.db.connection() as conn:
+            row = conn.execute(f"SELECT {_BOOK_COLUMNS} FROM books WHERE id = ?", (book_id,)).fetchone()
+        return _book(row) if row else None
+
+    def by_author(self, author: str) -> List[dict]:
+        with self.db.connection() as conn:
+            rows = conn.execute(f"SELECT {_BOOK_COLUMNS} FROM books WHERE author = ? ORDER BY id",
+                                (author,)).fetchall()
+        return [_book(row) for row in rows]
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[dict]:
+        limit = -1 if limit is None else limit
+        with self.db.connection() as conn:
+            if self.fts and len(query) >= 3:
+                phrase = '"' + query.replace('"', '""') + '"'
+                rows = conn.execute(
+                    f"SELECT {', '.join('b.' + f for f in BOOK_FIELDS)} FROM books_fts "
+                    "JOIN books b ON b.id = books_fts.rowid "
+                    "WHERE books_fts MATCH ? ORDER BY bm25(books_fts, 3.0, 2.0, 1.0), b.id LIMIT ?",
+                    (phrase, limit)).fetchall()
+            else:
+                pattern = _like_pattern(query)
+                rows = conn.execute(
+                    f"SELECT {_BOOK_COLUMNS} FROM books WHERE title LIKE ?1 ESCAPE '\\' "
+                    "OR author LIKE ?1 ESCAPE '\\' OR description LIKE ?1 ESCAPE '\\' "
+                    "ORDER BY title LIKE ?1 ESCAPE '\\' DESC, author LIKE ?1 ESCAPE '\\' DESC, id LIMIT ?2",
+                    (pattern, limit)).fetchall()
+        return [_book(row) for row in rows]
+
+    def page(self, cursor: Optional[int] = None, limit: int = 100) -> Tuple[List[dict], Optional[int]]:
+        with self.db.connection() as conn:
+            rows = conn.execute(f"SELECT {_BOOK_COLUMNS} FROM books WHERE id > ? ORDER BY id LIMIT ?",
+                                (-(1 << 63) if cursor is None else cursor, limit + 1)).fetchall()
+        books = [_book(row) for row in rows[:limit]]
+        return books, (books[-1]["id"] if len(rows) > limit else None)
+
+    def find(self, author: Optional[str] = None, published: Optional[bool] = None,
+             price_min: Optional[float] = None, price_max: Optional[float] = None,
+             sort: str = "id", descending: bool = False, after: Optional[Position] = None,
+             limit: int = 100) -> Tuple[List[dict], Optional[Position]]:
+        conditions, params = [], []
+        for condition, value in (("author = ?", author), ("published = ?", published),
+                                 ("price >= ?", price_min), ("price <= ?", price_max)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        column = _SORT_COLUMNS[sort]
+        op, direction = ("<", "DESC") if descending else (">", "ASC")
+        if after is not None:
+            if sort == "id":
+                conditions.append(f"id {op} ?")
+                params.append(after[1])
+            else:
+                # the leading bound lets SQLite seek the index (it doesn't for a
+                # row value compared with a collation)
+                conditions.append(f"{column} {op}= ? AND ({column}, id) {op} (?, ?)")
+                params.extend((after[0], *after))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = f"id {direction}" if sort == "id" else f"{column} {direction}, id {direction}"
+        with self.db.connection() as conn:
+            rows = conn.execute(f"SELECT {_BOOK_COLUMNS} FROM books {where} ORDER BY {order} LIMIT ?",
+                                (*params, limit + 1)).fetchall()
+        books = [_book(row) for row in rows[:limit]]
+        return books, (sort_key(books[-1], sort) if len(rows) > limit else None)
+
+    def add(self, book: dict) -> None:
+        try:
+            with self.db.transaction() as conn:
+                conn.execute(f"INSERT INTO books ({_BOOK_COLUMNS}, rev, modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             self._values(book) + self._bump(conn))
+        except sqlite3.IntegrityError:
+            raise KeyError(book["id"])
+
+    def replace(self, book_id: int, book: dict, expected_revision: Optional[int] = None) -> dict:
+        with self.db.transaction() as conn:
+            row = conn.execute(f"SELECT {_BOOK_COLUMNS} FROM books WHERE id = ?", (book_id,)).fetchone()
+            if row is None:
+                raise KeyError(book_id)
+            self._check_revision(conn, book_id, expected_revision)
+            try:
+                conn.execute(
+                    "UPDATE books SET id = ?, title = ?, description = ?, author = ?, "
+                    "cover_image = ?, price = ?, published = ?, rev = ?, modified = ? WHERE id = ?",
+                    self._values(book) + self._bump(conn) + (book_id,))
+            except sqlite3.IntegrityError:
+                raise KeyError(book["id"])
+        return _book(row)
+
+    def delete(self, book_id: int, expected_revision: Optional[int] = None) -> dict:
+        with self.db.transaction() as conn:
+            row = conn.execute(f"SELECT {_BOOK_COLUMNS} FROM books WHERE id = ?", (book_id,)).fetchone()
+            if row is None:
+                raise KeyError(book_id)
+            self._check_revision(conn, book_id, expected_revision)
+            conn.execute("DELETE FROM books WHERE id = ?", (book_id,))
+            self._bump(conn)
+        return _book(row)
+
+    def existing_ids(self, ids: Iterable[int]) -> Set[int]:
+        ids = list(ids)
+        found: Set[int] = set()
+        with self.db.connection() as conn:
+            # stay under SQLite's bound parameter limit
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                found.update(row[0] for row in conn.execute(
+                    f"SELECT id FROM books WHERE id IN ({placeholders})", chunk))
+        return found
+
+    def add_many(self, books: List[dict]) -> None:
+        try:
+            with self.db.transaction() as conn:
+                revision = self._bump(conn)
+                conn.executemany(
+                    f"INSERT INTO books ({_BOOK_COLUMNS}, rev, modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self._values(book) + revision for book in books))
+        except sqlite3.IntegrityError:
+            duplicates = self.existing_ids(book["id"] for book in books) or {book["id"] for book in books}
+            raise KeyError(min(duplicates))
+
+    def replace_many(self, books: List[dict]) -> None:
+        with self.db.transaction() as conn:
+            self._check_exist(conn, [book["id"] for book in books])
+            duplicate = first_duplicate(book["id"] for book in books)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            revision = self._bump(conn)
+            conn.executemany(
+                "UPDATE books SET title = ?, description = ?, author = ?, "
+                "cover_image = ?, price = ?, published = ?, rev = ?, modified = ? WHERE id = ?",
+                (self._values(book)[1:] + revision + (book["id"],) for book in books))
+
+    def delete_many(self, book_ids: List[int]) -> None:
+        with self.db.transaction() as conn:
+            self._check_exist(conn, book_ids)
+            duplicate = first_duplicate(book_ids)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            conn.executemany("DELETE FROM books WHERE id = ?", ((book_id,) for book_id in book_ids))
+            self._bump(conn)
+
+    @staticmethod
+    def _check_exist(conn: sqlite3.Connection, book_ids: List[int]) -> None:
+        for book_id in book_ids:
+            if conn.execute("SELECT 1 FROM books WHERE id = ?", (book_id,)).fetchone() is None:
+                raise KeyError(book_id)
+
+
+# SQLite user repository
+class SQLiteUserStore(UserRepository):
+    """
+    User repository stored in the `users` table.
+    """
+
+    blocking = True
+
+    def __init__(self, db: SQLiteDatabase, seed: Iterable[dict] = ()):
+        self.db = db
+        db.create_schema(USERS_SCHEMA)
+        with db.transaction() as conn:
+            if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+                conn.executemany(f"INSERT INTO users ({_USER_COLUMNS}) VALUES (?, ?, ?, ?)",
+                                 (self._values(user) for user in seed))
+
+    @staticmethod
+    def _values(user: dict) -> tuple:
+        return tuple(user.get(field) for field in USER_FIELDS)
+
+    def __len__(self) -> int:
+        with self.db.connection() as conn:
+            return conn.execute("SELECT count(*) FROM users").fetchone()[0]
+
+    def get(self, username: str) -> Optional[dict]:
+        with self.db.connection() as conn:
+            row = conn.execute(f"SELECT {_USER_COLUMNS} FROM users WHERE username = ?", (username,)).fetchone()
+        return dict(row) if row else None
+
+    def add(self, user: dict) -> None:
+        try:
+            with self.db.transaction() as conn:
+                conn.execute(f"INSERT INTO users ({_USER_COLUMNS}) VALUES (?, ?, ?, ?)", self._values(user))
+        except sqlite3.IntegrityError:
+            raise KeyError(user["username"])
+
+    def update(self, username: str, **fields) -> dict:
+        unknown = set(fields) - set(USER_FIELDS[1:])
+        if unknown:
+            raise ValueError(f"Unknown user fields: {', '.join(sorted(unknown))}")
+        with self.db.transaction() as conn:
+            if fields:
+                assignments = ", ".join(f"{field} = ?" for field in fields)
+                conn.execute(f"UPDATE users SET {assignments} WHERE username = ?",
+                             tuple(fields.values()) + (username,))
+            row = conn.execute(f"SELECT {_USER_COLUMNS} FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            raise KeyError(username)
+        return dict(row)
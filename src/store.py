@@ -0,0 +1,622 @@
+from abc import ABC, abstractmethod
+from array import array
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+import threading
+import time
+
+from indexes import BULK_THRESHOLD, Bitmap, Position, SortedIndex, SortedList, book_matches, sort_key, title_key
+from search import SearchIndex
+from snapshots import SnapshotWriter
+
+# Books per section of a snapshot
+_SNAPSHOT_CHUNK = 10000
+
+
+def first_duplicate(values: Iterable) -> Optional[object]:
+    """
+    Returns the first value that appears a second time, or None if all are unique.
+    """
+    seen = set()
+    for value in values:
+        if value in seen:
+            return value
+        seen.add(value)
+    return None
+
+
+class RevisionConflict(Exception):
+    """
+    Raised by a conditional write when the book is no longer at the expected
+    revision: someone else wrote it since it was read.
+    """
+
+    def __init__(self, book_id: int, revision: int):
+        super().__init__(f"Book {book_id} is at revision {revision}")
+        self.book_id = book_id
+        self.revision = revision
+
+
+# Storage interface for books
+class BookRepository(ABC):
+    """
+    Interface every book storage backend implements. Books are plain dicts with the
+    fields of the `Book` model, keyed by their `id`.
+    """
+
+    # True if methods do I/O, so async callers must run them off the event loop
+    blocking = False
+    # Methods that wait for I/O even though the others don't
+    blocking_methods: FrozenSet[str] = frozenset()
+    # Methods that never wait for the lock scans and batches hold, so they can't be
+    # held up by one
+    lock_free_methods: FrozenSet[str] = frozenset()
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    def __contains__(self, book_id: object) -> bool:
+        return self.get(book_id) is not None
+
+    def __iter__(self) -> Iterator[dict]:
+        for books in self.iter_pages():
+            yield from books
+
+    @abstractmethod
+    def get(self, book_id: int) -> Optional[dict]:
+        """
+        Returns the book with the given ID, or None if it does not exist.
+        """
+
+    @abstractmethod
+    def version(self) -> Tuple[int, float]:
+        """
+        Returns the catalog version and the time of the last write. Every write
+        (including each bulk write) bumps the version, so it changes whenever any
+        listing or search result may have changed.
+        """
+
+    @abstractmethod
+    def revision(self, book_id: int) -> Optional[Tuple[int, float]]:
+        """
+        Returns the revision and last-modified time of a book, or None if it does not
+        exist. A book's revision is the catalog version of its last write, so it is
+        never reused, not even by a book deleted and created again.
+        """
+
+    @abstractmethod
+    def by_author(self, author: str) -> List[dict]:
+        """
+        Returns all books written by the given author.
+        """
+
+    @abstractmethod
+    def search(self, query: str, limit: Optional[int] = None) -> List[dict]:
+        """
+        Returns books whose title, author or description contains `query`
+        (case-insensitive), best matches first.
+        """
+
+    @abstractmethod
+    def page(self, cursor: Optional[int] = None, limit: int = 100) -> Tuple[List[dict], Optional[int]]:
+        """
+        Returns up to `limit` books ordered by ID, starting after the `cursor` ID.
+        Returns:
+            Tuple[List[dict], Optional[int]]: The books, and the cursor for the next
+                page (None when this is the last page).
+        """
+
+    @abstractmethod
+    def find(self, author: Optional[str] = None, published: Optional[bool] = None,
+             price_min: Optional[float] = None, price_max: Optional[float] = None,
+             sort: str = "id", descending: bool = False, after: Optional[Position] = None,
+             limit: int = 100) -> Tuple[List[dict], Optional[Position]]:
+        """
+        Returns up to `limit` books matching every given filter (None means any),
+        ordered by `sort` ("id", "price" or "title", ties broken by ID).
+        Args:
+            price_min (float, optional), price_max (float, optional): Inclusive price range.
+            after (Position, optional): Start after this position in the order (see
+                `indexes.sort_key`), i.e. the position returned with the previous page.
+        Returns:
+            Tuple[List[dict], Optional[Position]]: The books, and the position of the
+                last one (None when this is the last page).
+        """
+
+    def iter_pages(self, cursor: Optional[int] = None, limit: int = 100) -> Iterator[List[dict]]:
+        """
+        Yields the books ordered by ID in pages of `limit`, starting after the
+        `cursor` ID. Each page is fetched by key, so memory stays constant and
+        concurrent writes don't invalidate the iteration.
+        """
+        while True:
+            books, cursor = self.page(cursor, limit)
+            if books:
+                yield books
+            if cursor is None:
+                return
+
+    def iter_find(self, after: Optional[Position] = None, limit: int = 100, **query) -> Iterator[List[dict]]:
+        """
+        Yields every book `find` returns for `query` (filters and order), in pages
+        of `limit`, starting after the `after` position.
+        """
+        while True:
+            books, after = self.find(after=after, limit=limit, **query)
+            if books:
+                yield books
+            if after is None:
+                return
+
+    @abstractmethod
+    def add(self, book: dict) -> None:
+        """
+        Adds a new book to the store.
+        Raises:
+            KeyError: If a book with the same ID already exists.
+        """
+
+    @abstractmethod
+    def replace(self, book_id: int, book: dict, expected_revision: Optional[int] = None) -> dict:
+        """
+        Replaces the book stored under `book_id` with `book`. The new record may
+        carry a different ID, in which case the book is re-keyed.
+        Args:
+            expected_revision (int, optional): Only replace the book if it is still at
+                this revision, checked atomically with the write.
+        Returns:
+            dict: The previous record.
+        Raises:
+            KeyError: If `book_id` does not exist, or if the new ID is already taken
+                by another book.
+            RevisionConflict: If the book is not at `expected_revision`.
+        """
+
+    @abstractmethod
+    def delete(self, book_id: int, expected_revision: Optional[int] = None) -> dict:
+        """
+        Removes the book with the given ID from the store.
+        Args:
+            expected_revision (int, optional): Only delete the book if it is still at
+                this revision, checked atomically with the write.
+        Returns:
+            dict: The deleted record.
+        Raises:
+            KeyError: If the book does not exist.
+            RevisionConflict: If the book is not at `expected_revision`.
+        """
+
+    def existing_ids(self, ids: Iterable[int]) -> Set[int]:
+        """
+        Returns which of the given IDs are taken.
+        """
+        return {book_id for book_id in ids if book_id in self}
+
+    @abstractmethod
+    def add_many(self, books: List[dict]) -> None:
+        """
+        Adds several new books atomically: either all are added or none is.
+        Raises:
+            KeyError: If any of the IDs already exists.
+        """
+
+    @abstractmethod
+    def replace_many(self, books: List[dict]) -> None:
+        """
+        Replaces several books atomically, each one with the record of the same ID.
+        Raises:
+            KeyError: If any of the books does not exist, or an ID is given twice.
+        """
+
+    @abstractmethod
+    def delete_many(self, book_ids: List[int]) -> None:
+        """
+        Removes several books atomically.
+        Raises:
+            KeyError: If any of the books does not exist.
+        """
+
+
+# Storage interface for users
+class UserRepository(ABC):
+    """
+    Interface every user storage backend implements. Users are plain dicts keyed by
+    their `username`.
+    """
+
+    # True if methods do I/O, so async callers must run them off the event loop
+    blocking = False
+    # Methods that wait for I/O even though the others don't
+    blocking_methods: FrozenSet[str] = frozenset()
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    def __contains__(self, username: object) -> bool:
+        return self.get(username) is not None
+
+    @abstractmethod
+    def get(self, username: str) -> Optional[dict]:
+        """
+        Returns the user with the given username, or None if it does not exist.
+        """
+
+    @abstractmethod
+    def add(self, user: dict) -> None:
+        """
+        Adds a new user.
+        Raises:
+            KeyError: If the username is already taken.
+        """
+
+    @abstractmethod
+    def update(self, username: str, **fields) -> dict:
+        """
+        Updates some fields of a user.
+        Returns:
+            dict: The updated user.
+        Raises:
+            KeyError: If the user does not exist.
+        """
+
+
+# In-memory book repository
+class BookStore(BookRepository):
+    """
+    Book repository backed by a hash index of ID -> book record.
+
+    Lookups, duplicate checks, updates and deletes by ID are O(1). Books are also
+    indexed by author, by a `SortedList` of IDs for keyset pagination, by sorted price
+    and title indexes and a bitmap of published IDs for filtered listings and, for
+    search, by an inverted full-text index.
+    """
+
+    # plain dict reads; writers replace records and revisions whole
+    lock_free_methods = frozenset({"get", "version", "revision"})
+
+    def __init__(self, books: Iterable[dict] = ()):
+        self._books: Dict[int, dict] = {}
+        # author -> ordered set of book ids (dict keys keep insertion order)
+        self._by_author: Dict[str, Dict[int, None]] = {}
+        self._ids = SortedList()
+        self._by_price = SortedIndex()
+        self._by_title = SortedIndex()
+        self._published = Bitmap()
+        self._search = SearchIndex()
+        # book id -> (revision, last modified)
+        self._revisions: Dict[int, Tuple[int, float]] = {}
+        self._version: Tuple[int, float] = (0, time.time())
+        self._lock = threading.RLock()
+        # every book gets its own revision, as if added one by one, but the indexes
+        # are built in one pass
+        added = []
+        for book in books:
+            if book["id"] in self._books:
+                raise KeyError(book["id"])
+            self._books[book["id"]] = book
+            self._revisions[book["id"]] = self._bump()
+            added.append(book)
+        self._index_many(added)
+
+    def __len__(self) -> int:
+        return len(self._books)
+
+    def __contains__(self, book_id: object) -> bool:
+        return book_id in self._books
+
+    def get(self, book_id: int) -> Optional[dict]:
+        return self._books.get(book_id)
+
+    def version(self) -> Tuple[int, float]:
+        return self._version
+
+    def revision(self, book_id: int) -> Optional[Tuple[int, float]]:
+        return self._revisions.get(book_id)
+
+    def by_author(self, author: str) -> List[dict]:
+        with self._lock:
+            ids = self._by_author.get(author, {})
+            return [self._books[book_id] for book_id in ids]
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[dict]:
+        with self._lock:
+            ids = self._search.search(query, self._books.get, limit)
+            return [self._books[book_id] for book_id in ids]
+
+    def page(self, cursor: Optional[int] = None, limit: int = 100) -> Tuple[List[dict], Optional[int]]:
+        with self._lock:
+            start = 0 if cursor is None else self._ids.bisect_right(cursor)
+            ids = list(self._ids.islice(start, start + limit))
+            books = [self._books[book_id] for book_id in ids]
+            more = start + limit < len(self._ids)
+        return books, (ids[-1] if more and ids else None)
+
+    def find(self, author: Optional[str] = None, published: Optional[bool] = None,
+             price_min: Optional[float] = None, price_max: Optional[float] = None,
+             sort: str = "id", descending: bool = False, after: Optional[Position] = None,
+             limit: int = 100) -> Tuple[List[dict], Optional[Position]]:
+        with self._lock:
+            priced = price_min is not None or price_max is not None
+            # either walk an index in the requested order, skipping books that don't
+            # match, or sort a small set of candidates: an author's books, or a narrow
+            # price range (when it holds fewer books than walking would visit)
+            candidates = None
+            if author is not None:
+                candidates = self._by_author.get(author, {})
+            elif sort == "price":
+                walk = self._by_price.walk(after, descending, price_min, price_max)
+                priced = False
+            elif priced and self._by_price.count(price_min, price_max) ** 2 <= limit * len(self._books):
+                candidates = [book_id for _, book_id in self._by_price.walk(lo=price_min, hi=price_max)]
+            elif sort == "title":
+                walk = self._by_title.walk(after, descending)
+            else:
+                walk = self._walk_ids(after, descending)
+
+            if candidates is not None:
+                positions = sorted(sort_key(self._books[book_id], sort) for book_id in candidates)
+                if descending:
+                    positions.reverse()
+                if after is not None:
+                    positions = [p for p in positions if (p < after if descending else p > after)]
+                walk = iter(positions)
+
+            books = []
+            for _, book_id in walk:
+                if published is not None and (book_id in self._published) != published:
+                    continue
+                book = self._books[book_id]
+                if priced and not book_matches(book, author, None, price_min, price_max):
+                    continue
+                books.append(book)
+                if len(books) > limit:
+                    break
+        if len(books) > limit:
+            return books[:limit], sort_key(books[limit - 1], sort)
+        return books, None
+
+    def _walk_ids(self, after: Optional[Position], descending: bool) -> Iterator[Position]:
+        ids = self._ids
+        if descending:
+            stop = len(ids) if after is None else ids.bisect_left(after[1])
+            walk = ids.islice(0, stop, descending=True)
+        else:
+            start = 0 if after is None else ids.bisect_right(after[1])
+            walk = ids.islice(start, len(ids))
+        for book_id in walk:
+            yield book_id, book_id
+
+    def add(self, book: dict) -> None:
+        with self._lock:
+            book_id = book["id"]
+            if book_id in self._books:
+                raise KeyError(book_id)
+            self._books[book_id] = book
+            self._index(book)
+            self._revisions[book_id] = self._bump()
+
+    def replace(self, book_id: int, book: dict, expected_revision: Optional[int] = None) -> dict:
+        with self._lock:
+            old = self._books[book_id]
+            self._check_revision(book_id, expected_revision)
+            new_id = book["id"]
+            if new_id != book_id and new_id in self._books:
+                raise KeyError(new_id)
+            self._unindex(old)
+            if new_id == book_id:
+                self._books[book_id] = book
+            else:
+                del self._books[book_id]
+                del self._revisions[book_id]
+                self._books[new_id] = book
+            self._index(book)
+            self._revisions[new_id] = self._bump()
+            return old
+
+    def delete(self, book_id: int, expected_revision: Optional[int] = None) -> dict:
+        with self._lock:
+            book = self._books[book_id]
+            self._check_revision(book_id, expected_revision)
+            del self._books[book_id]
+            self._unindex(book)
+            del self._revisions[book_id]
+            self._bump()
+            return book
+
+    def existing_ids(self, ids: Iterable[int]) -> Set[int]:
+        return {book_id for book_id in ids if book_id in self._books}
+
+    def add_many(self, books: List[dict]) -> None:
+        with self._lock:
+            ids = [book["id"] for book in books]
+            duplicate = first_duplicate(ids)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            for book_id in ids:
+                if book_id in self._books:
+                    raise KeyError(book_id)
+            for book in books:
+                self._books[book["id"]] = book
+            self._index_many(books)
+            revision = self._bump()
+            for book_id in ids:
+                self._revisions[book_id] = revision
+
+    def replace_many(self, books: List[dict]) -> None:
+        with self._lock:
+            duplicate = first_duplicate(book["id"] for book in books)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            for book in books:
+                if book["id"] not in self._books:
+                    raise KeyError(book["id"])
+            self._unindex_many([self._books[book["id"]] for book in books])
+            for book in books:
+                self._books[book["id"]] = book
+            self._index_many(books)
+            revision = self._bump()
+            for book in books:
+                self._revisions[book["id"]] = revision
+
+    def delete_many(self, book_ids: List[int]) -> None:
+        with self._lock:
+            duplicate = first_duplicate(book_ids)
+            if duplicate is not None:
+                raise KeyError(duplicate)
+            for book_id in book_ids:
+                if book_id not in self._books:
+                    raise KeyError(book_id)
+            self._unindex_many([self._books.pop(book_id) for book_id in book_ids])
+            for book_id in book_ids:
+                del self._revisions[book_id]
+            self._bump()
+
+    def _bump(self) -> Tuple[int, float]:
+        # called with the lock held, after the data changed, so a version never
+        # labels data older than itself
+        self._version = (self._version[0] + 1, time.time())
+        return self._version
+
+    def _check_revision(self, book_id: int, expected_revision: Optional[int]) -> None:
+        # called with the lock held, before anything changes
+        if expected_revision is not None and self._revisions[book_id][0] != expected_revision:
+            raise RevisionConflict(book_id, self._revisions[book_id][0])
+
+    # Secondary index maintenance
+    def _index(self, book: dict) -> None:
+        self._by_author.setdefault(book["author"], {})[book["id"]] = None
+        self._ids.add(book["id"])
+        self._by_price.add(book["price"], book["id"])
+        self._by_title.add(title_key(book["title"]), book["id"])
+        if book["published"]:
+            self._published.add(book["id"])
+        self._search.add(book)
+
+    def _unindex(self, book: dict) -> None:
+        ids = self._by_author.get(book["author"])
+        if ids is not None:
+            ids.pop(book["id"], None)
+            if not ids:
+                del self._by_author[book["author"]]
+        self._ids.remove(book["id"])
+        self._by_price.remove(book["price"], book["id"])
+        self._by_title.remove(title_key(book["title"]), book["id"])
+        self._published.discard(book["id"])
+        self._search.remove(book)
+
+    def _index_many(self, books: List[dict]) -> None:
+        if len(books) <= BULK_THRESHOLD:
+            for book in books:
+                self._index(book)
+            return
+        for book in books:
+            self._by_author.setdefault(book["author"], {})[book["id"]] = None
+            if book["published"]:
+                self._published.add(book["id"])
+            self._search.add(book)
+        self._ids.update([book["id"] for book in books])
+        self._by_price.add_many([(book["price"], book["id"]) for book in books])
+        self._by_title.add_many([(title_key(book["title"]), book["id"]) for book in books])
+
+    def _unindex_many(self, books: List[dict]) -> None:
+        if len(books) <= BULK_THRESHOLD:
+            for book in books:
+                self._unindex(book)
+            return
+        for book in books:
+            ids = self._by_author.get(book["author"])
+            if ids is not None:
+                ids.pop(book["id"], None)
+                if not ids:
+                    del self._by_author[book["author"]]
+            self._published.discard(book["id"])
+            self._search.remove(book)
+        self._ids.remove_many([book["id"] for book in books])
+        self._by_price.remove_many([(book["price"], book["id"]) for book in books])
+        self._by_title.remove_many([(title_key(book["title"]), book["id"]) for book in books])
+
+    # Snapshots
+    def snapshot(self) -> Callable[[SnapshotWriter], None]:
+        """
+        Captures the catalog and returns a function writing it to a snapshot. Only
+        the capture, a copy of the record references, holds the lock: records are
+        replaced rather than changed in place, so the snapshot can be written while
+        writes go on.
+        """
+        with self._lock:
+            books = list(self._books.values())
+            revisions = [self._revisions[book["id"]] for book in books]
+            version = self._version
+
+        def write(writer: SnapshotWriter) -> None:
+            writer.section("version", list(version))
+            writer.section("revisions", array("q", [revision for revision, _ in revisions]))
+            writer.section("modified", array("d", [modified for _, modified in revisions]))
+            for start in range(0, len(books), _SNAPSHOT_CHUNK):
+                writer.section("books", books[start:start + _SNAPSHOT_CHUNK])
+        return write
+
+    @classmethod
+    def restore(cls, sections: List[Tuple[str, Any]]) -> "BookStore":
+        """
+        Rebuilds a store from the sections of a snapshot written by `snapshot`. The
+        secondary indexes are rebuilt from the records.
+        """
+        store = cls()
+        books = [book for name, chunk in sections if name == "books" for book in chunk]
+        values = dict(sections)
+        for book, revision, modified in zip(books, values["revisions"], values["modified"]):
+            store._books[book["id"]] = book
+            store._revisions[book["id"]] = (revision, modified)
+        store._index_many(books)
+        store._version = tuple(values["version"])
+        return store
+
+
+# In-memory user repository
+class UserStore(UserRepository):
+    """
+    User repository backed by a dict of username -> user record.
+    """
+
+    def __init__(self, users: Iterable[dict] = ()):
+        self._users: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        for user in users:
+            self.add(user)
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def __contains__(self, username: object) -> bool:
+        return username in self._users
+
+    def get(self, username: str) -> Optional[dict]:
+        return self._users.get(username)
+
+    def add(self, user: dict) -> None:
+        with self._lock:
+            if user["username"] in self._users:
+                raise KeyError(user["username"])
+            self._users[user["username"]] = user
+
+    def update(self, username: str, **fields) -> dict:
+        with self._lock:
+            user = self._users[username]
+            user.update(fields)
+            return user
+
+    # Snapshots
+    def snapshot(self) -> Callable[[SnapshotWriter], None]:
+        """
+        Captures the users (copies, as updates change records in place) and returns
+        a function writing them to a snapshot.
+        """
+        with self._lock:
+            users = [dict(user) for user in self._users.values()]
+        return lambda writer: writer.section("users", users)
+
+    @classmethod
+    def restore(cls, sections: List[Tuple[str, Any]]) -> "UserStore":
+        return cls(dict(sections)["users"])
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import threading
+import time
+
+from app_constants import TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL
+
+
+# Cache of decoded access tokens
+class TokenCache:
+    """
+    LRU cache of decoded JWT payloads keyed by the raw token, so a token reused for
+    many requests is only signature-checked and parsed once.
+
+    An entry never outlives the token's `exp` claim (tokens without one are kept for
+    `ttl` seconds), and `invalidate` drops a token explicitly, e.g. on logout.
+    """
+
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[dict, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, token: str) -> Optional[dict]:
+        """
+        Returns the cached payload of `token`, or None if it isn't cached or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                payload, expires = entry
+                if expires > time.time():
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return payload
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token: str, payload: dict) -> None:
+        """
+        Caches the payload of a token whose signature and claims were just verified.
+        """
+        if self.maxsize <= 0:
+            return
+        expires = payload.get("exp")
+        if not isinstance(expires, (int, float)):
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._entries[token] = (payload, expires)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+token_cache = TokenCache()
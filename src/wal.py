@@ -0,0 +1,394 @@
+from typing import Any, Callable, Iterable, List, Optional, Set, Tuple
+import os
+import struct
+import threading
+import time
+import zlib
+
+from app_constants import WAL_COMMIT_DELAY, WAL_FSYNC, WAL_SNAPSHOT_EVERY
+from encoding import dumps, loads
+from indexes import Position
+from snapshots import SnapshotWriter, read_snapshot
+from store import BookRepository, UserRepository
+
+# A log record: payload length and CRC-32, then the payload, a JSON
+# [method, args, kwargs] list
+_FRAME = struct.Struct("<II")
+
+SNAPSHOT_FILE = "snapshot"
+SEGMENT_PREFIX = "log."
+
+
+def segment_path(directory: str, seq: int) -> str:
+    return os.path.join(directory, f"{SEGMENT_PREFIX}{seq:010d}")
+
+
+def list_segments(directory: str) -> List[int]:
+    """
+    The sequence numbers of the log segments in a directory, in order.
+    """
+    return sorted(int(name[len(SEGMENT_PREFIX):]) for name in os.listdir(directory)
+                  if name.startswith(SEGMENT_PREFIX) and name[len(SEGMENT_PREFIX):].isdigit())
+
+
+def read_segment(path: str) -> Tuple[List[list], int]:
+    """
+    Reads the records of a log segment, up to the first incomplete or corrupt one.
+    Returns:
+        Tuple[List[list], int]: The records, and the size of the valid part of the file.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    records = []
+    offset = 0
+    while offset + _FRAME.size <= len(data):
+        length, crc = _FRAME.unpack_from(data, offset)
+        payload = data[offset + _FRAME.size:offset + _FRAME.size + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            break
+        records.append(loads(payload))
+        offset += _FRAME.size + length
+    return records, offset
+
+
+def fsync_directory(directory: str) -> None:
+    # makes renames and new files in the directory durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Append-only log with group commit
+class WriteAheadLog:
+    """
+    Appends records to the current segment file of a log directory.
+
+    `append` only queues a record; a flusher thread writes everything queued in one
+    write and one fsync, then wakes the writers waiting for it in `wait`. Writers
+    arriving while an fsync is in progress are all committed by the next one, so
+    the number of fsyncs stays flat as the number of concurrent writers grows.
+    `commit_delay` makes the flusher wait that much longer before writing, to
+    gather bigger groups at the cost of latency.
+
+    A failed write or fsync fails every waiting and later commit: the log can no
+    longer be trusted to match memory.
+    """
+
+    def __init__(self, directory: str, seq: int, fsync: bool = WAL_FSYNC, commit_delay: float = WAL_COMMIT_DELAY):
+        self.directory = directory
+        self.seq = seq
+        self.fsync = fsync
+        self.commit_delay = commit_delay
+        # number of flushes, each committing a group of records
+        self.commits = 0
+        self._file = open(segment_path(directory, seq), "ab")
+        self._pending: List[bytes] = []
+        # sequence numbers of the last record appended and of the last one on disk
+        self._appended = 0
+        self._durable = 0
+        self._error: Optional[OSError] = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._flusher = threading.Thread(target=self._flush_loop, name="wal-flusher", daemon=True)
+        self._flusher.start()
+
+    def append(self, record: list) -> int:
+        """
+        Queues a record.
+        Returns:
+            int: The record's sequence number, to pass to `wait`.
+        """
+        payload = dumps(record)
+        frame = _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                raise ValueError("The write-ahead log is closed")
+            self._pending.append(frame)
+            self._appended += 1
+            self._cond.notify_all()
+            return self._appended
+
+    def wait(self, lsn: int) -> None:
+        """
+        Blocks until the record `lsn` is on disk.
+        Raises:
+            OSError: If writing the log failed.
+        """
+        with self._cond:
+            while self._durable < lsn:
+                if self._error is not None:
+                    raise self._error
+                self._cond.wait()
+
+    def rotate(self) -> int:
+        """
+        Waits for every queued record to be on disk, then starts a new segment. The
+        caller must keep records from being appended meanwhile.
+        Returns:
+            int: The sequence number of the new segment.
+        """
+        with self._cond:
+            while self._durable < self._appended and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            self._file.close()
+            self.seq += 1
+            self._file = open(segment_path(self.directory, self.seq), "ab")
+        fsync_directory(self.directory)
+        return self.seq
+
+    def close(self) -> None:
+        """
+        Writes out the queued records and closes the segment.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join()
+        self._file.close()
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+            with self._cond:
+                frames, self._pending = self._pending, []
+                lsn = self._appended
+                file = self._file
+            try:
+                file.write(b"".join(frames))
+                file.flush()
+                if self.fsync:
+                    os.fsync(file.fileno())
+            except OSError as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._durable = lsn
+                self.commits += 1
+                self._cond.notify_all()
+
+
+# Write-ahead logging and snapshots of an in-memory repository
+class Journal:
+    """
+    Makes an in-memory repository (`BookStore`, `CompactBookStore` or `UserStore`)
+    durable with a write-ahead log and periodic snapshots in `directory`.
+
+    Every write is applied in memory and appended to the log under one lock, so the
+    log has the writes in the order they were applied, then waits outside the lock
+    for its group commit. A write is visible to readers slightly before it is on
+    disk, but is never acknowledged before.
+
+    After `snapshot_every` logged writes a snapshot is taken in the background: the
+    store's state is captured and the log moves to a new segment under the lock,
+    then the snapshot is written to a temporary file and renamed over the previous
+    one, and the segments it covers are deleted. Opening a journal loads the
+    snapshot and replays the segments after it; a torn record at the end of the log
+    (a crash during a write) is dropped. A new directory is seeded with `seed`.
+    """
+
+    def __init__(self, directory: str, store_class: type, seed: Iterable[dict] = (), fsync: bool = WAL_FSYNC,
+                 commit_delay: float = WAL_COMMIT_DELAY, snapshot_every: int = WAL_SNAPSHOT_EVERY):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._since_snapshot = 0
+        self._checkpointing = False
+
+        os.makedirs(directory, exist_ok=True)
+        snapshot = os.path.join(directory, SNAPSHOT_FILE)
+        segments = list_segments(directory)
+        if not segments and not os.path.exists(snapshot):
+            # the seed goes straight to a first snapshot
+            self.store = store_class(seed)
+            seq = 1
+            self._write_snapshot(self.store.snapshot(), seq)
+        elif os.path.exists(snapshot):
+            with open(snapshot, "rb") as f:
+                meta, sections = read_snapshot(f)
+            if meta["store"] != store_class.__name__:
+                raise ValueError(f"{directory} holds a {meta['store']} snapshot, not a {store_class.__name__} one")
+            self.store = store_class.restore(sections)
+            seq = meta["seq"]
+        else:
+            self.store = store_class()
+            seq = segments[0]
+
+        # replay the log after the snapshot, then append to a new segment
+        replay = [segment for segment in segments if segment >= seq]
+        for segment in replay:
+            path = segment_path(directory, segment)
+            records, valid = read_segment(path)
+            if valid < os.path.getsize(path):
+                if segment != replay[-1]:
+                    raise ValueError(f"Corrupt write-ahead log segment {path}")
+                with open(path, "r+b") as f:
+                    f.truncate(valid)
+            for method, args, kwargs in records:
+                getattr(self.store, method)(*args, **kwargs)
+            self._since_snapshot += len(records)
+        self.log = WriteAheadLog(directory, max([seq - 1, *replay]) + 1, fsync, commit_delay)
+
+    def write(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        """
+        Applies a write to the store and commits it to the log.
+        Returns:
+            Any: What the store method returned.
+        Raises:
+            KeyError, RevisionConflict: As raised by the store, in which case nothing
+                is logged.
+        """
+        with self._lock:
+            result = getattr(self.store, method)(*args, **kwargs)
+            lsn = self.log.append([method, args, kwargs])
+            self._since_snapshot += 1
+            snapshot = self._since_snapshot >= self.snapshot_every and not self._checkpointing
+            if snapshot:
+                self._checkpointing = True
+        if snapshot:
+            threading.Thread(target=self.checkpoint, name="wal-snapshot", daemon=True).start()
+        self.log.wait(lsn)
+        return result
+
+    def checkpoint(self) -> None:
+        """
+        Takes a snapshot and deletes the log segments it makes redundant.
+        """
+        with self._checkpoint_lock:
+            try:
+                with self._lock:
+                    write = self.store.snapshot()
+                    seq = self.log.rotate()
+                    self._since_snapshot = 0
+                self._write_snapshot(write, seq)
+                for segment in list_segments(self.directory):
+                    if segment < seq:
+                        os.remove(segment_path(self.directory, segment))
+            finally:
+                self._checkpointing = False
+
+    def _write_snapshot(self, write: Callable[[SnapshotWriter], None], seq: int) -> None:
+        # replaces the snapshot atomically; `seq` is the first log segment it doesn't cover
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + ".tmp", "wb") as f:
+            writer = SnapshotWriter(f, {"store": type(self.store).__name__, "seq": seq})
+            write(writer)
+            writer.close()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        fsync_directory(self.directory)
+
+    def close(self) -> None:
+        self.log.close()
+
+
+# Durable in-memory book repository
+class DurableBookStore(BookRepository):
+    """
+    An in-memory book repository whose writes go through a `Journal`. Reads are
+    served by the in-memory store as they are.
+    """
+
+    # writes wait for their group commit
+    blocking_methods = frozenset({"add", "replace", "delete", "add_many", "replace_many", "delete_many"})
+
+    def __init__(self, directory: str, store_class: type, seed: Iterable[dict] = (), **options: Any):
+        self.journal = Journal(directory, store_class, seed, **options)
+        self.store: BookRepository = self.journal.store
+        self.lock_free_methods = self.store.lock_free_methods
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __contains__(self, book_id: object) -> bool:
+        return book_id in self.store
+
+    def get(self, book_id: int) -> Optional[dict]:
+        return self.store.get(book_id)
+
+    def version(self) -> Tuple[int, float]:
+        return self.store.version()
+
+    def revision(self, book_id: int) -> Optional[Tuple[int, float]]:
+        return self.store.revision(book_id)
+
+    def by_author(self, author: str) -> List[dict]:
+        return self.store.by_author(author)
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[dict]:
+        return self.store.search(query, limit)
+
+    def page(self, cursor: Optional[int] = None, limit: int = 100) -> Tuple[List[dict], Optional[int]]:
+        return self.store.page(cursor, limit)
+
+    def find(self, author: Optional[str] = None, published: Optional[bool] = None,
+             price_min: Optional[float] = None, price_max: Optional[float] = None,
+             sort: str = "id", descending: bool = False, after: Optional[Position] = None,
+             limit: int = 100) -> Tuple[List[dict], Optional[Position]]:
+        return self.store.find(author, published, price_min, price_max, sort, descending, after, limit)
+
+    def existing_ids(self, ids: Iterable[int]) -> Set[int]:
+        return self.store.existing_ids(ids)
+
+    def add(self, book: dict) -> None:
+        self.journal.write("add", book)
+
+    def replace(self, book_id: int, book: dict, expected_revision: Optional[int] = None) -> dict:
+        # the store checks the revision under the journal lock, and a write that fails
+        # the check isn't logged
+        return self.journal.write("replace", book_id, book, expected_revision=expected_revision)
+
+    def delete(self, book_id: int, expected_revision: Optional[int] = None) -> dict:
+        return self.journal.write("delete", book_id, expected_revision=expected_revision)
+
+    def add_many(self, books: List[dict]) -> None:
+        self.journal.write("add_many", books)
+
+    def replace_many(self, books: List[dict]) -> None:
+        self.journal.write("replace_many", books)
+
+    def delete_many(self, book_ids: List[int]) -> None:
+        self.journal.write("delete_many", book_ids)
+
+
+# Durable in-memory user repository
+class DurableUserStore(UserRepository):
+    """
+    An in-memory user repository whose writes go through a `Journal`.
+    """
+
+    blocking_methods = frozenset({"add", "update"})
+
+    def __init__(self, directory: str, store_class: type, seed: Iterable[dict] = (), **options: Any):
+        self.journal = Journal(directory, store_class, seed, **options)
+        self.store: UserRepository = self.journal.store
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __contains__(self, username: object) -> bool:
+        return username in self.store
+
+    def get(self, username: str) -> Optional[dict]:
+        return self.store.get(username)
+
+    def add(self, user: dict) -> None:
+        self.journal.write("add", user)
+
+    def update(self, username: str, **fields) -> dict:
+        return self.journal.write("update", username, **fields)
@@ -0,0 +1,101 @@
+from typing import Any, Callable, Iterator, List, Optional
+from xml.sax.saxutils import escape, quoteattr
+import re
+
+# Same document layout json2xml produces: an <all> root, elements named after dict
+# keys, <item> elements for list entries, and a `type` attribute on every element.
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" ?>'
+ROOT = "all"
+
+_NAME_RE = re.compile(r"^[A-Za-z_][\w.-]*$")
+
+
+def open_tag(name: str, type_name: str) -> str:
+    if _NAME_RE.match(name) and not name.lower().startswith("xml"):
+        return f'<{name} type="{type_name}">'
+    # keys that aren't valid element names go in an attribute instead
+    return f'<key name={quoteattr(name)} type="{type_name}">'
+
+
+def close_tag(name: str) -> str:
+    if _NAME_RE.match(name) and not name.lower().startswith("xml"):
+        return f"</{name}>"
+    return "</key>"
+
+
+def write_value(parts: List[str], name: str, value: Any) -> None:
+    """
+    Appends the XML for `value`, wrapped in an element called `name`, to `parts`.
+    """
+    if value is None:
+        parts.append(open_tag(name, "null"))
+    elif isinstance(value, bool):
+        parts.append(open_tag(name, "bool"))
+        parts.append("true" if value else "false")
+    elif isinstance(value, str):
+        parts.append(open_tag(name, "str"))
+        parts.append(escape(value))
+    elif isinstance(value, int):
+        parts.append(open_tag(name, "int"))
+        parts.append(str(value))
+    elif isinstance(value, float):
+        parts.append(open_tag(name, "float"))
+        parts.append(repr(value))
+    elif isinstance(value, dict):
+        parts.append(open_tag(name, "dict"))
+        for key, item in value.items():
+            write_value(parts, str(key), item)
+    elif isinstance(value, (list, tuple)):
+        parts.append(open_tag(name, "list"))
+        for item in value:
+            write_value(parts, "item", item)
+    else:
+        parts.append(open_tag(name, "str"))
+        parts.append(escape(str(value)))
+    parts.append(close_tag(name))
+
+
+def element(name: str, value: Any) -> str:
+    """
+    Returns the XML of `value` wrapped in an element called `name`.
+    """
+    parts: List[str] = []
+    write_value(parts, name, value)
+    return "".join(parts)
+
+
+def item_xml(value: Any) -> str:
+    """
+    Returns the XML of one list entry.
+    """
+    return element("item", value)
+
+
+def to_xml(content: Any) -> bytes:
+    """
+    Serializes JSON-compatible content into an XML document.
+    """
+    parts = [XML_DECLARATION, f"<{ROOT}>"]
+    if isinstance(content, dict):
+        for key, value in content.items():
+            write_value(parts, str(key), value)
+    else:
+        write_value(parts, "item", content)
+    parts.append(f"</{ROOT}>")
+    return "".join(parts).encode()
+
+
+def iter_xml_list(key: str, pages: Iterator[List[Any]],
+                  encode_items: Optional[Callable[[List[Any]], List[bytes]]] = None) -> Iterator[bytes]:
+    """
+    Streams an XML document holding a single list under `key`, one chunk per page,
+    so arbitrarily long lists are written in constant memory. `encode_items` may
+    supply the encoded entries of a page, e.g. from cached blobs.
+    """
+    yield f"{XML_DECLARATION}<{ROOT}>{open_tag(key, 'list')}".encode()
+    for page in pages:
+        if encode_items is not None:
+            yield b"".join(encode_items(page))
+        else:
+            yield "".join(item_xml(item) for item in page).encode()
+    yield f"{close_tag(key)}</{ROOT}>".encode()
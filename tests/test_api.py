@@ -1,6 +1,10 @@
 from fastapi.testclient import TestClient
 import sys
 import os
+import json
+import asyncio
+import threading
+from xml.etree import ElementTree
 
 # Add the path of the directory containing build.py to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
@@ -9,6 +13,10 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 's
 from build import app
 from data import users_db, books_db
 from models import User, Book
+from credentials import credential_cache
+from kdf_pool import kdf_pool
+from token_cache import token_cache
+from http_cache import SingleFlight, response_cache
 
 
 client = TestClient(app)
@@ -50,6 +58,19 @@ def test_login_with_already_logged_in_user():
     client.post("/logout", headers=headers)
 
 
+# test 4
+def test_login_when_kdf_pool_saturated():
+    credential_cache.clear()
+    max_pending = kdf_pool.max_pending
+    kdf_pool.max_pending = 0
+    try:
+        response = client.post("/login", auth=("wookie2", "wookie2@123"))
+    finally:
+        kdf_pool.max_pending = max_pending
+    assert response.status_code == 503
+    assert response.headers.get("Retry-After") == str(kdf_pool.retry_after)
+
+
 # TEST LOGOUT ENDPOINT
 # test 1
 def test_successful_logout():
@@ -63,6 +84,8 @@ def test_successful_logout():
     response = client.post("/logout", headers=headers)
     assert response.status_code == 200
     assert response.json()["message"] == "You have been logged out."
+    # the decoded token is dropped from the token cache
+    assert token_cache.get(token) is None
 
 
 # test 2
@@ -97,6 +120,79 @@ def test_get_all_books():
     assert response.status_code == 200
     assert len(response.json()["books"]) == 3
 
+# test 2 (paginate with limit and cursor)
+def test_get_books_paginated():
+    response = client.get("/books?limit=2")
+    assert response.status_code == 200
+    assert [book["id"] for book in response.json()["books"]] == [1, 2]
+    next_cursor = response.json()["next_cursor"]
+    assert next_cursor == 2
+
+    response = client.get(f"/books?limit=2&cursor={next_cursor}")
+    assert [book["id"] for book in response.json()["books"]] == [3]
+    assert response.json()["next_cursor"] is None
+
+# test 3 (stream every book)
+def test_get_books_streamed():
+    response = client.get("/books?stream=ndjson")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [1, 2, 3]
+
+    response = client.get("/books?stream=json&cursor=1")
+    assert [book["id"] for book in response.json()["books"]] == [2, 3]
+
+# test 4 (xml through Accept, and through the legacy Content-Type)
+def test_get_books_as_xml():
+    response = client.get("/books?limit=1", headers={"Accept": "application/xml"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/xml"
+    assert "Accept" in response.headers["vary"]
+    root = ElementTree.fromstring(response.content)
+    assert root.tag == "all"
+    assert root.find("books/item/title").text == "The Big Adventure"
+    assert root.find("books/item/id").get("type") == "int"
+
+    response = client.get("/books/100", headers={"Content-Type": "application/xml"})
+    assert response.status_code == 404
+    assert ElementTree.fromstring(response.content).find("detail").text == "Book not found!"
+
+    # JSON wins when preferred
+    response = client.get("/books", headers={"Accept": "application/xml;q=0.5, application/json"})
+    assert response.headers["content-type"] == "application/json"
+
+# test 5 (streamed xml)
+def test_get_books_streamed_as_xml():
+    response = client.get("/books?stream=ndjson", headers={"Accept": "text/xml"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/xml"
+    root = ElementTree.fromstring(response.content)
+    assert [item.find("id").text for item in root.find("books")] == ["1", "2", "3"]
+
+# test 6 (filter and sort, page by page)
+def test_get_books_filtered_and_sorted():
+    response = client.get("/books?published=true")
+    assert [book["id"] for book in response.json()["books"]] == [1, 2]
+
+    response = client.get("/books?author=wookie1&price_min=11")
+    assert [book["id"] for book in response.json()["books"]] == [3]
+
+    response = client.get("/books?sort=price&order=desc&limit=2")
+    assert [book["id"] for book in response.json()["books"]] == [3, 1]
+    next_cursor = response.json()["next_cursor"]
+    response = client.get(f"/books?sort=price&order=desc&limit=2&cursor={next_cursor}")
+    assert [book["id"] for book in response.json()["books"]] == [2]
+    assert response.json()["next_cursor"] is None
+
+    response = client.get("/books?sort=title&published=false&stream=ndjson")
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [3]
+
+    response = client.get("/books?query=the&sort=price&price_max=11")
+    assert [book["id"] for book in response.json()["search_results"]] == [2, 1]
+
+    response = client.get("/books?sort=price&cursor=garbage")
+    assert response.status_code == 422
+
 # TEST GET BOOK BY ID ENDPOINT
 # test 1
 def test_get_book_by_id():
@@ -149,8 +245,8 @@ def test_create_book_successfully():
     create_book_response = client.post("/books", json=new_book, headers=headers)
     assert create_book_response.status_code == 201
     assert create_book_response.json() == {"message": "Book created successfully"}
-    assert new_book in books_db
-    del books_db[-1]
+    assert books_db.get(new_book["id"]) == new_book
+    books_db.delete(new_book["id"])
     
     # logout
     client.post("/logout", headers=headers)
@@ -174,7 +270,7 @@ def test_create_book_unauthorized():
     response = client.post("/books", json=new_book, headers=headers)
     assert response.status_code == 401
     assert response.json()["detail"] == "User is not authorized to create book"
-    assert new_book not in books_db
+    assert books_db.get(new_book["id"]) != new_book
 
     # logout
     client.post("/logout", headers=headers)
@@ -198,7 +294,7 @@ def test_create_book_forbidden():
     create_response = client.post("/books", json=new_book, headers=headers)
     assert create_response.status_code == 403
     assert create_response.json()["detail"] == "Darth Vader is not allowed to publish his work on Wookie Books"
-    assert new_book not in books_db
+    assert books_db.get(new_book["id"]) != new_book
     # logout
     client.post("/logout", headers=headers)
 
@@ -336,4 +432,312 @@ def test_delete_book():
     # test deleting a book as a non-author user
     response = client.delete("/books/20", headers=login_headers)
     assert response.status_code == 403
-    assert response.json() == {"detail": "User is not authorized to delete book"}
\ No newline at end of file
+    assert response.json() == {"detail": "User is not authorized to delete book"}
+
+# TEST BULK ENDPOINTS
+def make_bulk_book(book_id, author="wookie2", **fields):
+    return {
+        "id": book_id,
+        "title": f"Bulk Book {book_id}",
+        "description": "Published in bulk",
+        "author": author,
+        "cover_image": None,
+        "price": 1.5,
+        "published": True,
+        **fields,
+    }
+
+# test 1
+def test_bulk_create_update_delete():
+    login_response = client.post("/login", auth=("wookie2", "wookie2@123"))
+    headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+    # create from a JSON array
+    books = [make_bulk_book(book_id) for book_id in (500, 501, 502)]
+    response = client.post("/books/bulk", json=books, headers=headers)
+    assert response.status_code == 201
+    assert response.json()["count"] == 3
+    assert books_db.get(501) == books[1]
+
+    # create from NDJSON
+    body = "\n".join(json.dumps(make_bulk_book(book_id)) for book_id in (503, 504))
+    response = client.post("/books/bulk", content=body,
+                           headers={**headers, "Content-Type": "application/x-ndjson"})
+    assert response.status_code == 201
+    assert books_db.get(504)["title"] == "Bulk Book 504"
+
+    # update
+    response = client.put("/books/bulk", json=[make_bulk_book(500, title="Renamed"),
+                                               make_bulk_book(501, price=9.99)], headers=headers)
+    assert response.status_code == 200
+    assert books_db.get(500)["title"] == "Renamed"
+    assert books_db.get(501)["price"] == 9.99
+
+    # delete, by ID or by object
+    response = client.request("DELETE", "/books/bulk", json=[500, 501, {"id": 502}, 503, 504], headers=headers)
+    assert response.status_code == 200
+    assert response.json()["count"] == 5
+    assert books_db.existing_ids([500, 501, 502, 503, 504]) == set()
+
+    client.post("/logout", headers=headers)
+
+# test 2
+def test_bulk_create_atomic_rejects_whole_batch():
+    login_response = client.post("/login", auth=("wookie2", "wookie2@123"))
+    headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+    books = [
+        make_bulk_book(600),
+        make_bulk_book(1000),                       # already exists
+        make_bulk_book(600),                        # repeated in the batch
+        make_bulk_book(601, author="wookie1"),      # someone else's book
+        {"id": 602, "author": "wookie2"},           # invalid
+    ]
+    response = client.post("/books/bulk", json=books, headers=headers)
+    assert response.status_code == 400
+    errors = response.json()["detail"]["errors"]
+    assert [(e["index"], e["status"]) for e in errors] == [(1, 400), (2, 400), (3, 401), (4, 422)]
+    assert books_db.get(600) is None
+
+    # non-atomic: the valid item goes in, every item gets a result
+    response = client.post("/books/bulk?atomic=false", json=books, headers=headers)
+    assert response.status_code == 207
+    assert [r["status"] for r in response.json()["results"]] == [201, 400, 400, 401, 422]
+    assert books_db.get(600) is not None
+
+    # updates and deletes of other users' books are rejected
+    response = client.put("/books/bulk", json=[make_bulk_book(3, author="wookie1")], headers=headers)
+    assert response.status_code == 400
+    response = client.request("DELETE", "/books/bulk?atomic=false", json=[600, 3, 12345], headers=headers)
+    assert [r["status"] for r in response.json()["results"]] == [200, 403, 404]
+    assert books_db.get(3) is not None
+
+    client.post("/logout", headers=headers)
+
+# TEST CONDITIONAL GETS (ETag / Last-Modified)
+# test 1
+def test_get_book_by_id_not_modified():
+    response = client.get("/books/1000")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["last-modified"]
+
+    response = client.get("/books/1000", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    # the xml representation has its own tag
+    response = client.get("/books/1000", headers={"Accept": "application/xml", "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+    # an update changes the tag
+    login_response = client.post("/login", auth=("wookie2", "wookie2@123"))
+    headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+    client.put("/books/1000", json=make_bulk_book(1000, title="Retitled"), headers=headers)
+    client.post("/logout", headers=headers)
+
+    response = client.get("/books/1000", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["title"] == "Retitled"
+    assert response.headers["etag"] != etag
+
+# test 2
+def test_get_books_not_modified():
+    response = client.get("/books?limit=2")
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+    assert client.get("/books?limit=2", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/books?limit=2", headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get("/books?query=bulk", headers={"If-None-Match": etag}).status_code == 304
+
+    # any write changes the catalog version
+    login_response = client.post("/login", auth=("wookie2", "wookie2@123"))
+    headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+    client.post("/books", json=make_bulk_book(700), headers=headers)
+    client.post("/logout", headers=headers)
+
+    response = client.get("/books?limit=2", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    response = client.get("/books?query=bulk", headers={"If-None-Match": etag})
+    assert 700 in [book["id"] for book in response.json()["search_results"]]
+
+
+# test 3 (compressed bodies are cached and revalidated too)
+def test_get_books_compressed(monkeypatch):
+    import http_cache
+    monkeypatch.setattr(http_cache, "COMPRESSION_MIN_SIZE", 0)
+    response_cache.clear()
+    hits, misses = response_cache.hits, response_cache.misses
+    response = client.get("/books?limit=2", headers={"Accept-Encoding": "gzip"})
+    # a cold request is one miss, however many bodies it looked up
+    assert (response_cache.hits, response_cache.misses) == (hits, misses + 1)
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    etag = response.headers["etag"]
+    assert etag.startswith('W/"books.')
+    assert len(response.json()["books"]) == 2
+
+    # the compressed variant is served from the cache, and the weak tag still validates
+    hits = response_cache.hits
+    response = client.get("/books?limit=2", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response_cache.hits == hits + 1
+    response = client.get("/books?limit=2", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304
+
+    assert "content-encoding" not in client.get("/books?limit=2", headers={"Accept-Encoding": "identity"}).headers
+
+    # a compressed request finding only the plain body is one hit
+    response_cache.clear()
+    client.get("/books?limit=2", headers={"Accept-Encoding": "identity"})
+    hits, misses = response_cache.hits, response_cache.misses
+    assert client.get("/books?limit=2", headers={"Accept-Encoding": "gzip"}).headers["content-encoding"] == "gzip"
+    assert (response_cache.hits, response_cache.misses) == (hits + 1, misses)
+
+# test 4 (writes drop the cached bodies they made stale)
+def test_writes_invalidate_cached_responses():
+    login_response = client.post("/login", auth=("wookie2", "wookie2@123"))
+    headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+    client.post("/books/bulk", json=[make_bulk_book(710), make_bulk_book(711)], headers=headers)
+    response_cache.clear()
+    client.get("/books?limit=2")
+    client.get("/books/710")
+    client.get("/books/711")
+    assert len(response_cache) == 3
+
+    client.put("/books/710", json=make_bulk_book(710, title="Invalidated"), headers=headers)
+    client.post("/logout", headers=headers)
+    # the listing and book 710 are gone, book 711 is still cached
+    assert len(response_cache) == 1
+    hits = response_cache.hits
+    client.get("/books/711")
+    assert response_cache.hits == hits + 1
+    assert client.get("/books/710").json()["title"] == "Invalidated"
+
+# test 5 (concurrent misses are computed once)
+def test_concurrent_misses_are_coalesced():
+    flights = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        if len(calls) > 1:
+            raise ValueError("second flight")
+        return b"body"
+
+    async def run():
+        bodies = await asyncio.gather(*(flights.run("key", compute) for _ in range(10)))
+        # once landed, the next call computes again; its error reaches every caller
+        errors = await asyncio.gather(*(flights.run("key", compute) for _ in range(3)), return_exceptions=True)
+        return bodies, errors
+
+    bodies, errors = asyncio.run(run())
+    assert bodies == [b"body"] * 10
+    assert [type(error) for error in errors] == [ValueError] * 3
+    assert len(calls) == 2
+    assert flights.coalesced == 11
+    assert len(flights) == 0
+
+# TEST CONDITIONAL WRITES (If-Match)
+# test 1
+def test_update_and_delete_with_if_match():
+    login_response = client.post("/login", auth=("wookie2", "wookie2@123"))
+    headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+    client.post("/books/bulk", json=[make_bulk_book(720)], headers=headers)
+    etag = client.get("/books/720").headers["etag"]
+
+    response = client.put("/books/720", json=make_bulk_book(720, title="First"), headers={**headers, "If-Match": etag})
+    assert response.status_code == 200
+    # the tag is stale now
+    response = client.put("/books/720", json=make_bulk_book(720, title="Lost"), headers={**headers, "If-Match": etag})
+    assert response.status_code == 412
+    assert client.delete("/books/720", headers={**headers, "If-Match": etag}).status_code == 412
+    assert books_db.get(720)["title"] == "First"
+
+    # any representation of the current revision matches, weak tags never do
+    xml_etag = client.get("/books/720", headers={"Accept": "application/xml"}).headers["etag"]
+    assert client.put("/books/720", json=make_bulk_book(720, title="Second"),
+                      headers={**headers, "If-Match": f'W/{xml_etag}'}).status_code == 412
+    assert client.put("/books/720", json=make_bulk_book(720, title="Second"),
+                      headers={**headers, "If-Match": f'"stale", {xml_etag}'}).status_code == 200
+    assert client.put("/books/720", json=make_bulk_book(720, title="Third"),
+                      headers={**headers, "If-Match": "*"}).status_code == 200
+    client.post("/logout", headers=headers)
+
+    # authorization is checked before the precondition
+    login_response = client.post("/login", auth=("vader", "vader@123"))
+    other_headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+    assert client.delete("/books/720", headers={**other_headers, "If-Match": etag}).status_code == 403
+    client.post("/logout", headers=other_headers)
+
+    etag = client.get("/books/720").headers["etag"]
+    assert client.delete("/books/720", headers={**headers, "If-Match": etag}).status_code == 200
+    assert books_db.get(720) is None
+
+# test 2 (concurrent read-modify-write cycles lose no update)
+def test_concurrent_conditional_updates():
+    login_response = client.post("/login", auth=("wookie2", "wookie2@123"))
+    headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+    client.post("/books/bulk", json=[make_bulk_book(730, price=0.0)], headers=headers)
+
+    def increment(times):
+        for _ in range(times):
+            while True:
+                response = client.get("/books/730")
+                book = response.json()
+                book["price"] += 1
+                response = client.put("/books/730", json=book, headers={**headers, "If-Match": response.headers["etag"]})
+                if response.status_code == 200:
+                    break
+                # someone else updated it in between: read it again
+                assert response.status_code == 412
+
+    threads = [threading.Thread(target=increment, args=(10,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.post("/logout", headers=headers)
+    assert books_db.get(730)["price"] == 80
+    books_db.delete(730)
+
+
+# TEST METRICS ENDPOINT
+def test_metrics():
+    client.get("/books/1000")
+    client.get("/books/123456")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert any(line.startswith('bookstore_responses_total{method="GET",route="/books/{book_id}",code="404"}')
+               for line in lines)
+    assert any(line.startswith('bookstore_request_duration_seconds_count{method="GET",route="/books/{book_id}"}')
+               for line in lines)
+    assert any(line.startswith('bookstore_stage_duration_seconds_count{stage="serialize"}') for line in lines)
+    assert any(line.startswith('bookstore_cache_requests_total{cache="tokens",result="hit"}') for line in lines)
+
+
+# TEST ADMIN PROFILE ENDPOINTS
+def test_admin_profiles(monkeypatch, tmp_path):
+    import auth
+    import profiling
+    monkeypatch.setattr(profiling.profile_store, "directory", str(tmp_path))
+    login_response = client.post("/login", auth=("wookie2", "wookie2@123"))
+    headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+    assert client.get("/admin/profiles", headers=headers).status_code == 403
+
+    monkeypatch.setattr(auth, "ADMIN_USERS", {"wookie2"})
+    profiling.profile_store.save("GET /books/{book_id}", "1-1", {"get_book_by_id (build.py:1)": 3})
+    response = client.get("/admin/profiles", headers=headers)
+    assert response.json() == {"profiles": [{"route": "GET /books/{book_id}", "profiles": 1, "samples": 3}]}
+    response = client.get("/admin/profiles/download", params={"route": "GET /books/{book_id}"}, headers=headers)
+    assert response.text == "get_book_by_id (build.py:1) 3\n"
+    assert client.delete("/admin/profiles", headers=headers).status_code == 200
+    assert client.get("/admin/profiles", headers=headers).json() == {"profiles": []}
+
+    client.post("/logout", headers=headers)
@@ -0,0 +1,101 @@
+import sys
+import os
+import time
+
+import pytest
+
+# Add the path of the directory containing auth.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from credentials import CredentialCache, hash_password
+from token_cache import TokenCache
+from sessions import MemorySessionStore, SQLiteSessionStore
+from sqlite_store import SQLiteDatabase
+
+
+# TEST CREDENTIAL CACHE
+# test 1
+def test_credential_cache_hit_and_miss():
+    cache = CredentialCache(maxsize=2, ttl=60)
+    hashed_password = hash_password("secret")
+    assert not cache.check("wookie1", "secret", hashed_password)
+    cache.add("wookie1", "secret", hashed_password)
+    assert cache.check("wookie1", "secret", hashed_password)
+    # wrong password, other user, or a changed password hash
+    assert not cache.check("wookie1", "Secret", hashed_password)
+    assert not cache.check("wookie2", "secret", hashed_password)
+    assert not cache.check("wookie1", "secret", hash_password("secret"))
+
+
+# test 2
+def test_credential_cache_expiry_and_bound():
+    cache = CredentialCache(maxsize=2, ttl=0)
+    cache.add("wookie1", "secret", "hash")
+    assert not cache.check("wookie1", "secret", "hash")
+
+    cache = CredentialCache(maxsize=2, ttl=60)
+    for username in ("a", "b", "c"):
+        cache.add(username, "secret", "hash")
+    assert len(cache) == 2
+    assert not cache.check("a", "secret", "hash")
+    assert cache.check("c", "secret", "hash")
+
+
+# TEST TOKEN CACHE
+# test 1
+def test_token_cache_counts_hits_and_misses():
+    cache = TokenCache(maxsize=2, ttl=60)
+    assert cache.get("token") is None
+    cache.put("token", {"sub": "wookie1", "exp": time.time() + 60})
+    assert cache.get("token")["sub"] == "wookie1"
+    cache.invalidate("token")
+    assert cache.get("token") is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "size": 0}
+
+
+# test 2
+def test_token_cache_respects_exp():
+    cache = TokenCache(maxsize=2, ttl=60)
+    cache.put("expired", {"sub": "wookie1", "exp": time.time() - 1})
+    assert cache.get("expired") is None
+    assert len(cache) == 0
+
+
+# TEST SESSION STORES
+@pytest.fixture(params=["memory", "sqlite"])
+def session_store(request, tmp_path):
+    if request.param == "memory":
+        return MemorySessionStore()
+    return SQLiteSessionStore(SQLiteDatabase(str(tmp_path / "sessions.db")))
+
+
+# test 1
+def test_session_start_and_end(session_store):
+    assert not session_store.is_active("wookie1")
+    assert session_store.start("wookie1", ttl=60)
+    assert session_store.is_active("wookie1")
+    # already logged in
+    assert not session_store.start("wookie1", ttl=60)
+    assert session_store.end("wookie1")
+    assert not session_store.is_active("wookie1")
+    assert not session_store.end("wookie1")
+
+
+# test 2
+def test_session_expires(session_store):
+    assert session_store.start("wookie1", ttl=-1)
+    assert not session_store.is_active("wookie1")
+    # an expired session doesn't block the next login
+    assert session_store.start("wookie1", ttl=60)
+
+
+# test 3
+def test_sqlite_sessions_are_shared_between_workers(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    worker_one = SQLiteSessionStore(SQLiteDatabase(path), cache_ttl=0)
+    worker_two = SQLiteSessionStore(SQLiteDatabase(path), cache_ttl=0)
+    assert worker_one.start("wookie1", ttl=60)
+    assert worker_two.is_active("wookie1")
+    assert not worker_two.start("wookie1", ttl=60)
+    assert worker_two.end("wookie1")
+    assert not worker_one.is_active("wookie1")
@@ -0,0 +1,93 @@
+import sys
+import os
+import gzip
+import zlib
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Add the path of the directory containing compression.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import compression
+from compression import CompressionMiddleware, StreamCompressor, available_encodings, negotiate_encoding
+
+BODY = b'{"books":[' + b",".join(b'{"id":%d,"title":"The Big Adventure"}' % i for i in range(200)) + b"]}"
+
+
+def make_client(encodings=("gzip",)):
+    async def page(request):
+        return Response(BODY, media_type="application/json", headers={"ETag": '"books.1.json"'})
+
+    async def small(request):
+        return PlainTextResponse("ok")
+
+    async def image(request):
+        return Response(BODY, media_type="image/png")
+
+    async def stream(request):
+        async def chunks():
+            for i in range(3):
+                yield b'{"id":%d}\n' % i
+        return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+    app = Starlette(routes=[Route("/page", page), Route("/small", small), Route("/image", image),
+                            Route("/stream", stream)])
+    return TestClient(CompressionMiddleware(app, minimum_size=100, encodings=list(encodings)))
+
+
+# TEST ACCEPT-ENCODING NEGOTIATION
+# test 1
+def test_negotiate_encoding():
+    offered = ["br", "gzip"]
+    assert negotiate_encoding("gzip, br", offered) == "br"
+    assert negotiate_encoding("gzip;q=1.0, br;q=0.5", offered) == "gzip"
+    assert negotiate_encoding("br;q=0, *", offered) == "gzip"
+    assert negotiate_encoding("identity", offered) is None
+    assert negotiate_encoding(None, offered) is None
+    assert available_encodings("zstd, gzip, deflate") == (["zstd", "gzip"] if compression.zstandard else ["gzip"])
+
+
+# TEST MIDDLEWARE
+# test 1
+def test_middleware_compresses_large_text_responses():
+    client = make_client()
+    response = client.get("/page", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.headers["etag"] == 'W/"books.1.json"'
+    assert int(response.headers["content-length"]) < len(BODY)
+    assert response.content == BODY
+
+    assert "content-encoding" not in client.get("/page", headers={"Accept-Encoding": "identity"}).headers
+    assert "content-encoding" not in client.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    assert "content-encoding" not in client.get("/image", headers={"Accept-Encoding": "gzip"}).headers
+
+# test 2
+def test_middleware_compresses_streams_chunk_by_chunk():
+    client = make_client()
+    response = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.text.splitlines() == ['{"id":0}', '{"id":1}', '{"id":2}']
+
+    # every chunk is flushed, so it can be decoded before the stream ends
+    compressor = StreamCompressor("gzip")
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    first = compressor.compress(b"first chunk")
+    assert decoder.decompress(first) == b"first chunk"
+    assert gzip.decompress(first + compressor.compress(b", second") + compressor.finish()) == b"first chunk, second"
+
+
+# test 3
+@pytest.mark.skipif(compression.brotli is None, reason="brotli is not installed")
+def test_middleware_brotli():
+    client = make_client(["br", "gzip"])
+    response = client.get("/page", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["content-encoding"] == "br"
+    assert response.content == BODY
+    response = client.get("/stream", headers={"Accept-Encoding": "br"})
+    assert response.headers["content-encoding"] == "br"
+    assert response.text.splitlines() == ['{"id":0}', '{"id":1}', '{"id":2}']
@@ -0,0 +1,38 @@
+import sys
+import os
+import json
+
+# Add the path of the directory containing encoding.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import encoding
+import xmlstream
+from encoding import JSON, XML, BlobCache, BookList, render
+
+
+def make_book(book_id, title="Title"):
+    return {"id": book_id, "title": title, "description": "Ünïcode & <markup>", "author": "wookie1",
+            "cover_image": None, "price": 1.5, "published": True}
+
+
+# TEST ENCODING
+# test 1
+def test_blob_encoding_matches_plain_encoding(monkeypatch):
+    books = [make_book(1), make_book(2, title="Other")]
+    for use_orjson in (True, False):
+        if not use_orjson:
+            monkeypatch.setattr(encoding, "orjson", None)
+        content = {"books": BookList(books), "next_cursor": None}
+        assert json.loads(render(content, JSON)) == {"books": books, "next_cursor": None}
+        assert render(content, JSON) == render({"books": books, "next_cursor": None}, JSON)
+        assert render(content, XML) == xmlstream.to_xml({"books": books, "next_cursor": None})
+
+# test 2
+def test_blob_cache_follows_record_changes():
+    cache = BlobCache(maxsize=2)
+    book = make_book(1)
+    assert cache.encode(book, JSON) is cache.encode(book, JSON)
+    assert b"New" in cache.encode(make_book(1, title="New"), JSON)
+    cache.encode(make_book(2), JSON)
+    cache.encode(make_book(3), JSON)
+    assert len(cache) <= 2
@@ -0,0 +1,32 @@
+import sys
+import os
+
+# Add the path of the directory containing metrics.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from metrics import Counter, Histogram, Registry
+
+
+# TEST PROMETHEUS RENDERING
+# test 1
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.register(Histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0)))
+    histogram.observe(0.05, "/books")
+    histogram.observe(0.5, "/books")
+    histogram.observe(5.0, "/books")
+    lines = registry.render().decode().splitlines()
+    assert lines[:2] == ["# HELP latency_seconds Latency.", "# TYPE latency_seconds histogram"]
+    assert 'latency_seconds_bucket{route="/books",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/books",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="/books",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{route="/books"} 5.55' in lines
+    assert 'latency_seconds_count{route="/books"} 3' in lines
+
+# test 2
+def test_counter_escapes_label_values():
+    registry = Registry()
+    counter = registry.register(Counter("responses_total", "Responses.", ("route",)))
+    counter.inc('say "hi"')
+    counter.inc('say "hi"', amount=2)
+    assert 'responses_total{route="say \\"hi\\""} 3' in registry.render().decode().splitlines()
@@ -0,0 +1,75 @@
+import sys
+import os
+import time
+from collections import Counter
+
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+# Add the path of the directory containing profiling.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from profiling import ProfileStore, ProfilingMiddleware, sign, verify
+
+
+def busy_endpoint(request):
+    deadline = time.perf_counter() + 0.05
+    while time.perf_counter() < deadline:
+        pass
+    return PlainTextResponse("done")
+
+
+# TEST DEBUG HEADER SIGNATURES
+# test 1
+def test_sign_and_verify():
+    value = sign("secret")
+    assert verify("secret", value)
+    assert not verify("other", value)
+    assert not verify(None, value)
+    assert not verify("secret", "1:" + value.split(":")[1])
+    assert not verify("secret", sign("secret", ttl=-1))
+
+
+# TEST PROFILING MIDDLEWARE
+# test 1
+def test_profiles_signed_requests_only(tmp_path):
+    store = ProfileStore(str(tmp_path))
+    app = Starlette(routes=[Route("/busy", busy_endpoint)])
+    app.add_middleware(ProfilingMiddleware, sample_rate=0.0, secret="secret", store=store)
+    client = TestClient(app)
+
+    response = client.get("/busy")
+    assert "x-profile-id" not in response.headers
+    assert store.summary() == []
+
+    response = client.get("/busy", headers={"X-Profile": sign("secret")})
+    assert "x-profile-id" in response.headers
+    [summary] = store.summary()
+    assert summary["route"] == "GET /busy" and summary["profiles"] == 1 and summary["samples"] > 0
+    # the sync endpoint ran on a threadpool thread, and was sampled there
+    assert "busy_endpoint (test_profiling.py" in store.merged("GET /busy")
+    assert store.merged().startswith("GET /busy;")
+    assert store.merged("GET /nothing") is None
+
+    assert store.clear() == 1
+    assert store.summary() == []
+
+
+# test 2
+def test_profile_store_merges_old_profiles_and_keeps_totals(tmp_path):
+    store = ProfileStore(str(tmp_path), max_files=2)
+    for i in range(5):
+        store.save("GET /busy", f"{1000 + i}-{os.getpid()}", Counter({"main;busy": 2, f"main;step{i}": 1}))
+    directory = os.path.join(str(tmp_path), os.listdir(str(tmp_path))[0])
+    files = sorted(name for name in os.listdir(directory) if name.endswith(".collapsed"))
+    assert files == [f"1003-{os.getpid()}.collapsed", f"1004-{os.getpid()}.collapsed",
+                     f"merged-{os.getpid()}.collapsed"]
+    assert store.summary() == [{"route": "GET /busy", "profiles": 5, "samples": 15}]
+    merged = store.merged("GET /busy")
+    assert "main;busy 10" in merged
+    assert all(f"main;step{i} 1" in merged for i in range(5))
+    assert store.clear() == 1
+    store.save("GET /busy", f"2000-{os.getpid()}", Counter({"main;busy": 1}))
+    assert store.summary() == [{"route": "GET /busy", "profiles": 1, "samples": 1}]
@@ -0,0 +1,143 @@
+import sys
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+# Add the path of the directory containing ratelimit.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from auth import create_access_token
+from ratelimit import MemoryBucketStore, RateLimitMiddleware, SQLiteBucketStore, parse_budgets
+from sqlite_store import SQLiteDatabase
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# Every bucket test runs against each bucket store
+@pytest.fixture(params=["memory", "sqlite"])
+def new_store(request, tmp_path):
+    clock = FakeClock()
+    if request.param == "memory":
+        return MemoryBucketStore(clock=clock), clock
+    return SQLiteBucketStore(SQLiteDatabase(str(tmp_path / "limits.db")), clock=clock), clock
+
+
+# TEST TOKEN BUCKETS
+# test 1
+def test_bucket_allows_a_burst_then_refills(new_store):
+    store, clock = new_store
+    # 3 requests per 3 seconds
+    assert [store.take("a", 3, 1.0)[0] for _ in range(4)] == [True, True, True, False]
+    assert store.take("b", 3, 1.0) == (True, 2)
+    clock.now += 1.5
+    assert store.take("a", 3, 1.0) == (True, 0.5)
+    assert store.take("a", 3, 1.0) == (False, 0.5)
+    clock.now += 100
+    assert store.take("a", 3, 1.0) == (True, 2)
+
+# test 2
+def test_buckets_are_taken_from_all_or_none(new_store):
+    store, clock = new_store
+    assert store.take_all([("a", 3, 1.0), ("b", 1, 1.0)]) == [(True, 2), (True, 0)]
+    # "b" is empty, so "a" keeps its tokens
+    assert store.take_all([("a", 3, 1.0), ("b", 1, 1.0)]) == [(True, 2), (False, 0)]
+    assert store.take("a", 3, 1.0) == (True, 1)
+    clock.now += 1
+    assert store.take_all([("a", 3, 1.0), ("b", 1, 1.0)]) == [(True, 1), (True, 0)]
+
+# test 3
+def test_memory_buckets_are_evicted():
+    clock = FakeClock()
+    store = MemoryBucketStore(max_buckets=3, clock=clock)
+    for key in "abcde":
+        store.take(key, 10, 1.0)
+    assert len(store) == 3
+    # once refilled, idle buckets are dropped as new clients arrive
+    clock.now += 2
+    store.take("f", 10, 1.0)
+    assert len(store) == 1
+
+
+# TEST MIDDLEWARE
+def make_client(spec, shared_spec="", store=None):
+    async def endpoint(request):
+        return PlainTextResponse("ok")
+    app = Starlette(routes=[Route("/books/{book_id}", endpoint), Route("/login", endpoint, methods=["POST"])])
+    budgets = parse_budgets(spec) + parse_budgets(shared_spec, shared=True)
+    return TestClient(RateLimitMiddleware(app, budgets, store))
+
+# test 1
+def test_middleware_limits_each_client():
+    client = make_client("GET /books/{book_id}=2/60")
+    response = client.get("/books/1")
+    assert response.headers["RateLimit-Limit"] == "2"
+    assert response.headers["RateLimit-Remaining"] == "1"
+    assert response.headers["RateLimit-Policy"] == "2;w=60"
+    assert client.get("/books/2").status_code == 200
+    response = client.get("/books/3")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "30"
+    assert response.json()["detail"] == "Too many requests, please retry later"
+    # other routes, and users with an access token, have their own budget
+    assert client.post("/login").status_code == 200
+    token = create_access_token({"sub": "wookie1"})
+    assert client.get("/books/1", headers={"Authorization": f"Bearer {token}"}).status_code == 200
+
+# test 2
+def test_middleware_shared_budget():
+    client = make_client("* *=100/1", shared_spec="POST /login=1/10")
+    token = create_access_token({"sub": "wookie1"})
+    assert client.post("/login").status_code == 200
+    response = client.post("/login", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 429
+    # the most depleted bucket is reported, every matched budget listed
+    assert response.headers["RateLimit-Remaining"] == "0"
+    assert response.headers["RateLimit-Policy"] == "100;w=1, 1;w=10"
+
+# test 3
+def test_middleware_rejected_requests_take_no_tokens():
+    clock = FakeClock()
+    store = MemoryBucketStore(clock=clock)
+    client = make_client("GET /books/{book_id}=5/60", shared_spec="* *=1/60", store=store)
+    assert client.get("/books/1").status_code == 200
+    for _ in range(3):
+        assert client.get("/books/1").status_code == 429
+    # the shared budget rejected those, so the client's own bucket wasn't drained
+    assert store.take("GET /books/{book_id}|ip:testclient", 5, 5 / 60) == (True, 3)
+
+# test 4
+def test_parse_budgets_rejects_malformed_budgets():
+    assert [budget.name for budget in parse_budgets("post /login=10/60; * *=5/0.5")] == ["POST /login", "* *"]
+    with pytest.raises(ValueError):
+        parse_budgets("POST /login=10")
+    with pytest.raises(ValueError):
+        parse_budgets("POST /login=0/60")
+
+# test 5
+def test_middleware_matches_budgets_by_resolved_route():
+    async def endpoint(request):
+        return PlainTextResponse("ok")
+    budgets = parse_budgets("* /books/{book_id}=1/60; POST /books/bulk=3/60")
+    app = Starlette(routes=[Route("/books/{book_id:int}", endpoint, methods=["GET"]),
+                            Route("/books/bulk", endpoint, methods=["POST"])],
+                    middleware=[Middleware(RateLimitMiddleware, budgets=budgets)])
+    client = TestClient(app)
+    # bulk requests are only charged to the bulk budget
+    for remaining in ("2", "1", "0"):
+        response = client.post("/books/bulk")
+        assert response.status_code == 200
+        assert response.headers["RateLimit-Policy"] == "3;w=60"
+        assert response.headers["RateLimit-Remaining"] == remaining
+    assert client.get("/books/1").status_code == 200
+    assert client.get("/books/2").status_code == 429
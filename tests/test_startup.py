@@ -0,0 +1,39 @@
+import sys
+import os
+import subprocess
+
+# Add the path of the directory containing build.py to the Python path
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(SRC)
+
+from app_constants import _find_env_file
+
+# Modules only loaded on first use: PyJWT and passlib on the first login or token
+# check, the XML encoder for the first XML client, process pools for the first
+# hashing job on one
+LAZY_MODULES = ("jwt", "passlib", "xml.sax.saxutils", "concurrent.futures.process", "uvicorn")
+
+
+# TEST STARTUP
+# test 1
+def test_importing_the_app_defers_optional_subsystems():
+    code = ("import sys; import build; "
+            f"print(','.join(name for name in {LAZY_MODULES!r} if name in sys.modules))")
+    output = subprocess.run([sys.executable, "-c", code], cwd=SRC, env={**os.environ, "SECRET_KEY": "test"},
+                            check=True, stdout=subprocess.PIPE, text=True).stdout
+    assert output.strip() == ""
+
+# test 2
+def test_env_file_is_found_in_a_parent_directory(tmp_path):
+    nested = tmp_path / "app" / "src"
+    nested.mkdir(parents=True)
+    (tmp_path / "app" / ".env").write_text("SECRET_KEY=secret\n")
+    assert _find_env_file(str(nested)) == str(tmp_path / "app" / ".env")
+
+# test 3
+def test_serve_refuses_several_workers_with_memory_sessions():
+    result = subprocess.run([sys.executable, "serve.py"], cwd=SRC, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env={**os.environ, "SECRET_KEY": "test", "WORKERS": "2", "SESSION_BACKEND": "memory"},
+                            text=True, timeout=60)
+    assert result.returncode == 1
+    assert "SESSION_BACKEND=sqlite" in result.stderr
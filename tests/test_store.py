@@ -0,0 +1,367 @@
+import sys
+import os
+import asyncio
+import random
+import threading
+import time
+
+import pytest
+
+# Add the path of the directory containing store.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import indexes
+from aio import AsyncRepository
+from store import BookStore, RevisionConflict
+from compact_store import CompactBookStore
+from mapped_store import MappedBookStore, export_catalog
+from sqlite_store import SQLiteBookStore, SQLiteDatabase
+
+
+def make_book(book_id, author="wookie1", title="Title"):
+    return {
+        "id": book_id,
+        "title": title,
+        "description": "A description",
+        "author": author,
+        "cover_image": None,
+        "price": 1.0,
+        "published": True,
+    }
+
+
+# Every test runs against each storage backend
+@pytest.fixture(params=["memory", "compact", "mapped", "sqlite"])
+def new_store(request, tmp_path):
+    def factory(books=()):
+        if request.param == "memory":
+            return BookStore(books)
+        if request.param == "compact":
+            return CompactBookStore(books)
+        if request.param == "mapped":
+            export_catalog(BookStore(books), str(tmp_path / "catalog.bin"))
+            return MappedBookStore(str(tmp_path / "catalog.bin"))
+        return SQLiteBookStore(SQLiteDatabase(str(tmp_path / "books.db")), seed=books)
+    return factory
+
+
+# TEST BOOK STORE
+# test 1
+def test_store_lookup_and_duplicates(new_store):
+    store = new_store([make_book(1), make_book(2, author="wookie2")])
+    assert len(store) == 2
+    assert 1 in store
+    assert store.get(2)["author"] == "wookie2"
+    assert store.get(3) is None
+    with pytest.raises(KeyError):
+        store.add(make_book(1))
+
+
+# test 2
+def test_store_replace_rekeys_and_reindexes_author(new_store):
+    store = new_store([make_book(1), make_book(2)])
+    store.replace(1, make_book(10, author="wookie2"))
+    assert store.get(1) is None
+    assert store.get(10)["author"] == "wookie2"
+    assert [b["id"] for b in store.by_author("wookie1")] == [2]
+    assert [b["id"] for b in store.by_author("wookie2")] == [10]
+    # new ID already taken by another book
+    with pytest.raises(KeyError):
+        store.replace(10, make_book(2))
+
+
+# test 3
+def test_store_delete(new_store):
+    store = new_store([make_book(1), make_book(2), make_book(3)])
+    assert store.delete(2)["id"] == 2
+    assert [b["id"] for b in store] == [1, 3]
+    assert [b["id"] for b in store.by_author("wookie1")] == [1, 3]
+    with pytest.raises(KeyError):
+        store.delete(2)
+
+# test 4
+def test_store_batches_reject_duplicate_ids(new_store):
+    store = new_store([make_book(1), make_book(2)])
+    for batch in (lambda: store.replace_many([make_book(1, title="New"), make_book(1, title="Newer")]),
+                  lambda: store.add_many([make_book(3), make_book(3)]),
+                  lambda: store.delete_many([2, 2])):
+        with pytest.raises(KeyError):
+            batch()
+    # nothing changed, and every index still holds both books
+    assert len(store) == 2
+    assert [b["id"] for b in store.page()[0]] == [1, 2]
+    assert [b["title"] for b in store.find(sort="title")[0]] == ["Title", "Title"]
+    assert [b["id"] for b in store.search("title")] == [1, 2]
+    store.delete(1)
+    assert [b["id"] for b in store.page()[0]] == [2]
+
+
+# TEST SEARCH INDEX
+# test 1
+def test_store_search_substring_and_ranking(new_store):
+    store = new_store([
+        make_book(1, title="Star Wars"),
+        make_book(2, title="Guide", author="starling"),
+        make_book(3, title="Mustard Tales"),
+    ])
+    store.replace(3, dict(make_book(3, title="Other"), description="A tale of a rockstar"))
+    # title matches rank above author matches, which rank above description matches
+    assert [b["id"] for b in store.search("STAR")] == [1, 2, 3]
+    assert [b["id"] for b in store.search("star", limit=1)] == [1]
+    assert [b["id"] for b in store.search("tar wa")] == [1]
+    assert store.search("mustard") == []
+
+
+# test 2
+def test_store_search_follows_deletes(new_store):
+    store = new_store([make_book(1, title="The Big Adventure"), make_book(2, title="Big Data")])
+    store.delete(1)
+    assert [b["id"] for b in store.search("big")] == [2]
+    assert store.search("adventure") == []
+
+# test 3
+def test_store_search_short_terms(new_store):
+    store = new_store([make_book(1, title="The Big Adventure"), make_book(2, title="Big Data"),
+                       make_book(3, title="X")])
+    store.delete(2)
+    assert [b["id"] for b in store.search("en")] == [1]
+    assert [b["id"] for b in store.search("x")] == [3]
+    assert store.search("ta") == []
+    # the token index matches single characters as prefixes only
+    if isinstance(store, BookStore):
+        assert store.search("v") == []
+        assert [b["id"] for b in store.search("a")] == [1, 3]
+
+
+# TEST FILTERS AND SORTS
+# test 1
+def test_store_find_filters_sorts_and_pages(new_store):
+    store = new_store([
+        dict(make_book(1, title="b"), price=3.0),
+        dict(make_book(2, author="wookie2", title="A"), price=1.0, published=False),
+        dict(make_book(3, title="c"), price=2.0),
+        dict(make_book(4, title="a"), price=2.0),
+    ])
+    books, after = store.find(sort="price", limit=2)
+    assert [b["id"] for b in books] == [2, 3]
+    books, after = store.find(sort="price", after=after, limit=2)
+    assert [b["id"] for b in books] == [4, 1]
+    assert after is None
+
+    # titles ignore ASCII case, ties broken by ID
+    assert [b["id"] for b in store.find(sort="title", descending=True)[0]] == [3, 1, 4, 2]
+    assert [b["id"] for b in store.find(published=True, price_max=2.0)[0]] == [3, 4]
+    assert [b["id"] for b in store.find(author="wookie1", price_min=2.5)[0]] == [1]
+
+    store.replace(4, dict(make_book(4), price=5.0))
+    assert [b["id"] for b in store.find(sort="price", descending=True, limit=1)[0]] == [4]
+    store.delete(4)
+    assert [b["id"] for b in store.find(price_min=4.0)[0]] == []
+
+# test 2
+def test_store_orders_follow_writes_across_index_blocks(new_store, monkeypatch):
+    # tiny blocks, so the writes below split and merge them all the time
+    monkeypatch.setattr(indexes, "BLOCK_SIZE", 4)
+    rng = random.Random(7)
+
+    def random_book(book_id):
+        return dict(make_book(book_id, title=rng.choice("abcdefgh")), price=float(rng.randint(1, 20)))
+
+    books = {book_id: random_book(book_id) for book_id in range(0, 200, 2)}
+    store = new_store(books.values())
+    batch_start = 1000
+    for _ in range(300):
+        book_id = rng.randrange(200)
+        if book_id not in books:
+            books[book_id] = random_book(book_id)
+            store.add(books[book_id])
+        elif rng.random() < 0.5:
+            books[book_id] = random_book(book_id)
+            store.replace(book_id, books[book_id])
+        else:
+            del books[book_id]
+            store.delete(book_id)
+        if rng.random() < 0.05:
+            batch = [random_book(book_id) for book_id in range(batch_start, batch_start + 100)]
+            batch_start += 100
+            store.add_many(batch)
+            books.update((book["id"], book) for book in batch)
+
+    orders = {"id": lambda b: b["id"], "price": lambda b: (b["price"], b["id"]),
+              "title": lambda b: (b["title"], b["id"])}
+    for sort, key in orders.items():
+        for descending in (False, True):
+            expected = [b["id"] for b in sorted(books.values(), key=key, reverse=descending)]
+            seen, after = [], None
+            while True:
+                page, after = store.find(sort=sort, descending=descending, after=after, limit=7)
+                seen += [b["id"] for b in page]
+                if after is None:
+                    break
+            assert seen == expected
+    assert [b["id"] for b in store.find(sort="price", price_min=5.0, price_max=9.0, limit=10000)[0]] == \
+        [b["id"] for b in sorted(books.values(), key=orders["price"]) if 5.0 <= b["price"] <= 9.0]
+    assert [b["id"] for b in store.page(cursor=50, limit=10000)[0]] == sorted(i for i in books if i > 50)
+
+
+# TEST VERSIONS AND REVISIONS
+# test 1
+def test_store_versions_and_revisions(new_store):
+    store = new_store([make_book(1), make_book(2)])
+    version = store.version()[0]
+    assert store.revision(1)[0] <= version
+    assert store.revision(3) is None
+
+    store.replace(1, make_book(1, title="New"))
+    assert store.version()[0] == version + 1
+    assert store.revision(1)[0] == version + 1
+    assert store.revision(2)[0] < version + 1
+
+    # a book created again never gets a revision it had before
+    store.delete(1)
+    assert store.revision(1) is None
+    store.add(make_book(1))
+    assert store.revision(1)[0] == version + 3
+
+    store.add_many([make_book(4), make_book(5)])
+    assert store.revision(4) == store.revision(5) == store.version()
+
+
+# TEST CONDITIONAL WRITES
+# test 1
+def test_store_conditional_writes(new_store):
+    store = new_store([make_book(1), make_book(2)])
+    revision = store.revision(1)[0]
+    version = store.version()[0]
+    with pytest.raises(RevisionConflict) as conflict:
+        store.replace(1, make_book(1, title="Stale"), expected_revision=revision - 1)
+    assert conflict.value.revision == revision
+    # a failed check writes nothing
+    assert store.get(1)["title"] == "Title"
+    assert store.version()[0] == version
+
+    store.replace(1, make_book(1, title="New"), expected_revision=revision)
+    with pytest.raises(RevisionConflict):
+        store.delete(1, expected_revision=revision)
+    assert 1 in store
+    store.delete(1, expected_revision=store.revision(1)[0])
+    with pytest.raises(KeyError):
+        store.delete(1, expected_revision=revision)
+
+# test 2
+def test_store_concurrent_read_modify_writes_lose_no_updates(new_store):
+    books, writers, increments = 4, 4, 25
+    store = new_store([make_book(book_id) for book_id in range(books)])
+    version = store.version()[0]
+
+    def increment(book_id):
+        for _ in range(increments):
+            while True:
+                revision = store.revision(book_id)[0]
+                book = store.get(book_id)
+                # let other writers in between the read and the write, as a route would
+                time.sleep(0)
+                try:
+                    store.replace(book_id, {**book, "price": book["price"] + 1}, expected_revision=revision)
+                    break
+                except RevisionConflict:
+                    pass
+
+    threads = [threading.Thread(target=increment, args=(book_id,))
+               for book_id in range(books) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [store.get(book_id)["price"] for book_id in range(books)] == [1.0 + writers * increments] * books
+    assert store.version()[0] == version + books * writers * increments
+
+
+# TEST MAPPED CATALOG
+# test 1
+def test_mapped_catalog_layers_writes_over_the_file(tmp_path):
+    path = str(tmp_path / "catalog.bin")
+    export_catalog(BookStore([make_book(1), make_book(2, title="Star"), make_book(3)]), path)
+    store = MappedBookStore(path)
+    store.replace(2, make_book(2, title="Moon"))
+    store.delete(3)
+    store.add(make_book(4, title="Star"))
+    assert [b["id"] for b in store] == [1, 2, 4]
+    assert [b["id"] for b in store.search("star")] == [4]
+    assert [b["title"] for b in store.by_author("wookie1")] == ["Title", "Moon", "Star"]
+
+    # the file itself never changes; exporting again folds the writes in
+    assert [b["id"] for b in MappedBookStore(path)] == [1, 2, 3]
+    export_catalog(store, path)
+    reopened = MappedBookStore(path)
+    assert list(reopened) == list(store)
+    assert reopened.version() == store.version()
+    assert reopened.revision(4) == store.revision(4)
+
+    (tmp_path / "other.bin").write_bytes(b"not a catalog" * 100)
+    with pytest.raises(ValueError):
+        MappedBookStore(str(tmp_path / "other.bin"))
+
+
+# TEST ASYNC REPOSITORY
+# test 1
+def test_async_repository(new_store):
+    store = new_store([make_book(1), make_book(2, title="Other")])
+    repository = AsyncRepository(store, workers=2)
+
+    async def run():
+        threads = {}
+        original = store.get
+
+        def get(book_id):
+            threads["get"] = threading.current_thread()
+            return original(book_id)
+        store.get = get
+        assert (await repository.get(1))["id"] == 1
+        assert [b["id"] for b in await repository.search("other")] == [2]
+        await repository.add(make_book(3))
+        assert await repository.revision(3) == await repository.version()
+        return threads["get"]
+
+    try:
+        thread = asyncio.run(run())
+    finally:
+        repository.shutdown()
+    # in-memory lookups run inline on the event loop, SQLite ones on the storage executor
+    assert (thread is threading.main_thread()) == (not store.blocking)
+
+# test 2
+def test_async_repository_waits_for_the_store_lock_off_the_event_loop(new_store):
+    store = new_store([make_book(1), make_book(2)])
+    if store.blocking:
+        pytest.skip("every call of a blocking backend runs on the executor")
+    repository = AsyncRepository(store, workers=2, offload_min_size=1)
+    # a scan holding the lock, as an offloaded search would
+    locked, release = threading.Event(), threading.Event()
+
+    def hold():
+        with store._lock:
+            locked.set()
+            # let go eventually, so a write blocking the event loop fails the test
+            # instead of hanging it
+            release.wait(1)
+    holder = threading.Thread(target=hold)
+    holder.start()
+    locked.wait()
+
+    async def run():
+        assert await repository.version() == store.version()
+        add = asyncio.ensure_future(repository.add(make_book(3)))
+        # the event loop keeps running while the write waits for the lock
+        await asyncio.sleep(0.05)
+        assert not add.done()
+        release.set()
+        await add
+
+    try:
+        asyncio.run(run())
+    finally:
+        release.set()
+        holder.join()
+        repository.shutdown()
+    assert store.get(3)["id"] == 3
@@ -0,0 +1,129 @@
+import sys
+import os
+import threading
+
+import pytest
+
+# Add the path of the directory containing wal.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from compact_store import CompactBookStore
+from store import BookStore, RevisionConflict, UserStore
+from wal import DurableBookStore, DurableUserStore, list_segments, segment_path
+
+
+def make_book(book_id, author="wookie1", title="Title"):
+    return {
+        "id": book_id,
+        "title": title,
+        "description": "A description",
+        "author": author,
+        "cover_image": None,
+        "price": 1.0,
+        "published": True,
+    }
+
+
+# Every test runs against each in-memory book store
+@pytest.fixture(params=[BookStore, CompactBookStore])
+def open_store(request, tmp_path):
+    opened = []
+
+    def factory(**options):
+        store = DurableBookStore(str(tmp_path / "books"), request.param, seed=[make_book(1)], **options)
+        opened.append(store)
+        return store
+    yield factory
+    for store in opened:
+        store.journal.close()
+
+
+def contents(store):
+    # replayed writes keep their revisions, not their timestamps
+    return list(store), store.version()[0], [store.revision(book["id"])[0] for book in store]
+
+
+# TEST WRITE-AHEAD LOG
+# test 1
+def test_writes_survive_a_restart(open_store):
+    store = open_store()
+    store.add(make_book(2, title="Second"))
+    store.replace(1, make_book(1, title="First"))
+    store.add_many([make_book(book_id) for book_id in range(10, 20)])
+    store.delete_many([10, 11])
+    store.delete(2)
+    with pytest.raises(KeyError):
+        store.add(make_book(1))
+    expected = contents(store)
+    store.journal.close()
+
+    reopened = open_store()
+    assert contents(reopened) == expected
+    assert reopened.get(1)["title"] == "First"
+    assert [book["id"] for book in reopened.search("first")] == [1]
+
+# test 2
+def test_snapshot_and_log_tail(open_store):
+    store = open_store(snapshot_every=1000)
+    store.add_many([make_book(book_id) for book_id in range(2, 100)])
+    store.journal.checkpoint()
+    store.replace(5, make_book(5, title="After the snapshot"))
+    expected = contents(store)
+    store.journal.close()
+    # the snapshot made the earlier segments redundant
+    assert len(list_segments(store.journal.directory)) == 1
+
+    reopened = open_store()
+    assert contents(reopened) == expected
+
+# test 3
+def test_torn_record_at_the_end_of_the_log_is_dropped(open_store):
+    store = open_store()
+    store.add(make_book(2))
+    expected = contents(store)
+    store.journal.close()
+    with open(segment_path(store.journal.directory, store.journal.log.seq), "ab") as f:
+        f.write(b"\x40\x00\x00\x00\x00\x00\x00\x00{\"partial")
+
+    reopened = open_store()
+    assert contents(reopened) == expected
+    reopened.add(make_book(3))
+    reopened.journal.close()
+    assert 3 in open_store()
+
+# test 4
+def test_concurrent_writers_share_commits(open_store):
+    store = open_store(commit_delay=0.01)
+    threads = [threading.Thread(target=store.add, args=(make_book(book_id),)) for book_id in range(2, 34)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(store) == 33
+    assert store.journal.log.commits < 32
+
+# test 5
+def test_conditional_writes_survive_a_restart(open_store):
+    store = open_store()
+    store.add(make_book(2))
+    store.replace(1, make_book(1, title="First"), expected_revision=store.revision(1)[0])
+    with pytest.raises(RevisionConflict):
+        store.delete(2, expected_revision=store.revision(2)[0] - 1)
+    store.delete(2, expected_revision=store.revision(2)[0])
+    expected = contents(store)
+    store.journal.close()
+
+    assert contents(open_store()) == expected
+
+# test 6
+def test_user_store_is_durable(tmp_path):
+    directory = str(tmp_path / "users")
+    users = DurableUserStore(directory, UserStore, seed=[{"username": "wookie1", "hashed_password": "old"}])
+    users.update("wookie1", hashed_password="new")
+    users.add({"username": "wookie2", "hashed_password": "hash"})
+    users.journal.close()
+
+    users = DurableUserStore(directory, UserStore)
+    assert users.get("wookie1")["hashed_password"] == "new"
+    assert "wookie2" in users
+    users.journal.close()